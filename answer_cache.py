@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticAnswerCache:
+    """
+    Семантический кэш ответов RAG по проектам (SQLite + матрица векторов в памяти).
+
+    Запись: эмбеддинг вопроса, id найденных чанков, источники, ответ и ревизия индекса.
+    Попадание — косинусная близость вопроса >= threshold при той же ревизии индекса и не старше ttl.
+    На проект хранится не больше max_entries записей, лишние вытесняются по last_used (LRU).
+    """
+
+    def __init__(self, db_path: str, threshold: float = 0.95, ttl_seconds: float = 3 * 24 * 3600, max_entries: int = 200):
+        self.db_path = db_path
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        # project -> (ревизия, ids, нормированные векторы)
+        self._vectors: dict[str, tuple[int, list[int], np.ndarray]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def set_path(self, db_path: str) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self._vectors.clear()
+            self.db_path = db_path
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " project TEXT NOT NULL,"
+                " revision INTEGER NOT NULL,"
+                " query TEXT NOT NULL,"
+                " vector BLOB NOT NULL,"
+                " chunk_ids TEXT NOT NULL,"
+                " sources TEXT NOT NULL,"
+                " answer TEXT NOT NULL,"
+                " created REAL NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS answers_project ON answers(project, last_used)")
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32)
+        n = float(np.linalg.norm(v))
+        return v / n if n else v
+
+    def _project_vectors(self, db: sqlite3.Connection, project: str, revision: int) -> tuple[list[int], np.ndarray]:
+        cached = self._vectors.get(project)
+        if cached is not None and cached[0] == revision:
+            return cached[1], cached[2]
+        min_created = time.time() - self.ttl_seconds
+        rows = db.execute(
+            "SELECT id, vector FROM answers WHERE project = ? AND revision = ? AND created >= ?",
+            (project, revision, min_created),
+        ).fetchall()
+        ids = [r[0] for r in rows]
+        matrix = (
+            np.vstack([np.frombuffer(r[1], dtype=np.float32) for r in rows])
+            if rows else np.zeros((0, 0), dtype=np.float32)
+        )
+        self._vectors[project] = (revision, ids, matrix)
+        return ids, matrix
+
+    def lookup(self, project: str, revision: int, query_vector) -> tuple[str, dict | list] | None:
+        """(answer, sources) похожего вопроса или None; sources сохраняются как переданы в put."""
+        q = self._normalize(query_vector)
+        with self._lock:
+            db = self._db()
+            ids, matrix = self._project_vectors(db, project, revision)
+            if not ids or matrix.shape[1] != q.shape[0]:
+                self.misses += 1
+                return None
+
+            scores = matrix @ q
+            best = int(np.argmax(scores))
+            if float(scores[best]) < self.threshold:
+                self.misses += 1
+                return None
+
+            row = db.execute(
+                "SELECT answer, sources, created FROM answers WHERE id = ?", (ids[best],)
+            ).fetchone()
+            if row is None or row[2] < time.time() - self.ttl_seconds:
+                self._vectors.pop(project, None)
+                self.misses += 1
+                return None
+
+            db.execute("UPDATE answers SET last_used = ? WHERE id = ?", (time.time(), ids[best]))
+            db.commit()
+            self.hits += 1
+            return row[0], json.loads(row[1])
+
+    def put(
+        self,
+        project: str,
+        revision: int,
+        query: str,
+        query_vector,
+        chunk_ids: list[str],
+        sources: dict | list,
+        answer: str,
+    ) -> None:
+        q = self._normalize(query_vector)
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT INTO answers (project, revision, query, vector, chunk_ids, sources, answer, created, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    project, revision, query, q.tobytes(),
+                    json.dumps(chunk_ids, ensure_ascii=False),
+                    json.dumps(sources, ensure_ascii=False),
+                    answer, now, now,
+                ),
+            )
+            # TTL + LRU-лимит на проект
+            db.execute(
+                "DELETE FROM answers WHERE project = ? AND (revision != ? OR created < ?)",
+                (project, revision, now - self.ttl_seconds),
+            )
+            db.execute(
+                "DELETE FROM answers WHERE project = ? AND id NOT IN ("
+                " SELECT id FROM answers WHERE project = ? ORDER BY last_used DESC LIMIT ?)",
+                (project, project, self.max_entries),
+            )
+            db.commit()
+            self._vectors.pop(project, None)
+
+    def invalidate(self, project: str) -> None:
+        """Вызывается после переиндексации проекта: старые ответы больше не актуальны."""
+        with self._lock:
+            db = self._db()
+            db.execute("DELETE FROM answers WHERE project = ?", (project,))
+            db.commit()
+            self._vectors.pop(project, None)
+        logger.info("Кэш ответов сброшен: %s", project)
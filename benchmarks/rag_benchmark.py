@@ -0,0 +1,403 @@
+"""
+Бенчмарк RAG-пайплайна на синтетическом корпусе русскоязычных PDF.
+
+Этапы: извлечение текста (iter_pdf_documents), разбиение на чанки, сборка индекса
+(build_index_for_project: холодная, без изменений, полная с кэшами) и поиск (get_relevant_context).
+Эмбеддинги — локальный провайдер (embedding_providers.HashingEmbeddings, без сети и расходов),
+поэтому цифры сравнимы между версиями кода на одной машине.
+
+Запуск (из корня репозитория):
+  python benchmarks/rag_benchmark.py --pdfs 20 --pages 30 --output bench.json
+  python benchmarks/rag_benchmark.py --pdfs 20 --pages 30 --compare bench.json
+
+Результат — JSON: параметры, pages/sec, chunks/sec, пиковый RSS, размер индекса на диске,
+латентность запросов p50/p95/p99.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from datetime import datetime
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# Бенчмарк не ходит в OpenAI: провайдер эмбеддингов — локальный
+os.environ["RAG_EMBEDDING_PROVIDER"] = "local"
+
+import rag_engine  # noqa: E402
+
+logger = logging.getLogger("rag_benchmark")
+
+PROJECT = "Бенчмарк Объект"
+
+# -------------------- SYNTHETIC CORPUS --------------------
+_WORDS = """
+монтаж кровли утеплитель гидроизоляция пароизоляция трубопровод стояк канализации водоснабжения
+отопления подвала фасада кладки штукатурки стяжки перекрытия балконной плиты лестничной клетки
+армирование бетона опалубки арматуры сварки креплений кронштейнов водостока парапета примыкания
+толщина слоя уклон шаг длина ширина высота диаметр давление температура испытание приёмка
+согласно проекту требованиям нормативам замечание устранение дефекта акт освидетельствования
+скрытых работ исполнительная документация подрядчик технадзор заказчик смета объём расценка
+выполнить проверить заменить установить демонтировать очистить загрунтовать окрасить
+""".split()
+_NORMS = ["СП 17.13330.2017", "СП 30.13330.2020", "СП 60.13330.2020", "ГОСТ 30494-2011", "СП 71.13330.2017"]
+_UNITS = ["мм", "м", "м2", "м3", "шт", "кг", "МПа", "°C"]
+
+# cp1251 → глифы Adobe Glyph List: pdfminer восстанавливает кириллицу без встроенного шрифта
+# (в AGL Ё/ё стоят внутри алфавита — afii10023/afii10071, в cp1251 — отдельно)
+_CYRILLIC_DIFFERENCES = "168 /afii10023 184 /afii10071 192 " + " ".join(
+    f"/afii{n}" for n in [*range(10017, 10050), *range(10065, 10098)] if n not in (10023, 10071)
+)
+_FONT_SIZE = 9
+_LINE_CHARS = 100
+
+
+def _sentence(rng: random.Random) -> str:
+    words = rng.sample(_WORDS, rng.randint(6, 12))
+    if rng.random() < 0.3:
+        words.insert(rng.randint(0, len(words)), rng.choice(_NORMS))
+    if rng.random() < 0.5:
+        words.append(f"{rng.randint(1, 900)} {rng.choice(_UNITS)}")
+    text = " ".join(words)
+    return text[0].upper() + text[1:] + "."
+
+
+def _page_lines(rng: random.Random, n_lines: int) -> list[str]:
+    lines: list[str] = []
+    current = ""
+    while len(lines) < n_lines:
+        for word in _sentence(rng).split():
+            if len(current) + len(word) + 1 > _LINE_CHARS:
+                lines.append(current)
+                current = ""
+            current = f"{current} {word}" if current else word
+    return lines[:n_lines]
+
+
+def _pdf_string(text: str) -> bytes:
+    raw = text.encode("cp1251", errors="replace")
+    return b"(" + raw.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+def write_pdf(path: str, pages: list[list[str]]) -> None:
+    """Минимальный PDF: Type1-шрифт с cp1251-кодировкой, по строке текста на Tj."""
+    objects: list[bytes] = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"",  # Pages — после страниц
+        (
+            b"<< /Type /Font /Subtype /Type1 /BaseFont /BenchSansCyr /FirstChar 32 /LastChar 255"
+            b" /Widths [" + b" ".join([b"500"] * 224) + b"]"
+            b" /FontDescriptor << /Type /FontDescriptor /FontName /BenchSansCyr /Flags 32"
+            b" /FontBBox [0 -200 1000 900] /ItalicAngle 0 /Ascent 900 /Descent -200 /CapHeight 700 /StemV 80 >>"
+            b" /Encoding << /Type /Encoding /BaseEncoding /WinAnsiEncoding /Differences ["
+            + _CYRILLIC_DIFFERENCES.encode("ascii") + b"] >> >>"
+        ),
+    ]
+    kids: list[int] = []
+    for lines in pages:
+        ops = [f"BT /F1 {_FONT_SIZE} Tf {_FONT_SIZE + 3} TL 40 800 Td".encode("ascii")]
+        ops += [_pdf_string(line) + b" Tj T*" for line in lines]
+        ops.append(b"ET")
+        content = b"\n".join(ops)
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842]"
+            b" /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (len(objects))
+        )
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % k for k in kids), len(kids)
+    )
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets: list[int] = []
+    for num, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % num + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % off for off in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def generate_corpus(folder: str, n_pdfs: int, n_pages: int, n_lines: int, seed: int) -> int:
+    """PDF-файлы корпуса в folder (часть — во вложенных папках). Возвращает число страниц."""
+    rng = random.Random(seed)
+    for i in range(n_pdfs):
+        sub = os.path.join(folder, ["Проект", "Сметы", "Акты"][i % 3])
+        os.makedirs(sub, exist_ok=True)
+        pages = [_page_lines(rng, n_lines) for _ in range(n_pages)]
+        write_pdf(os.path.join(sub, f"документ_{i:03d}.pdf"), pages)
+    return n_pdfs * n_pages
+
+
+def generate_queries(n: int, seed: int) -> list[str]:
+    rng = random.Random(seed + 1)
+    queries = []
+    for _ in range(n):
+        words = rng.sample(_WORDS, rng.randint(2, 5))
+        if rng.random() < 0.3:
+            words.append(rng.choice(_NORMS))
+        queries.append(" ".join(words))
+    return queries
+
+
+# -------------------- EMBEDDINGS --------------------
+class CountingEmbeddings(Embeddings):
+    """Обёртка провайдера: считает вызовы и тексты, может имитировать задержку API на пачку."""
+
+    def __init__(self, underlying: Embeddings, latency_ms: float = 0.0):
+        self.underlying = underlying
+        self.persistent_cache = getattr(underlying, "persistent_cache", True)
+        self.latency_ms = latency_ms
+        self.calls = 0
+        self.texts = 0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        self.calls += 1
+        self.texts += len(texts)
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        return self.underlying.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.underlying.embed_query(text)
+
+
+# -------------------- MEASUREMENTS --------------------
+def _peak_rss_mb() -> dict:
+    # Linux: ru_maxrss в килобайтах; children — процессы извлечения PDF
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {"self": round(self_kb / 1024, 1), "children": round(children_kb / 1024, 1)}
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _percentiles(latencies: list[float]) -> dict:
+    arr = np.asarray(latencies) * 1000
+    return {
+        "count": len(latencies),
+        "mean_ms": round(float(arr.mean()), 3),
+        "p50_ms": round(float(np.percentile(arr, 50)), 3),
+        "p95_ms": round(float(np.percentile(arr, 95)), 3),
+        "p99_ms": round(float(np.percentile(arr, 99)), 3),
+        "max_ms": round(float(arr.max()), 3),
+    }
+
+
+def _rate(count: int, seconds: float) -> float:
+    return round(count / seconds, 2) if seconds > 0 else 0.0
+
+
+def _git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def run(args) -> dict:
+    # Рабочий каталог всегда свой, внутри --data-dir: переданный каталог не очищается и не удаляется
+    if args.data_dir:
+        os.makedirs(args.data_dir, exist_ok=True)
+    data_dir = tempfile.mkdtemp(prefix="rag_bench_", dir=args.data_dir)
+
+    rag_engine.configure(data_dir, extract_workers=args.extract_workers)
+    rag_engine.set_embedding_provider("local", dim=args.dim)
+    embedder = CountingEmbeddings(rag_engine.EMBEDDINGS.underlying, latency_ms=args.embed_latency_ms)
+    rag_engine.EMBEDDINGS.set_underlying(embedder, rag_engine.EMBEDDING_MODEL)
+    rag_engine.VECTOR_STORES.max_bytes = max(rag_engine.VECTOR_STORES.max_bytes, 1 << 34)
+
+    docs_path = rag_engine._project_docs_path(PROJECT)
+    t0 = time.perf_counter()
+    total_pages = generate_corpus(docs_path, args.pdfs, args.pages, args.lines, args.seed)
+    corpus = {
+        "pdfs": args.pdfs,
+        "pages": total_pages,
+        "bytes": _dir_size(docs_path),
+        "generate_seconds": round(time.perf_counter() - t0, 3),
+    }
+    logger.info("Корпус: %d PDF, %d страниц, %.1f МБ", args.pdfs, total_pages, corpus["bytes"] / 1024 / 1024)
+
+    results: dict = {"corpus": corpus, "stages": {}}
+    stages = results["stages"]
+
+    # 1. Извлечение текста (холодный кэш страниц)
+    t0 = time.perf_counter()
+    docs = list(rag_engine.iter_pdf_documents(docs_path))
+    dt = time.perf_counter() - t0
+    stages["extract"] = {
+        "seconds": round(dt, 3), "pages": len(docs), "pages_per_sec": _rate(len(docs), dt), "rss_mb": _peak_rss_mb(),
+    }
+
+    # 2. Разбиение на чанки (те же параметры, что в build_index_for_project)
+    splitter = rag_engine.RecursiveCharacterTextSplitter(
+        chunk_size=1000, chunk_overlap=150, separators=["\n\n", "\n", ". ", " ", ""]
+    )
+    t0 = time.perf_counter()
+    chunks = splitter.split_documents(docs)
+    dt = time.perf_counter() - t0
+    stages["chunk"] = {
+        "seconds": round(dt, 3), "chunks": len(chunks), "chunks_per_sec": _rate(len(chunks), dt),
+        "rss_mb": _peak_rss_mb(),
+    }
+    del docs, chunks
+
+    # 3. Сборка индекса: холодная (без кэша страниц и эмбеддингов), без изменений, полная с кэшами
+    rag_engine.invalidate_page_cache()
+    for name, kwargs in (("build_cold", {}), ("build_noop", {}), ("build_full_cached", {"full_rebuild": True})):
+        texts_before = embedder.texts
+        t0 = time.perf_counter()
+        index = rag_engine.build_index_for_project(PROJECT, **kwargs)
+        dt = time.perf_counter() - t0
+        n_chunks = index.ntotal if index is not None else 0
+        stages[name] = {
+            "seconds": round(dt, 3),
+            "chunks": n_chunks,
+            "pages_per_sec": _rate(total_pages, dt),
+            "chunks_per_sec": _rate(n_chunks, dt),
+            "embedded_texts": embedder.texts - texts_before,
+            "rss_mb": _peak_rss_mb(),
+        }
+        logger.info("%s: %.2f с, chunks=%d", name, dt, n_chunks)
+
+    results["index_bytes"] = {
+        "project": _dir_size(rag_engine._project_index_path(PROJECT)),
+        "chunk_store": _dir_size(os.path.join(data_dir, rag_engine.CHUNK_STORE_DIRNAME)),
+        "page_cache": _dir_size(os.path.join(data_dir, rag_engine.PAGE_CACHE_DIRNAME)),
+    }
+
+    # 4. Поиск: первый запрос — с загрузкой индекса с диска, остальные — по индексу в памяти
+    queries = generate_queries(args.queries, args.seed)
+    rag_engine.VECTOR_STORES.pop(PROJECT, None)
+    t0 = time.perf_counter()
+    rag_engine.get_relevant_context(PROJECT, queries[0])
+    first = time.perf_counter() - t0
+    latencies = []
+    for query in queries:
+        t0 = time.perf_counter()
+        rag_engine.get_relevant_context(PROJECT, query)
+        latencies.append(time.perf_counter() - t0)
+    stages["query"] = {"first_ms": round(first * 1000, 3), **_percentiles(latencies), "rss_mb": _peak_rss_mb()}
+
+    results["peak_rss_mb"] = _peak_rss_mb()
+    results["meta"] = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "data_dir", "keep")},
+    }
+
+    if args.keep:
+        logger.info("Рабочий каталог сохранён: %s", data_dir)
+    else:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return results
+
+
+# -------------------- REPORT --------------------
+_KEY_METRICS = [
+    ("stages.extract.pages_per_sec", True),
+    ("stages.chunk.chunks_per_sec", True),
+    ("stages.build_cold.chunks_per_sec", True),
+    ("stages.build_noop.seconds", False),
+    ("stages.build_full_cached.seconds", False),
+    ("stages.query.p50_ms", False),
+    ("stages.query.p95_ms", False),
+    ("stages.query.p99_ms", False),
+    ("peak_rss_mb.self", False),
+    ("index_bytes.project", False),
+    ("index_bytes.chunk_store", False),
+]
+
+
+def _get(data: dict, dotted: str):
+    for part in dotted.split("."):
+        if not isinstance(data, dict) or part not in data:
+            return None
+        data = data[part]
+    return data
+
+
+def print_report(results: dict, baseline: dict | None = None) -> None:
+    print(f"{'метрика':<36} {'значение':>14}" + (f" {'база':>14} {'изменение':>10}" if baseline else ""))
+    for key, higher_is_better in _KEY_METRICS:
+        value = _get(results, key)
+        line = f"{key:<36} {value!s:>14}"
+        if baseline:
+            base = _get(baseline, key)
+            if isinstance(value, (int, float)) and isinstance(base, (int, float)) and base:
+                change = (value - base) / base * 100
+                worse = change < 0 if higher_is_better else change > 0
+                line += f" {base!s:>14} {change:>+9.1f}%" + (" ⚠️" if worse and abs(change) > 10 else "")
+            else:
+                line += f" {base!s:>14}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк RAG-пайплайна на синтетических PDF")
+    parser.add_argument("--pdfs", type=int, default=10, help="число PDF в корпусе")
+    parser.add_argument("--pages", type=int, default=20, help="страниц в каждом PDF")
+    parser.add_argument("--lines", type=int, default=55, help="строк текста на странице")
+    parser.add_argument("--queries", type=int, default=200, help="число поисковых запросов")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--dim", type=int, default=1536, help="размерность эмбеддингов (как text-embedding-3-small)")
+    parser.add_argument("--embed-latency-ms", type=float, default=0.0, help="имитация задержки API на пачку")
+    parser.add_argument("--extract-workers", type=int, default=1, help="RAG_EXTRACT_WORKERS")
+    parser.add_argument("--data-dir", help="где создать рабочий каталог (по умолчанию системный temp)")
+    parser.add_argument("--keep", action="store_true", help="не удалять рабочий каталог")
+    parser.add_argument("--output", help="куда сохранить JSON с результатами")
+    parser.add_argument("--compare", help="JSON предыдущего запуска для сравнения")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    logger.setLevel(logging.INFO)
+
+    results = run(args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import os
+import re
+import math
+import sqlite3
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Слова + идентификаторы вида "17.13330", "3.2", "А-12/3" целиком
+_TOKEN_RE = re.compile(r"[0-9a-zа-я]+(?:[./\-][0-9a-zа-я]+)*")
+_PARTS_RE = re.compile(r"[./\-]")
+
+# Окончания для лёгкого стемминга (самые длинные первыми)
+_RU_ENDINGS = sorted(
+    """
+    ами ями ого его ому ему ыми ими ией ый ий ой ая яя ое ее ые ие ых их ую юю ом ем ам ям ах ях ов ев
+    ей ой ию ья ье ьи ью ия а я о е ы и у ю ь
+    """.split(),
+    key=len,
+    reverse=True,
+)
+_RU_STEM_MIN_LEN = 4
+
+
+def _stem(word: str) -> str:
+    if len(word) <= _RU_STEM_MIN_LEN or not ("а" <= word[-1] <= "я"):
+        return word
+    for ending in _RU_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= _RU_STEM_MIN_LEN - 1:
+            return word[: -len(ending)]
+    return word
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Токенизация с учётом русского: нижний регистр, ё→е, лёгкий стемминг окончаний.
+    Составные идентификаторы ("17.13330.2017") дают и целый токен, и его части,
+    чтобы запрос "СП 17.13330" находил "СП 17.13330.2017".
+    """
+    tokens: list[str] = []
+    for tok in _TOKEN_RE.findall(text.lower().replace("ё", "е")):
+        parts = _PARTS_RE.split(tok)
+        if len(parts) > 1:
+            tokens.append(tok)
+            tokens.extend(_stem(p) for p in parts if p)
+        else:
+            tokens.append(_stem(tok))
+    return tokens
+
+
+class BM25Index:
+    """
+    Инвертированный индекс BM25 проекта в SQLite (postings term → chunk, tf).
+
+    В память ничего не грузится: при поиске читаются только posting-листы терминов запроса,
+    поэтому индекс не удваивает потребление RAM рядом с FAISS.
+    """
+
+    def __init__(self, path: str, k1: float = 1.5, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS docs ("
+                " id INTEGER PRIMARY KEY,"
+                " chunk_id TEXT UNIQUE NOT NULL,"
+                " length INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS postings ("
+                " term TEXT NOT NULL,"
+                " doc INTEGER NOT NULL,"
+                " tf INTEGER NOT NULL,"
+                " PRIMARY KEY (term, doc)) WITHOUT ROWID"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS postings_doc ON postings(doc)")
+            self._conn = conn
+        return self._conn
+
+    @classmethod
+    def copy(cls, src_path: str, path: str, k1: float = 1.5, b: float = 0.75) -> "BM25Index":
+        """Копия индекса в новый файл (sqlite backup — согласованный снимок даже при открытых читателях)."""
+        src = sqlite3.connect(src_path)
+        dst = sqlite3.connect(path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+        return cls(path, k1, b)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def add_many(self, items: list[tuple[str, str]]) -> None:
+        """items: [(chunk_id, text)]."""
+        with self._lock:
+            db = self._db()
+            for chunk_id, text in items:
+                counts = Counter(tokenize(text))
+                db.execute("DELETE FROM postings WHERE doc IN (SELECT id FROM docs WHERE chunk_id = ?)", (chunk_id,))
+                cur = db.execute(
+                    "INSERT OR REPLACE INTO docs (chunk_id, length) VALUES (?, ?)",
+                    (chunk_id, sum(counts.values())),
+                )
+                doc = cur.lastrowid
+                db.executemany(
+                    "INSERT OR REPLACE INTO postings (term, doc, tf) VALUES (?, ?, ?)",
+                    [(term, doc, tf) for term, tf in counts.items()],
+                )
+            db.commit()
+
+    def delete(self, chunk_ids: list[str]) -> None:
+        with self._lock:
+            db = self._db()
+            for i in range(0, len(chunk_ids), 500):
+                part = chunk_ids[i:i + 500]
+                marks = ",".join("?" * len(part))
+                db.execute(
+                    f"DELETE FROM postings WHERE doc IN (SELECT id FROM docs WHERE chunk_id IN ({marks}))", part
+                )
+                db.execute(f"DELETE FROM docs WHERE chunk_id IN ({marks})", part)
+            db.commit()
+
+    def search(self, query: str, k: int = 10) -> list[tuple[str, float]]:
+        """Top-k чанков по BM25: [(chunk_id, score)]."""
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        with self._lock:
+            db = self._db()
+            n_docs, total_len = db.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs").fetchone()
+            if not n_docs:
+                return []
+            avgdl = total_len / n_docs
+
+            scores: dict[int, float] = {}
+            for term in terms:
+                rows = db.execute(
+                    "SELECT p.doc, p.tf, d.length FROM postings p JOIN docs d ON d.id = p.doc WHERE p.term = ?",
+                    (term,),
+                ).fetchall()
+                if not rows:
+                    continue
+                df = len(rows)
+                idf = math.log((n_docs - df + 0.5) / (df + 0.5) + 1.0)
+                for doc, tf, length in rows:
+                    norm = tf + self.k1 * (1 - self.b + self.b * length / avgdl)
+                    scores[doc] = scores.get(doc, 0.0) + idf * tf * (self.k1 + 1) / norm
+
+            if not scores:
+                return []
+
+            top = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:k]
+            marks = ",".join("?" * len(top))
+            names = dict(db.execute(f"SELECT id, chunk_id FROM docs WHERE id IN ({marks})", [d for d, _ in top]))
+        return [(names[d], score) for d, score in top if d in names]
@@ -0,0 +1,200 @@
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+import httpx
+from telegram.error import BadRequest, ChatMigrated, Forbidden, NetworkError, RetryAfter
+
+from message_stream import _seconds
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram Bot API: ~30 сообщений/с на бота, ~20 сообщений/мин в одну группу
+GLOBAL_RATE_PER_SECOND = 25.0
+GLOBAL_BURST = 25
+CHAT_RATE_PER_SECOND = 20 / 60
+CHAT_BURST = 20
+
+# Сетевые ошибки, при которых запрос точно не дошёл до Telegram: повтор не создаст дубликат.
+# Остальные (TimedOut на чтении, обрыв ответа) — копия могла уже уйти, такие не повторяем.
+_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас. Ожидающие — по очереди."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1) -> None:
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            pause = self._blocked_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            self._refill()
+            while self._tokens < tokens:
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= tokens
+
+    def block(self, seconds: float) -> None:
+        """После RetryAfter: следующий acquire пройдёт не раньше чем через seconds."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+@dataclass
+class BroadcastResult:
+    total: int
+    sent: list[int] = field(default_factory=list)
+    failed: dict[int, str] = field(default_factory=dict)
+    # chat_id группы → новый chat_id супергруппы (ChatMigrated)
+    migrated: dict[int, int] = field(default_factory=dict)
+    retries: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def done(self) -> int:
+        return len(self.sent) + len(self.failed)
+
+
+def _request_not_sent(error: NetworkError) -> bool:
+    return isinstance(error.__cause__, _NOT_SENT_ERRORS)
+
+
+class BroadcastEngine:
+    """
+    Рассылка сообщения по чатам: copy_message / copy_messages (альбом) — любой тип
+    сообщения с подписью и форматированием, без пометки «переслано».
+
+    - одновременно не больше concurrency отправок;
+    - общее ведро токенов на бота и ведро на каждый чат (лимиты Telegram),
+      ведра живут между рассылками;
+    - RetryAfter: пауза ровно на retry_after для чата и для всего бота, затем повтор;
+    - сетевые сбои до отправки запроса (нет соединения) — повтор с экспоненциальной
+      задержкой; таймаут ответа — ошибка чата без повтора (копия могла уже дойти);
+    - Forbidden/BadRequest — сразу ошибка чата;
+    - ChatMigrated (группа стала супергруппой): повтор на новый chat_id.
+    """
+
+    def __init__(self, concurrency: int = 8, max_retries: int = 5, progress_interval: float = 2.0):
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.progress_interval = progress_interval
+        self._global = TokenBucket(GLOBAL_RATE_PER_SECOND, GLOBAL_BURST)
+        self._chats: dict[int, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(CHAT_RATE_PER_SECOND, CHAT_BURST)
+        return bucket
+
+    async def _copy(self, bot, chat_id: int, from_chat_id: int, message_ids: list[int]) -> None:
+        if len(message_ids) == 1:
+            await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_ids[0])
+        else:
+            await bot.copy_messages(chat_id=chat_id, from_chat_id=from_chat_id, message_ids=message_ids)
+
+    async def _send_one(self, bot, chat_id: int, from_chat_id: int, message_ids: list[int], result: BroadcastResult):
+        target = chat_id
+        attempt = 0
+        while True:
+            await self._chat_bucket(target).acquire(len(message_ids))
+            await self._global.acquire(len(message_ids))
+            try:
+                await self._copy(bot, target, from_chat_id, message_ids)
+                result.sent.append(chat_id)
+                return
+            except RetryAfter as e:
+                delay = _seconds(e.retry_after)
+                logger.warning("Рассылка: flood control в %s, пауза %.0f с", target, delay)
+                # Следующая попытка подождёт в acquire; другие отправки в этот чат — тоже.
+                # Flood control Telegram действует и на бота целиком: остальные воркеры тоже ждут
+                self._chat_bucket(target).block(delay)
+                self._global.block(delay)
+                error = e
+            except ChatMigrated as e:
+                logger.warning("Рассылка: чат %s стал супергруппой %s", target, e.new_chat_id)
+                result.migrated[chat_id] = e.new_chat_id
+                target = e.new_chat_id
+                error = e
+            except (Forbidden, BadRequest) as e:
+                logger.error(f"Не удалось отправить в {target}: {e}")
+                result.failed[chat_id] = str(e)
+                return
+            except NetworkError as e:
+                if not _request_not_sent(e):
+                    logger.error(f"Рассылка: доставка в {target} не подтверждена ({e}), без повтора")
+                    result.failed[chat_id] = f"доставка не подтверждена: {e}"
+                    return
+                delay = min(2 ** attempt, 30)
+                logger.warning("Рассылка: сбой сети для %s (%s), повтор через %d с", target, e, delay)
+                await asyncio.sleep(delay)
+                error = e
+            except Exception as e:
+                logger.error(f"Не удалось отправить в {target}: {e}")
+                result.failed[chat_id] = str(e)
+                return
+
+            attempt += 1
+            result.retries += 1
+            if attempt > self.max_retries:
+                logger.error(f"Не удалось отправить в {target} после {attempt} попыток: {error}")
+                result.failed[chat_id] = str(error)
+                return
+
+    async def run(
+        self,
+        bot,
+        from_chat_id: int,
+        message_ids: list[int],
+        targets: list[int],
+        on_progress: Callable[[BroadcastResult], Awaitable[None]] | None = None,
+    ) -> BroadcastResult:
+        """Копирует message_ids (альбом — одним вызовом) из from_chat_id во все targets."""
+        message_ids = sorted(message_ids)
+        result = BroadcastResult(total=len(targets))
+        started = time.monotonic()
+        sem = asyncio.Semaphore(self.concurrency)
+        last_progress = 0.0
+
+        async def report(final: bool = False):
+            nonlocal last_progress
+            if on_progress is None:
+                return
+            now = time.monotonic()
+            if not final and now - last_progress < self.progress_interval:
+                return
+            last_progress = now
+            try:
+                await on_progress(result)
+            except Exception as e:
+                logger.warning("Рассылка: не удалось обновить прогресс: %s", e)
+
+        async def worker(chat_id: int):
+            async with sem:
+                await self._send_one(bot, chat_id, from_chat_id, message_ids, result)
+            result.elapsed = time.monotonic() - started
+            await report()
+
+        await asyncio.gather(*(worker(chat_id) for chat_id in targets))
+        result.elapsed = time.monotonic() - started
+        await report(final=True)
+        logger.info(
+            "Рассылка: %d/%d доставлено за %.1f с, ошибок %d, повторов %d",
+            len(result.sent), result.total, result.elapsed, len(result.failed), result.retries,
+        )
+        return result
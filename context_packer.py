@@ -0,0 +1,151 @@
+"""
+Сборка RAG-контекста под бюджет токенов.
+
+Найденные чанки одной страницы склеиваются (перекрытие сплиттера вырезается),
+повторы текста убираются, пробелы вёрстки (extract_text(layout=True)) сжимаются,
+и блоки в порядке релевантности укладываются в max_tokens. Заголовок блока
+"——— [источник] стр. N ———" сохраняется — по нему модель ссылается на документ.
+"""
+import re
+import logging
+import threading
+
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+# Если словарь tiktoken недоступен (нет сети при первом запуске) — оценка по символам, с запасом
+_APPROX_CHARS_PER_TOKEN = 3
+# Перекрытие соседних чанков ищем в этих пределах (chunk_overlap сплиттера — 150 символов)
+_MIN_OVERLAP_CHARS = 20
+_MAX_OVERLAP_CHARS = 500
+# Остаток бюджета, ради которого стоит обрезать последний блок, а не выбросить его
+_MIN_TAIL_TOKENS = 80
+
+_SPACES_RE = re.compile(r"[ \t\u00a0]{2,}")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
+class TokenCounter:
+    """Подсчёт токенов tiktoken для модели ответа; словарь загружается лениво, один раз."""
+
+    def __init__(self, model: str):
+        self.model = model
+        self._encoding = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _get_encoding(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    try:
+                        import tiktoken
+
+                        self._encoding = tiktoken.encoding_for_model(self.model)
+                    except Exception as e:
+                        logger.warning("tiktoken недоступен для %s (%s), токены оцениваются по длине", self.model, e)
+                    self._loaded = True
+        return self._encoding
+
+    def count(self, text: str) -> int:
+        encoding = self._get_encoding()
+        if encoding is None:
+            return -(-len(text) // _APPROX_CHARS_PER_TOKEN)
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        encoding = self._get_encoding()
+        if encoding is None:
+            return text[: max_tokens * _APPROX_CHARS_PER_TOKEN]
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+
+def compact_whitespace(text: str) -> str:
+    """Сжимает выравнивание вёрстки: отступы убираются, разрыв колонок — два пробела."""
+    lines = [_SPACES_RE.sub("  ", line).strip() for line in text.split("\n")]
+    return _BLANK_LINES_RE.sub("\n\n", "\n".join(lines)).strip()
+
+
+def _chunk_number(doc: Document) -> int | None:
+    cid = doc.metadata.get("chunk_id") or ""
+    tail = cid.rsplit(":", 1)[-1]
+    return int(tail) if tail.isdigit() else None
+
+
+def _overlap(left: str, right: str) -> int:
+    """Длина самого длинного суффикса left, совпадающего с префиксом right."""
+    for size in range(min(len(left), len(right), _MAX_OVERLAP_CHARS), _MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def _merge_page(docs: list[Document]) -> str:
+    """Чанки одной страницы в порядке следования на странице → один текст без повторов."""
+    ordered = sorted(docs, key=lambda d: (_chunk_number(d) is None, _chunk_number(d) or 0))
+    merged = ""
+    prev_number = None
+    for doc in ordered:
+        text = compact_whitespace(doc.page_content)
+        number = _chunk_number(doc)
+        if not merged:
+            merged = text
+        elif text in merged:
+            pass
+        else:
+            size = _overlap(merged, text)
+            if size:
+                merged += text[size:]
+            elif prev_number is not None and number == prev_number + 1:
+                merged += "\n" + text
+            else:
+                merged += "\n…\n" + text
+        prev_number = number
+    return merged
+
+
+def pack_context(docs: list[Document], max_tokens: int, counter: TokenCounter) -> tuple[str, int]:
+    """
+    docs — в порядке релевантности. Возвращает (контекст, число токенов).
+    Одинаковый текст из разных документов (копии PDF) даёт один блок со всеми ссылками.
+    """
+    pages: dict[tuple[str, object], list[Document]] = {}
+    for doc in docs:
+        key = (doc.metadata.get("source", "unknown"), doc.metadata.get("page", "?"))
+        pages.setdefault(key, []).append(doc)
+
+    # [текст, ссылки "[источник] стр. N"] в порядке релевантности; текст, уже вошедший
+    # в другой блок, добавляет к нему только ссылку
+    blocks: list[tuple[str, list[str]]] = []
+    for (source, page), page_docs in pages.items():
+        text = _merge_page(page_docs)
+        if not text:
+            continue
+        citation = f"[{source}] стр. {page}"
+        same = next((b for b in blocks if text in b[0]), None)
+        if same is not None:
+            same[1].append(citation)
+        else:
+            blocks.append((text, [citation]))
+
+    parts: list[str] = []
+    used = 0
+    for text, citations in blocks:
+        header = f"——— {' | '.join(citations)} ———\n"
+        part = header + text
+        tokens = counter.count(part) + (2 if parts else 0)
+        if used + tokens <= max_tokens:
+            parts.append(part)
+            used += tokens
+            continue
+        # Не влезает целиком: обрезаем, если осталось место на осмысленный кусок, и заканчиваем
+        remaining = max_tokens - used - counter.count(header) - 4
+        if remaining >= _MIN_TAIL_TOKENS:
+            part = header + counter.truncate(text, remaining).rstrip() + " …"
+            parts.append(part)
+            used += counter.count(part) + 2
+        break
+
+    return "\n\n".join(parts), used
@@ -0,0 +1,180 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from array import array
+
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+# Сколько отложенных обновлений last_used копить до записи в SQLite
+TOUCH_FLUSH_THRESHOLD = 1000
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Обёртка над любыми Embeddings с постоянным кэшем в SQLite — для эмбеддингов вопросов
+    (поиск, семантический кэш ответов): повторный вопрос не отправляется в API.
+
+    Ключ — sha256(модель + текст), значение — вектор float32.
+    Чанки документов сюда не попадают: их дедуплицирует общее хранилище
+    (vector_index.ChunkStore), а сборка индекса вызывает провайдер напрямую.
+    Размер ограничен max_entries: при переполнении удаляются давно не использованные записи.
+    last_used попаданий копится в памяти и пишется пачкой (при вставке, вытеснении или flush()),
+    чтобы поиск не делал запись в SQLite на каждый запрос.
+    Провайдеры с persistent_cache = False (локальные, дешевле SQLite) вызываются напрямую.
+    """
+
+    def __init__(self, underlying: Embeddings, model: str, db_path: str, max_entries: int = 50_000):
+        self.underlying = underlying
+        self.model = model
+        self.persistent = getattr(underlying, "persistent_cache", True)
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self._touched: dict[str, float] = {}
+        self.hits = 0
+        self.misses = 0
+
+    # -------------------- STORAGE --------------------
+    def set_path(self, db_path: str) -> None:
+        """Переключает кэш на другой файл (вызывается из rag_engine.configure)."""
+        with self._lock:
+            if self._conn is not None:
+                self._flush_touched(self._conn)
+                self._conn.close()
+                self._conn = None
+            self._touched.clear()
+            self.db_path = db_path
+
+    def set_underlying(self, underlying: Embeddings, model: str) -> None:
+        """Меняет провайдер (записи другой модели остаются в кэше под своими ключами)."""
+        with self._lock:
+            self.underlying = underlying
+            self.model = model
+            self.persistent = getattr(underlying, "persistent_cache", True)
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " key TEXT PRIMARY KEY,"
+                " vector BLOB NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+            self._conn = conn
+        return self._conn
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\x00{text}".encode("utf-8")).hexdigest()
+
+    def _get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        found: dict[str, list[float]] = {}
+        with self._lock:
+            db = self._db()
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                marks = ",".join("?" * len(part))
+                for key, blob in db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({marks})", part):
+                    found[key] = array("f", blob).tolist()
+            if found:
+                now = time.time()
+                self._touched.update((k, now) for k in found)
+                if len(self._touched) >= TOUCH_FLUSH_THRESHOLD:
+                    self._flush_touched(db)
+        return found
+
+    def _flush_touched(self, db: sqlite3.Connection) -> None:
+        """Пишет накопленные last_used одной транзакцией (вызывать под self._lock)."""
+        if not self._touched:
+            return
+        touched, self._touched = self._touched, {}
+        db.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(t, k) for k, t in touched.items()])
+        db.commit()
+
+    def flush(self) -> None:
+        """Сбрасывает отложенные обновления last_used на диск."""
+        with self._lock:
+            if self._conn is not None:
+                self._flush_touched(self._conn)
+
+    def _put_many(self, items: dict[str, list[float]]) -> None:
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(k, array("f", v).tobytes(), now) for k, v in items.items()],
+            )
+            db.commit()
+            self._evict(db)
+
+    def _evict(self, db: sqlite3.Connection) -> None:
+        self._flush_touched(db)
+        (count,) = db.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if count <= self.max_entries:
+            return
+        # Удаляем с запасом (10%), чтобы не чистить на каждой вставке
+        excess = count - int(self.max_entries * 0.9)
+        db.execute(
+            "DELETE FROM embeddings WHERE key IN ("
+            " SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+            (excess,),
+        )
+        db.commit()
+        logger.info("Кэш эмбеддингов: удалено %d старых записей", excess)
+
+    def clear(self) -> None:
+        with self._lock:
+            db = self._db()
+            db.execute("DELETE FROM embeddings")
+            db.commit()
+            self._touched.clear()
+
+    def _count(self, hits: int, misses: int) -> None:
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    # -------------------- Embeddings API --------------------
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not self.persistent:
+            self._count(0, len(texts))
+            return self.underlying.embed_documents(texts)
+
+        keys = [self._key(t) for t in texts]
+        try:
+            cached = self._get_many(list(set(keys)))
+        except sqlite3.Error as e:
+            logger.error("Кэш эмбеддингов недоступен: %s", e)
+            return self.underlying.embed_documents(texts)
+
+        missing: dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        self._count(len(texts) - len(missing), len(missing))
+
+        if missing:
+            vectors = self.underlying.embed_documents(list(missing.values()))
+            fresh = dict(zip(missing.keys(), vectors))
+            try:
+                self._put_many(fresh)
+            except sqlite3.Error as e:
+                logger.error("Не удалось записать кэш эмбеддингов: %s", e)
+            cached.update(fresh)
+
+        return [cached[k] for k in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
@@ -0,0 +1,101 @@
+"""
+Провайдеры эмбеддингов для RAG, выбираются настройкой RAG_EMBEDDING_PROVIDER.
+
+  openai — OpenAI API (RAG_OPENAI_EMBEDDING_MODEL, по умолчанию text-embedding-3-small)
+  local  — детерминированные хэшированные символьные n-граммы на NumPy: без сети и расходов,
+           для тестов, бенчмарков и работы без доступа к OpenAI (качество поиска ниже)
+
+Каждый провайдер отдаёт (Embeddings, model_id). model_id входит в ключи кэша эмбеддингов,
+путь общего хранилища чанков и параметры манифеста, поэтому смена провайдера
+не смешивает векторы разных моделей — индексы просто пересобираются.
+"""
+import os
+import logging
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROVIDER = "openai"
+OPENAI_EMBEDDING_MODEL = os.getenv("RAG_OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+LOCAL_EMBEDDING_DIM = int(os.getenv("RAG_LOCAL_EMBEDDING_DIM", "512"))
+
+# FNV-1a (64 бит) по кодам символов — одинаковый результат на любой машине и в любом процессе
+_FNV_OFFSET = np.uint64(14695981039346656037)
+_FNV_PRIME = np.uint64(1099511628211)
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Локальные эмбеддинги: символьные n-граммы текста (по умолчанию 3–5) хэшируются
+    в dim корзин со знаком (feature hashing), вектор нормируется.
+
+    Устойчивы к окончаниям русских слов и опечаткам, ловят совпадения идентификаторов
+    ("17.13330"), но не синонимы. Хэши n-грамм считаются векторно по всему тексту.
+    """
+
+    # Вектор считается быстрее, чем читается из SQLite-кэша эмбеддингов
+    persistent_cache = False
+
+    def __init__(self, dim: int = LOCAL_EMBEDDING_DIM, ngram_range: tuple[int, int] = (3, 5)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+
+    @property
+    def model_id(self) -> str:
+        lo, hi = self.ngram_range
+        return f"local-hashing-ngram{lo}{hi}-{self.dim}"
+
+    def _vector(self, text: str) -> np.ndarray:
+        # Границы слов — пробелы, поэтому n-граммы начала/конца слова отличаются от середины
+        normalized = " " + " ".join(text.lower().replace("ё", "е").split()) + " "
+        codes = np.frombuffer(normalized.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        vec = np.zeros(self.dim, dtype=np.float64)
+        lo, hi = self.ngram_range
+        for n in range(lo, hi + 1):
+            count = len(codes) - n + 1
+            if count <= 0:
+                break
+            h = np.full(count, _FNV_OFFSET, dtype=np.uint64)
+            for j in range(n):
+                h = (h ^ codes[j:j + count]) * _FNV_PRIME
+            buckets = (h >> np.uint64(32)) % np.uint64(self.dim)
+            signs = np.where(h & np.uint64(1), 1.0, -1.0)
+            vec += np.bincount(buckets.astype(np.int64), weights=signs, minlength=self.dim)
+        norm = np.linalg.norm(vec)
+        return (vec / norm if norm else vec).astype(np.float32)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._vector(t).tolist() for t in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._vector(text).tolist()
+
+
+def _openai(model: str = OPENAI_EMBEDDING_MODEL) -> tuple[Embeddings, str]:
+    # Импорт здесь: локальному провайдеру не нужны ни langchain_openai, ни OPENAI_API_KEY
+    from langchain_openai import OpenAIEmbeddings
+
+    return OpenAIEmbeddings(model=model), model
+
+
+def _local(dim: int = LOCAL_EMBEDDING_DIM, ngram_range: tuple[int, int] = (3, 5)) -> tuple[Embeddings, str]:
+    embeddings = HashingEmbeddings(dim=dim, ngram_range=ngram_range)
+    return embeddings, embeddings.model_id
+
+
+PROVIDERS = {
+    "openai": _openai,
+    "local": _local,
+}
+
+
+def create_embeddings(provider: str = DEFAULT_PROVIDER, **options) -> tuple[Embeddings, str]:
+    """(Embeddings, model_id) для провайдера; options — параметры конкретного провайдера."""
+    factory = PROVIDERS.get(provider.strip().lower())
+    if factory is None:
+        raise ValueError(f"Неизвестный провайдер эмбеддингов: {provider} (доступны: {', '.join(PROVIDERS)})")
+    embeddings, model_id = factory(**options)
+    logger.info("Эмбеддинги: %s (%s)", provider, model_id)
+    return embeddings, model_id
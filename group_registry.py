@@ -0,0 +1,240 @@
+"""
+Реестр объектов (групп Telegram) из DATA_DIR/groups.json.
+
+Формат — тот же, что был у GROUPS_CONFIG в коде:
+
+    {
+      "Мосрентген 28": {"chat_id": -5207136504, "systems": ["Ремонт крыши"]},
+      "Рекламация 2025": {"chat_id": -5044901573, "systems": ["Фото исправлений"],
+                          "progress": false, "broadcast": false}
+    }
+
+Необязательные поля: "titles" — другие названия чата, по которым он находится,
+"progress" — участвует в опросе прогресса, "broadcast" — входит в «✅ Все» рассылки.
+
+При загрузке строятся индексы (chat_id, название объекта и чата); файл проверяется
+целиком, и при ошибке остаётся прежний реестр. Изменения файла подхватываются
+без перезапуска (reload_if_changed).
+"""
+import os
+import json
+import logging
+import threading
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+_KNOWN_KEYS = {"chat_id", "systems", "titles", "progress", "broadcast"}
+
+
+class RegistryError(ValueError):
+    """Файл реестра не прошёл проверку; errors — все найденные ошибки."""
+
+    def __init__(self, errors: list[str]):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+@dataclass(frozen=True)
+class Group:
+    name: str
+    chat_id: int
+    systems: tuple[str, ...]
+    titles: tuple[str, ...] = ()
+    progress: bool = True
+    broadcast: bool = True
+
+
+class _Snapshot:
+    """Неизменяемый набор групп с индексами: читатели всегда видят согласованное состояние."""
+
+    def __init__(self, groups: list[Group]):
+        self.groups = tuple(sorted(groups, key=lambda g: g.name))
+        self.by_name = {g.name: g for g in self.groups}
+        self.by_chat = {g.chat_id: g for g in self.groups}
+        self.by_title: dict[str, Group] = {}
+        for g in self.groups:
+            for title in (g.name, *g.titles):
+                self.by_title.setdefault(title, g)
+        self.system_count = len({_system_key(s) for g in self.groups for s in g.systems})
+
+
+def _system_key(system: str) -> str:
+    return " ".join(system.lower().replace("ё", "е").split())
+
+
+def parse_groups(data) -> list[Group]:
+    """Проверка и разбор содержимого groups.json; все ошибки собираются в RegistryError."""
+    if not isinstance(data, dict):
+        raise RegistryError(["корень файла должен быть объектом {название: {...}}"])
+
+    errors: list[str] = []
+    groups: list[Group] = []
+    chats: dict[int, str] = {}
+    titles: dict[str, str] = {}
+    for name, cfg in data.items():
+        where = f"«{name}»"
+        if not isinstance(name, str) or not name.strip():
+            errors.append("пустое название объекта")
+            continue
+        if not isinstance(cfg, dict):
+            errors.append(f"{where}: ожидается объект с chat_id и systems")
+            continue
+        unknown = set(cfg) - _KNOWN_KEYS
+        if unknown:
+            logger.warning("Реестр объектов: %s — неизвестные поля %s", where, ", ".join(sorted(unknown)))
+
+        chat_id = cfg.get("chat_id")
+        if isinstance(chat_id, bool) or not isinstance(chat_id, int) or chat_id == 0:
+            errors.append(f"{where}: chat_id должен быть ненулевым целым числом")
+            continue
+        if chat_id in chats:
+            errors.append(f"{where}: chat_id {chat_id} уже занят объектом «{chats[chat_id]}»")
+            continue
+
+        systems = cfg.get("systems")
+        if not isinstance(systems, list) or not all(isinstance(s, str) and s.strip() for s in systems):
+            errors.append(f"{where}: systems должен быть списком непустых строк")
+            continue
+        if len({_system_key(s) for s in systems}) != len(systems):
+            errors.append(f"{where}: системы повторяются")
+            continue
+
+        extra_titles = cfg.get("titles", [])
+        if not isinstance(extra_titles, list) or not all(isinstance(t, str) and t.strip() for t in extra_titles):
+            errors.append(f"{where}: titles должен быть списком непустых строк")
+            continue
+        clash = next((t for t in (name, *extra_titles) if titles.get(t, name) != name), None)
+        if clash is not None:
+            errors.append(f"{where}: название «{clash}» уже используется объектом «{titles[clash]}»")
+            continue
+
+        flags = {k: cfg.get(k, True) for k in ("progress", "broadcast")}
+        bad_flag = next((k for k, v in flags.items() if not isinstance(v, bool)), None)
+        if bad_flag:
+            errors.append(f"{where}: {bad_flag} должен быть true или false")
+            continue
+
+        chats[chat_id] = name
+        for t in (name, *extra_titles):
+            titles[t] = name
+        groups.append(
+            Group(
+                name=name,
+                chat_id=chat_id,
+                systems=tuple(s.strip() for s in systems),
+                titles=tuple(extra_titles),
+                **flags,
+            )
+        )
+
+    if errors:
+        raise RegistryError(errors)
+    return groups
+
+
+class GroupRegistry:
+    """
+    Реестр объектов с индексами по chat_id и названию чата.
+    Если файла нет, он создаётся из default (прежний GROUPS_CONFIG).
+    """
+
+    def __init__(self, path: str, default: dict | None = None):
+        self.path = path
+        self.default = default or {}
+        self._snapshot = _Snapshot([])
+        self._stamp: tuple[int, int] | None = None
+        self._lock = threading.Lock()
+
+    def _file_stamp(self) -> tuple[int, int] | None:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _write_default(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.default, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+        logger.info("Реестр объектов создан из встроенного списка: %s", self.path)
+
+    def load(self) -> None:
+        """
+        Первая загрузка: при ошибке в файле работаем по встроенному списку (и пишем ошибку в лог).
+        Встроенный список тоже проверяется: с ошибкой он не пишется в файл и не используется.
+        """
+        try:
+            default_groups = parse_groups(self.default)
+        except RegistryError as e:
+            logger.error("Встроенный список объектов некорректен и не используется: %s", e)
+            default_groups = []
+        if not os.path.exists(self.path) and default_groups:
+            self._write_default()
+        try:
+            self.reload()
+        except (OSError, ValueError) as e:
+            logger.error("Реестр объектов %s не загружен (%s), используется встроенный список", self.path, e)
+            self._snapshot = _Snapshot(default_groups)
+            # Повторная попытка — когда файл исправят
+            self._stamp = self._file_stamp()
+
+    def reload(self) -> int:
+        """Перечитывает файл; при ошибке бросает RegistryError/OSError, текущий реестр не меняется."""
+        with self._lock:
+            stamp = self._file_stamp()
+            with open(self.path, "r", encoding="utf-8") as f:
+                try:
+                    data = json.load(f)
+                except json.JSONDecodeError as e:
+                    raise RegistryError([f"некорректный JSON: {e}"]) from e
+            snapshot = _Snapshot(parse_groups(data))
+            self._snapshot = snapshot
+            self._stamp = stamp
+        logger.info("Реестр объектов загружен: %d объектов", len(snapshot.groups))
+        return len(snapshot.groups)
+
+    def reload_if_changed(self) -> bool:
+        """Для периодической проверки: перечитывает файл, если изменились mtime/размер."""
+        stamp = self._file_stamp()
+        if stamp is None or stamp == self._stamp:
+            return False
+        try:
+            self.reload()
+            return True
+        except (OSError, ValueError) as e:
+            logger.error("Реестр объектов не обновлён, остаётся прежний: %s", e)
+            # Не повторяем ту же ошибку каждые N секунд — ждём следующего изменения файла
+            self._stamp = stamp
+            return False
+
+    # ---- поиск ----
+    def groups(self) -> tuple[Group, ...]:
+        return self._snapshot.groups
+
+    def names(self) -> list[str]:
+        return [g.name for g in self._snapshot.groups]
+
+    def get(self, name: str) -> Group | None:
+        return self._snapshot.by_name.get(name)
+
+    def by_chat(self, chat_id: int) -> Group | None:
+        return self._snapshot.by_chat.get(chat_id)
+
+    def resolve(self, chat_id: int, title: str | None = None) -> Group | None:
+        """Объект чата: сначала по chat_id, затем по названию чата."""
+        snapshot = self._snapshot
+        return snapshot.by_chat.get(chat_id) or (snapshot.by_title.get(title) if title else None)
+
+    def stats(self) -> dict:
+        snapshot = self._snapshot
+        return {
+            "groups": len(snapshot.groups),
+            "systems": snapshot.system_count,
+            "titles": len(snapshot.by_title),
+        }
+
+    def __len__(self) -> int:
+        return len(self._snapshot.groups)
@@ -0,0 +1,111 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class IndexCache:
+    """
+    LRU-кэш загруженных индексов проектов с бюджетом по памяти.
+
+    Размер записи считает size_fn (память, которой владеет индекс), при превышении max_bytes вытесняются
+    давно не использованные проекты. Закреплённые (pin) проекты не вытесняются.
+    Счётчики hits/misses/evictions — для подбора бюджета под инстанс.
+    """
+
+    def __init__(self, max_bytes: int, size_fn: Callable[[Any], int]):
+        self.max_bytes = max_bytes
+        self.size_fn = size_fn
+        self._items: OrderedDict[str, tuple[Any, int]] = OrderedDict()
+        self._pinned: set[str] = set()
+        self._lock = threading.RLock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str, default=None):
+        """Индекс из кэша (обновляет LRU-порядок и счётчики) или default."""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def peek(self, key: str, default=None):
+        """Как get, но без влияния на LRU и счётчики."""
+        with self._lock:
+            item = self._items.get(key)
+            return default if item is None else item[0]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._items
+
+    def __getitem__(self, key: str):
+        value = self.get(key, None)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value) -> None:
+        size = self.size_fn(value)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self._items[key] = (value, size)
+            self.total_bytes += size
+            self._evict(keep=key)
+
+    def pop(self, key: str, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return default
+            self.total_bytes -= item[1]
+            return item[0]
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def keys(self) -> list[str]:
+        """Проекты от давно использованных к недавним."""
+        with self._lock:
+            return list(self._items.keys())
+
+    def pin(self, key: str) -> None:
+        with self._lock:
+            self._pinned.add(key)
+
+    def unpin(self, key: str) -> None:
+        with self._lock:
+            self._pinned.discard(key)
+            self._evict(keep=None)
+
+    def _evict(self, keep: str | None) -> None:
+        for key in list(self._items.keys()):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key == keep or key in self._pinned:
+                continue
+            _, size = self._items.pop(key)
+            self.total_bytes -= size
+            self.evictions += 1
+            logger.info("Индекс выгружен из памяти (LRU): %s (%.1f МБ)", key, size / 1024 / 1024)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "projects": len(self._items),
+                "pinned": sorted(self._pinned),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,189 @@
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: меньше — раньше
+PRIORITY_INTERACTIVE = 0  # загрузка PDF в чат объекта
+PRIORITY_BULK = 10  # /reload_docs по всем объектам
+
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "загрузка", PRIORITY_BULK: "reload_docs"}
+
+
+class BuildJob:
+    """Запрос на сборку индекса проекта. Повторные запросы сливаются в один и тот же BuildJob."""
+
+    def __init__(self, project: str, priority: int):
+        self.project = project
+        self.priority = priority
+        self.full_rebuild = False
+        # Кого уведомить о результате (например, chat_id) — без повторов
+        self.subscribers: set[Hashable] = set()
+        self.requests = 0
+        self.created_at = time.monotonic()
+        self.ready_at = self.created_at
+        self.started_at: float | None = None
+        # waiting — ждёт debounce, queued — в очереди, held — ждёт окончания текущей сборки проекта
+        self.state = "waiting"
+        self.seq = 0
+        self.timer: asyncio.TimerHandle | None = None
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class IndexBuildScheduler:
+    """
+    Планировщик сборок индексов: ограниченный пул воркеров, приоритеты и слияние запросов.
+
+    - на проект не больше одной сборки одновременно и одной ожидающей;
+      запрос во время сборки ставит ровно одну повторную сборку после неё (ничего не теряется);
+    - debounce: пока приходят новые загрузки, ожидающая сборка откладывается;
+    - интерактивные загрузки обгоняют массовый /reload_docs в очереди.
+
+    build_fn(project, full_rebuild=...) — блокирующая сборка, выполняется в потоке.
+    listener(event, job, ok) — уведомления: "started" (ok=None) и "finished".
+    """
+
+    def __init__(
+        self,
+        build_fn: Callable[..., object],
+        workers: int = 2,
+        listener: Callable[[str, BuildJob, bool | None], Awaitable[None]] | None = None,
+    ):
+        self.build_fn = build_fn
+        self.workers = max(1, workers)
+        self.listener = listener
+        self._pending: dict[str, BuildJob] = {}
+        self._running: dict[str, BuildJob] = {}
+        self._queue: asyncio.PriorityQueue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._seq = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _ensure_started(self) -> None:
+        if self._tasks:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info("Планировщик индексации запущен: воркеров %d", self.workers)
+
+    async def stop(self) -> None:
+        """Останавливает воркеры. Уже идущая сборка в потоке доработает сама."""
+        for job in self._pending.values():
+            if job.timer:
+                job.timer.cancel()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(
+        self,
+        project: str,
+        priority: int = PRIORITY_INTERACTIVE,
+        full_rebuild: bool = False,
+        delay: float = 0.0,
+        subscriber: Hashable | None = None,
+    ) -> asyncio.Future:
+        """
+        Ставит сборку проекта. Если сборка уже ждёт — запрос сливается с ней
+        (приоритет повышается, full_rebuild накапливается, debounce продлевается).
+        Возвращает future с результатом сборки, которая учтёт этот запрос (True — индекс есть).
+        """
+        self._ensure_started()
+        job = self._pending.get(project)
+        if job is None:
+            job = self._pending[project] = BuildJob(project, priority)
+        job.priority = min(job.priority, priority)
+        job.full_rebuild = job.full_rebuild or full_rebuild
+        job.requests += 1
+        job.ready_at = max(job.ready_at, time.monotonic() + delay)
+        if subscriber is not None:
+            job.subscribers.add(subscriber)
+        self._arm(job)
+        return job.future
+
+    def _arm(self, job: BuildJob) -> None:
+        if job.timer:
+            job.timer.cancel()
+            job.timer = None
+        if job.project in self._running:
+            job.state = "held"
+            return
+        delay = job.ready_at - time.monotonic()
+        if delay > 0:
+            job.state = "waiting"
+            job.timer = asyncio.get_running_loop().call_later(delay, self._enqueue, job)
+        else:
+            self._enqueue(job)
+
+    def _enqueue(self, job: BuildJob) -> None:
+        job.timer = None
+        job.state = "queued"
+        self._seq += 1
+        job.seq = self._seq
+        # Старые записи этого job в очереди становятся неактуальными (seq не совпадёт)
+        self._queue.put_nowait((job.priority, job.seq, job))
+
+    async def _worker(self, n: int) -> None:
+        while True:
+            _, seq, job = await self._queue.get()
+            if self._pending.get(job.project) is not job or job.state != "queued" or job.seq != seq:
+                continue
+            del self._pending[job.project]
+            self._running[job.project] = job
+            job.started_at = time.monotonic()
+            await self._notify("started", job, None)
+
+            ok = False
+            try:
+                ok = bool(await asyncio.to_thread(self.build_fn, job.project, full_rebuild=job.full_rebuild))
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error("Ошибка сборки индекса %s: %s", job.project, e)
+            finally:
+                del self._running[job.project]
+                follow_up = self._pending.get(job.project)
+                if follow_up is not None:
+                    self._arm(follow_up)
+
+            logger.info(
+                "Сборка индекса %s: %s за %.1f с (воркер %d, запросов: %d)",
+                job.project, "ok" if ok else "нет индекса", time.monotonic() - job.started_at, n, job.requests,
+            )
+            if not job.future.done():
+                job.future.set_result(ok)
+            await self._notify("finished", job, ok)
+
+    async def _notify(self, event: str, job: BuildJob, ok: bool | None) -> None:
+        if self.listener is None:
+            return
+        try:
+            await self.listener(event, job, ok)
+        except Exception as e:
+            logger.error("Ошибка уведомления о сборке %s: %s", job.project, e)
+
+    def status(self) -> dict:
+        """Идущие и ожидающие сборки (время — в секундах от старта/постановки)."""
+        now = time.monotonic()
+        running = [
+            {"project": j.project, "elapsed": now - j.started_at, "full_rebuild": j.full_rebuild,
+             "priority": j.priority}
+            for j in self._running.values()
+        ]
+        pending = [
+            {"project": j.project, "state": j.state, "waiting": now - j.created_at,
+             "starts_in": max(0.0, j.ready_at - now), "full_rebuild": j.full_rebuild,
+             "priority": j.priority, "requests": j.requests}
+            for j in sorted(self._pending.values(), key=lambda j: (j.priority, j.ready_at))
+        ]
+        return {
+            "workers": self.workers,
+            "running": running,
+            "pending": pending,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
@@ -0,0 +1,127 @@
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Hashable
+
+import httpx
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+
+class LLMClient:
+    """
+    Асинхронный клиент OpenAI для ответов бота: не блокирует event loop.
+
+    - один пул HTTP-соединений (keep-alive) на все запросы;
+    - явные таймауты: подключение отдельно, ответ целиком — read_timeout;
+    - повторы с экспоненциальной задержкой на 408/409/429/5xx и обрывы соединения
+      (встроенный механизм SDK, учитывает Retry-After);
+    - общий лимит одновременных запросов и лимит на чат: один чат не занимает
+      все слоты, вопросы разных объектов обрабатываются параллельно.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        max_concurrency: int = 8,
+        per_chat_concurrency: int = 1,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 90.0,
+        max_retries: int = 3,
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.per_chat_concurrency = max(1, per_chat_concurrency)
+        self._http = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=self.max_concurrency * 2,
+                max_keepalive_connections=self.max_concurrency,
+            ),
+        )
+        self.client = AsyncOpenAI(api_key=api_key, http_client=self._http, max_retries=max_retries)
+        self._global = asyncio.Semaphore(self.max_concurrency)
+        # Семафор чата живёт, пока им кто-то пользуется
+        self._chats: dict[Hashable, tuple[asyncio.Semaphore, int]] = {}
+        self.in_flight = 0
+        self.waiting = 0
+
+    def _leave_chat(self, chat_id: Hashable) -> None:
+        sem, users = self._chats[chat_id]
+        if users <= 1:
+            del self._chats[chat_id]
+        else:
+            self._chats[chat_id] = (sem, users - 1)
+
+    @asynccontextmanager
+    async def slot(self, chat_id: Hashable | None = None):
+        """Слот на запрос: сначала лимит чата, затем общий."""
+        chat_sem = None
+        if chat_id is not None:
+            chat_sem, users = self._chats.get(chat_id, (None, 0))
+            if chat_sem is None:
+                chat_sem = asyncio.Semaphore(self.per_chat_concurrency)
+            self._chats[chat_id] = (chat_sem, users + 1)
+
+        started = time.monotonic()
+        self.waiting += 1
+        acquired_chat = False
+        try:
+            if chat_sem is not None:
+                await chat_sem.acquire()
+                acquired_chat = True
+            await self._global.acquire()
+        except BaseException:
+            if acquired_chat:
+                chat_sem.release()
+            if chat_sem is not None:
+                self._leave_chat(chat_id)
+            raise
+        finally:
+            self.waiting -= 1
+            waited = time.monotonic() - started
+            if waited > 1.0:
+                logger.info("Запрос к модели ждал слот %.1f с (chat=%s)", waited, chat_id)
+
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._global.release()
+            if chat_sem is not None:
+                chat_sem.release()
+                self._leave_chat(chat_id)
+
+    async def complete(self, messages: list[dict], model: str, chat_id: Hashable | None = None, **params) -> str:
+        """Текст ответа chat.completions; ошибки после всех повторов пробрасываются."""
+        async with self.slot(chat_id):
+            r = await self.client.chat.completions.create(model=model, messages=messages, **params)
+        return r.choices[0].message.content or ""
+
+    async def stream(self, messages: list[dict], model: str, chat_id: Hashable | None = None, **params):
+        """
+        Асинхронный генератор фрагментов текста ответа (stream=True).
+        Повторы SDK действуют до первого байта; обрыв посреди ответа пробрасывается.
+        """
+        async with self.slot(chat_id):
+            stream = await self.client.chat.completions.create(model=model, messages=messages, stream=True, **params)
+            try:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                await stream.close()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_concurrency": self.max_concurrency,
+            "per_chat_concurrency": self.per_chat_concurrency,
+        }
+
+    async def aclose(self) -> None:
+        await self.client.close()
+        await self._http.aclose()
@@ -2,9 +2,12 @@ import os
 import asyncio
 import logging
 import base64
+import hashlib
+import html
 import tempfile
 import shutil
 import json
+import time
 import pytz
 import sys
 print("SERVICE_STDOUT_TEST", flush=True)
@@ -13,8 +16,6 @@ print("SERVICE_STDERR_TEST", file=sys.stderr, flush=True)
 from apscheduler.triggers.cron import CronTrigger
 from datetime import datetime
 
-from openpyxl import Workbook, load_workbook
-
 from dotenv import load_dotenv
 from telegram import (
     Update,
@@ -31,9 +32,18 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
-from openai import OpenAI
+from telegram.error import BadRequest
 
 import rag_engine
+from group_registry import GroupRegistry, RegistryError
+from progress_export import import_legacy_workbooks, write_progress_workbook
+from state_store import StateStore
+from broadcast import BroadcastEngine, BroadcastResult
+from llm_client import LLMClient
+from message_stream import StreamingMessage, split_message
+from vision import VisionAnswerCache, prepare_image
+from pdf_excerpt import build_excerpt, format_pages
+from index_scheduler import PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_NAMES, IndexBuildScheduler
 
 
 # -------------------- ENV / PATHS --------------------
@@ -43,8 +53,12 @@ DATA_DIR = os.getenv("DATA_DIR", "/var/data")
 DATA_DIR = os.path.abspath(DATA_DIR)
 os.makedirs(DATA_DIR, exist_ok=True)
 
+STATE_DB_FILE = os.path.join(DATA_DIR, "state.sqlite3")
+# Прежнее хранение состояния: переносится в STATE_DB_FILE при первом запуске
 DEADLINES_FILE = os.path.join(DATA_DIR, "deadlines.json")
 PROGRESS_STATE_FILE = os.path.join(DATA_DIR, "progress_state.json")
+TG_FILE_IDS_FILE = os.path.join(DATA_DIR, "telegram_file_ids.json")
+EXCERPTS_DIR = os.path.join(DATA_DIR, "rag_excerpts")
 
 PROJECTS_DIR = os.path.join(DATA_DIR, "StroyBot_Files")
 os.makedirs(PROJECTS_DIR, exist_ok=True)
@@ -69,12 +83,13 @@ if not TELEGRAM_TOKEN:
 if not OPENAI_API_KEY:
     raise RuntimeError("OPENAI_API_KEY is not set")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
 
 # -------------------- CONFIG --------------------
 ADMIN_USER_IDS = {459980503, 5130953211, 1229215603}
 
-GROUPS_CONFIG = {
+# Встроенный список объектов: из него создаётся DATA_DIR/groups.json при первом запуске,
+# дальше объекты добавляются/меняются в файле без перезапуска (group_registry.py)
+DEFAULT_GROUPS_CONFIG = {
     "Мосрентген 28": {
         "chat_id": -5207136504,
         "systems": ["Ремонт подвала", "Ремонт крыши", "Ремонт ЭОМ", "Замена мусоропровода"],
@@ -121,18 +136,53 @@ GROUPS_CONFIG = {
         "systems": ["ХВС маг", "ГВС маг", "ЦО маг", "КН маг", "Ремонт подвала", "Ремонт крыши"],
     },
     "Щербинка Фабрика им. 1 Мая 46": {"chat_id": -4964265480, "systems": ["Ремонт крыши"]},
-    "Рекламация 2025": {"chat_id": -5044901573, "systems": ["Фото исправлений"]},
+    "Рекламация 2025": {
+        "chat_id": -5044901573,
+        "systems": ["Фото исправлений"],
+        "progress": False,
+        "broadcast": False,
+    },
 }
 
-REKLAMACIA_CHAT_ID = -5044901573
+GROUPS_FILE = os.path.join(DATA_DIR, "groups.json")
+GROUPS_RELOAD_INTERVAL_SECONDS = 30
+GROUPS = GroupRegistry(GROUPS_FILE, default=DEFAULT_GROUPS_CONFIG)
+GROUPS.load()
 
 COMMON_DOCS_BUTTON = "📁 Общие документы"
 COMMON_DOCS_FOLDER = "_PROJECT"
 
-# Индексация: дебаунс + lock (чтобы не убивать 512MB RAM)
+# Прогрев RAG после старта: сколько недавно использованных объектов загрузить (0 — выключено)
+RAG_WARMUP_PROJECTS = int(os.getenv("RAG_WARMUP_PROJECTS", "5"))
+RAG_WARMUP_DELAY_SECONDS = 10
+
+# Индексация: дебаунс загрузок + ограниченный пул сборок (чтобы не убивать 512MB RAM)
 REINDEX_DEBOUNCE_SECONDS = 60
-reindex_locks = {}
-reindex_tasks = {}
+RAG_BUILD_WORKERS = int(os.getenv("RAG_BUILD_WORKERS", "2"))
+
+# Запросы к OpenAI: всего одновременно / на один чат, таймауты и повторы при 429/5xx
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_PER_CHAT_CONCURRENCY = int(os.getenv("LLM_PER_CHAT_CONCURRENCY", "1"))
+LLM_CONNECT_TIMEOUT_SECONDS = 10
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "90"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+
+# Рассылка: параллельных отправок; альбом уходит, когда столько секунд не было новых частей
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_ALBUM_WAIT_SECONDS = 1.5
+
+# Vision: модель и кэш ответов по перцептивному хэшу фото + вопросу
+VISION_MODEL = "gpt-4o-mini"
+VISION_CACHE = VisionAnswerCache(
+    os.path.join(DATA_DIR, "vision_cache.sqlite3"),
+    ttl_seconds=float(os.getenv("VISION_CACHE_TTL_DAYS", "30")) * 24 * 3600,
+)
+
+# Потоковые ответы на "*"-вопросы: сообщение дописывается правками по мере генерации.
+# Telegram ограничивает правки (~1/с в личке, ~20/мин в группе) — в группах реже.
+LLM_STREAMING = os.getenv("LLM_STREAMING", "1").strip().lower() not in ("0", "false", "no", "off")
+STREAM_EDIT_INTERVAL_SECONDS = 1.5
+STREAM_EDIT_INTERVAL_GROUP_SECONDS = 3.0
 
 SYSTEM_PROMPT = """
 Ты — главный инженер и технический эксперт по капитальному ремонту многоквартирных домов (МКД) в Москве.
@@ -174,23 +224,199 @@ def _load_json(path: str, default):
         return default
 
 
-# -------------------- DEADLINES --------------------
-def load_deadlines() -> dict:
-    return _load_json(DEADLINES_FILE, {})
+# -------------------- TELEGRAM FILE_ID CACHE --------------------
+# Файл, уже загруженный в Telegram, повторно отправляется по file_id — без upload.
+# Ключ — путь + размер + mtime: изменённый на диске файл загрузится заново.
+# Файл пишется не на каждую отправку: через TG_FILE_IDS_SAVE_DELAY секунд после первого изменения, в потоке.
+TG_FILE_IDS_MAX = 2000
+TG_FILE_IDS_SAVE_DELAY = 5.0
+_tg_file_ids: dict | None = None
+_tg_file_ids_save_task: asyncio.Task | None = None
+_tg_file_ids_write_lock = asyncio.Lock()
+
+
+def _tg_file_ids_cache() -> dict:
+    global _tg_file_ids
+    if _tg_file_ids is None:
+        _tg_file_ids = _load_json(TG_FILE_IDS_FILE, {})
+    return _tg_file_ids
+
+
+def _tg_file_key(file_path: str) -> str | None:
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    return f"{os.path.abspath(file_path)}|{st.st_size}|{st.st_mtime_ns}"
+
+
+def remember_file_id(file_path: str, file_id: str) -> None:
+    key = _tg_file_key(file_path)
+    if not key:
+        return
+    cache = _tg_file_ids_cache()
+    # Старые версии того же файла больше не нужны
+    prefix = key.rsplit("|", 2)[0] + "|"
+    for old in [k for k in cache if k.startswith(prefix) and k != key]:
+        del cache[old]
+    cache.pop(key, None)
+    cache[key] = file_id
+    while len(cache) > TG_FILE_IDS_MAX:
+        del cache[next(iter(cache))]
+    _schedule_file_ids_save()
+
+
+def _forget_file_id(key: str) -> None:
+    cache = _tg_file_ids_cache()
+    if cache.pop(key, None) is not None:
+        _schedule_file_ids_save()
+
+
+def _schedule_file_ids_save() -> None:
+    global _tg_file_ids_save_task
+    if _tg_file_ids_save_task is None:
+        _tg_file_ids_save_task = asyncio.get_running_loop().create_task(_save_file_ids_later())
+
+
+async def _save_file_ids_later() -> None:
+    global _tg_file_ids_save_task
+    await asyncio.sleep(TG_FILE_IDS_SAVE_DELAY)
+    # Изменения после снимка запланируют следующую запись
+    _tg_file_ids_save_task = None
+    snapshot = dict(_tg_file_ids_cache())
+    async with _tg_file_ids_write_lock:
+        try:
+            await asyncio.to_thread(_atomic_write_json, TG_FILE_IDS_FILE, snapshot)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить file_id: {e}")
+
+
+def flush_file_ids() -> None:
+    """Записывает отложенные изменения file_id сразу (при остановке бота)."""
+    global _tg_file_ids_save_task
+    if _tg_file_ids_save_task is None:
+        return
+    _tg_file_ids_save_task.cancel()
+    _tg_file_ids_save_task = None
+    _atomic_write_json(TG_FILE_IDS_FILE, _tg_file_ids_cache())
+
+
+async def send_cached_document(
+    bot,
+    chat_id: int,
+    file_path: str,
+    caption: str | None = None,
+    filename: str | None = None,
+    reply_markup=None,
+):
+    """send_document с повторным использованием file_id; при первой отправке файл загружается с диска."""
+    key = _tg_file_key(file_path)
+    file_id = _tg_file_ids_cache().get(key) if key else None
+    if file_id:
+        try:
+            return await bot.send_document(
+                chat_id=chat_id, document=file_id, caption=caption, reply_markup=reply_markup
+            )
+        except BadRequest as e:
+            logger.warning(f"file_id устарел для {file_path}: {e}, загружаю заново")
+            _forget_file_id(key)
+
+    with open(file_path, "rb") as f:
+        sent = await bot.send_document(
+            chat_id=chat_id,
+            document=f,
+            filename=filename or os.path.basename(file_path),
+            caption=caption,
+            reply_markup=reply_markup,
+        )
+    if sent.document:
+        remember_file_id(file_path, sent.document.file_id)
+    return sent
+
+
+# -------------------- RAG SOURCES --------------------
+# Вместо всего PDF отправляется выдержка из процитированных страниц; полный файл — по кнопке.
+RAG_SEND_EXCERPTS = os.getenv("RAG_SEND_EXCERPTS", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+def _project_dir(project_name: str) -> str:
+    return os.path.join(PROJECTS_DIR, _clean_name(project_name))
+
+
+def _source_token(project_name: str, file_path: str) -> str:
+    """Короткий id файла объекта для callback_data (лимит Telegram — 64 байта)."""
+    rel = os.path.relpath(file_path, _project_dir(project_name))
+    return hashlib.sha1(rel.encode("utf-8")).hexdigest()[:16]
+
+
+def _find_source_by_token(project_name: str, token: str) -> str | None:
+    root = _project_dir(project_name)
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if name.lower().endswith(".pdf") and _source_token(project_name, path) == token:
+                return path
+    return None
+
+
+async def send_rag_source(bot, chat_id: int, project_name: str | None, file_path: str, pages: list[int]):
+    """Отправляет источник RAG-ответа: выдержку страниц pages с кнопкой полного файла или весь PDF."""
+    name = os.path.basename(file_path)
+    excerpt = None
+    if RAG_SEND_EXCERPTS and project_name and pages:
+        excerpt = await asyncio.to_thread(build_excerpt, file_path, pages, EXCERPTS_DIR)
+
+    if excerpt is None:
+        return await send_cached_document(bot, chat_id, file_path, caption=f"📄 {name}")
+
+    excerpt_path, included = excerpt
+    pages_str = format_pages(included)
+    stem, ext = os.path.splitext(name)
+    kb = InlineKeyboardMarkup(
+        [[InlineKeyboardButton("📎 Весь документ", callback_data=f"src_full:{_source_token(project_name, file_path)}")]]
+    )
+    return await send_cached_document(
+        bot,
+        chat_id,
+        excerpt_path,
+        caption=f"📄 {name}, стр. {pages_str}",
+        filename=f"{stem} (стр. {pages_str}){ext}",
+        reply_markup=kb,
+    )
+
+
+async def handle_full_source(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка "Весь документ" под выдержкой: отправляет исходный PDF объекта этого чата."""
+    q = update.callback_query
+    token = q.data.split(":", 1)[1]
+    chat = q.message.chat
+    project_name = _get_project_name_by_chat(chat.id, chat.title)
+    file_path = (
+        await asyncio.to_thread(_find_source_by_token, project_name, token) if project_name else None
+    )
+    if file_path is None:
+        await q.answer("Файл не найден — возможно, он удалён или перемещён", show_alert=True)
+        return
+
+    await q.answer("Отправляю полный файл…")
+    try:
+        await send_cached_document(context.bot, chat.id, file_path, caption=f"📄 {os.path.basename(file_path)}")
+    except Exception as e:
+        logger.error(f"Не удалось отправить документ {file_path}: {e}")
 
 
+# -------------------- STATE --------------------
+# Сроки и последний прогресс: в памяти + SQLite, см. state_store.py
+STATE = StateStore(STATE_DB_FILE, legacy_deadlines=DEADLINES_FILE, legacy_progress=PROGRESS_STATE_FILE)
+
+
+# -------------------- DEADLINES --------------------
 def save_system_deadline(chat_id: int, system_name: str, date_str: str) -> None:
-    data = load_deadlines()
-    chat_key = str(chat_id)
-    if chat_key not in data:
-        data[chat_key] = {}
-    data[chat_key][system_name] = date_str
-    _atomic_write_json(DEADLINES_FILE, data)
+    STATE.set_deadline(chat_id, system_name, date_str)
 
 
 def get_deadlines_report(chat_id: int, show_all: bool = False) -> str:
-    data = load_deadlines()
-    chat_data = data.get(str(chat_id), {})
+    chat_data = STATE.deadlines(chat_id)
 
     if not chat_data:
         return "" if not show_all else "📅 Сроки сдачи работ еще не установлены."
@@ -243,21 +469,8 @@ def get_deadlines_report(chat_id: int, show_all: bool = False) -> str:
 
 
 # -------------------- PROGRESS STATE --------------------
-def load_progress_state() -> dict:
-    return _load_json(PROGRESS_STATE_FILE, {})
-
-
-def save_progress_state(data: dict) -> None:
-    _atomic_write_json(PROGRESS_STATE_FILE, data)
-
-
 def get_prev_progress(chat_id: int, system_name: str):
-    state = load_progress_state()
-    chat_key = str(chat_id)
-    rec = state.get(chat_key, {}).get(system_name)
-    if not rec:
-        return 0.0, None
-    return float(rec.get("last_percent", 0)), rec.get("last_date")
+    return STATE.get_progress(chat_id, system_name)
 
 
 # -------------------- UI --------------------
@@ -268,14 +481,12 @@ def is_admin_user(update: Update) -> bool:
 
 def build_groups_keyboard(selected: set):
     rows = []
-    sorted_groups = sorted(GROUPS_CONFIG.items())
-
-    for name, cfg in sorted_groups:
-        if name == "Рекламация 2025":
+    for group in GROUPS.groups():
+        if not group.broadcast:
             continue
-        cid = cfg["chat_id"]
+        cid = group.chat_id
         mark = "✅" if cid in selected else "⬜️"
-        rows.append([InlineKeyboardButton(f"{mark} {name}", callback_data=f"bc_tgl:{cid}")])
+        rows.append([InlineKeyboardButton(f"{mark} {group.name}", callback_data=f"bc_tgl:{cid}")])
 
     rows.append(
         [
@@ -335,74 +546,68 @@ def build_progress_keyboard(min_value: int):
     return InlineKeyboardMarkup(rows)
 
 
-def create_or_update_progress_excel(address: str, date_str: str, data: dict):
-    address_clean = _clean_name(address)
-    path = os.path.join(DATA_DIR, address_clean)
-    os.makedirs(path, exist_ok=True)
+def _get_project_name_by_chat(chat_id: int, chat_title: str | None) -> str | None:
+    group = GROUPS.resolve(chat_id, chat_title)
+    return group.name if group else None
 
-    xlsx = os.path.join(path, "Прогресс_работ.xlsx")
-    if os.path.exists(xlsx):
-        wb = load_workbook(xlsx)
-        ws = wb.active
-    else:
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Прогресс"
-        ws.append(["Дата", "Система", "Процент выполнения, %"])
 
-    for sys, val in data.items():
-        ws.append([date_str, sys, val])
+# Приложение (для уведомлений из фоновых задач), задаётся в main()
+_app = None
 
-    wb.save(xlsx)
 
+async def _on_index_build(event: str, job, ok: bool | None):
+    """Уведомления планировщика индексации в чаты, откуда пришли загрузки PDF."""
+    bot = _app.bot if _app else None
+    if bot is None or not job.subscribers:
+        return
+    if event == "started":
+        text = f"🔄 Индексация: {job.project} (подождите)…"
+    elif ok:
+        text = "✅ Индексация завершена и сохранена на диск."
+    else:
+        text = "⚠️ Индексация не выполнена (нет PDF или ошибка)."
+    for chat_id in job.subscribers:
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+        except Exception as e:
+            logger.error(f"Не удалось отправить статус индексации в {chat_id}: {e}")
 
-def _get_project_name_by_chat(chat_id: int, chat_title: str | None) -> str | None:
-    for p_name, cfg in GROUPS_CONFIG.items():
-        if cfg["chat_id"] == chat_id:
-            return p_name
-    if chat_title and chat_title in GROUPS_CONFIG:
-        return chat_title
-    return None
 
+# Сборки индексов: на проект одна сборка + одна повторная, загрузки в чатах обгоняют /reload_docs
+INDEX_SCHEDULER = IndexBuildScheduler(
+    rag_engine.build_index_for_project,
+    workers=RAG_BUILD_WORKERS,
+    listener=_on_index_build,
+)
 
-async def schedule_reindex(bot, chat_id: int, project_name: str):
+
+def schedule_reindex(chat_id: int, project_name: str):
     """
-    Правильная автоиндексация:
-    - debounce: индексируем раз в N секунд после последней загрузки PDF
-    - lock: никогда не индексируем один проект параллельно
+    Автоиндексация после загрузки PDF:
+    - debounce: индексируем через N секунд после последней загрузки
+    - загрузка во время идущей сборки ставит одну повторную сборку (ничего не теряется)
     - build_index_for_project сохраняет индекс на диск (rag_engine.py)
     """
-    lock = reindex_locks.setdefault(project_name, asyncio.Lock())
-
-    old = reindex_tasks.get(project_name)
-    if old and not old.done():
-        old.cancel()
+    return INDEX_SCHEDULER.submit(
+        project_name,
+        priority=PRIORITY_INTERACTIVE,
+        delay=REINDEX_DEBOUNCE_SECONDS,
+        subscriber=chat_id,
+    )
 
-    async def _runner():
-        try:
-            await asyncio.sleep(REINDEX_DEBOUNCE_SECONDS)
-
-            if lock.locked():
-                return
-
-            async with lock:
-                await bot.send_message(chat_id=chat_id, text=f"🔄 Индексация: {project_name} (подождите)…")
-                ok = await asyncio.to_thread(rag_engine.build_index_for_project, project_name)
-                if ok:
-                    await bot.send_message(chat_id=chat_id, text="✅ Индексация завершена и сохранена на диск.")
-                else:
-                    await bot.send_message(chat_id=chat_id, text="⚠️ Индексация не выполнена (нет PDF или ошибка).")
-        except asyncio.CancelledError:
-            return
-        except Exception as e:
-            logger.error(f"Reindex error for {project_name}: {e}")
 
-    task = asyncio.create_task(_runner())
-    reindex_tasks[project_name] = task
+# -------------------- AI --------------------
+LLM = LLMClient(
+    OPENAI_API_KEY,
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    per_chat_concurrency=LLM_PER_CHAT_CONCURRENCY,
+    connect_timeout=LLM_CONNECT_TIMEOUT_SECONDS,
+    read_timeout=LLM_TIMEOUT_SECONDS,
+    max_retries=LLM_MAX_RETRIES,
+)
 
 
-# -------------------- AI --------------------
-async def get_gpt_response(text: str, context: str | None = None) -> str:
+def _gpt_messages(text: str, context: str | None = None) -> list[dict]:
     if context:
         system_msg = (
             f"{SYSTEM_PROMPT}\n\n"
@@ -413,39 +618,80 @@ async def get_gpt_response(text: str, context: str | None = None) -> str:
     else:
         system_msg = SYSTEM_PROMPT
 
+    return [
+        {"role": "system", "content": system_msg},
+        {"role": "user", "content": text},
+    ]
+
+
+async def get_gpt_response(text: str, context: str | None = None, chat_id: int | None = None) -> str:
     try:
-        r = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_msg},
-                {"role": "user", "content": text},
-            ],
-            temperature=0.5,
-        )
-        return r.choices[0].message.content or ""
+        return await LLM.complete(_gpt_messages(text, context), model="gpt-4o", chat_id=chat_id, temperature=0.5)
     except Exception as e:
         return f"⚠️ Ошибка: {str(e)}"
 
 
-async def get_vision_response(text: str, image_path: str) -> str:
+async def stream_gpt_response(bot, chat_id: int, text: str, context: str | None = None) -> tuple[str, bool]:
+    """
+    Как get_gpt_response, но ответ сразу появляется в чате и дописывается по мере генерации.
+    Возвращает (текст, ok); ok=False — ответ оборван ошибкой (в кэш его класть нельзя).
+    """
+    interval = STREAM_EDIT_INTERVAL_GROUP_SECONDS if chat_id < 0 else STREAM_EDIT_INTERVAL_SECONDS
+    out = StreamingMessage(bot, chat_id, min_interval=interval)
+    await out.start()
+    started = time.monotonic()
+    first_token_at = None
     try:
-        with open(image_path, "rb") as f:
-            b64 = base64.b64encode(f.read()).decode("utf-8")
+        async for delta in LLM.stream(_gpt_messages(text, context), model="gpt-4o", chat_id=chat_id, temperature=0.5):
+            if first_token_at is None:
+                first_token_at = time.monotonic() - started
+            await out.append(delta)
+    except Exception as e:
+        logger.error(f"Ошибка потокового ответа в чате {chat_id}: {e}")
+        suffix = f"\n\n⚠️ Ответ прерван: {e}" if out.text.strip() else f"⚠️ Ошибка: {e}"
+        return await out.finish(suffix), False
+
+    if not out.text.strip():
+        return await out.finish("⚠️ Не удалось получить ответ"), False
+    answer = await out.finish()
+    logger.info(
+        "Потоковый ответ в чат %s: первый фрагмент через %.1f с, всего %.1f с, сообщений %d, правок %d",
+        chat_id, first_token_at or 0.0, time.monotonic() - started, out.messages, out.edits,
+    )
+    return answer, True
 
-        r = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
+
+async def get_vision_response(text: str, image: bytes, chat_id: int | None = None) -> str:
+    """Ответ по фото: картинка уменьшается под модель, повторное фото с тем же вопросом — из кэша."""
+    prompt = text or "Анализ фото"
+    try:
+        jpeg, phash = await asyncio.to_thread(prepare_image, image)
+        cached = await asyncio.to_thread(VISION_CACHE.lookup, VISION_MODEL, prompt, phash)
+        if cached is not None:
+            logger.info(f"Vision-ответ из кэша (chat={chat_id}, hits={VISION_CACHE.hits})")
+            return cached
+
+        b64 = base64.b64encode(jpeg).decode("utf-8")
+        answer = await LLM.complete(
+            [
                 {"role": "system", "content": SYSTEM_PROMPT},
                 {
                     "role": "user",
                     "content": [
-                        {"type": "text", "text": text or "Анализ фото"},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64}"}},
+                        {"type": "text", "text": prompt},
+                        {
+                            "type": "image_url",
+                            "image_url": {"url": f"data:image/jpeg;base64,{b64}", "detail": "high"},
+                        },
                     ],
                 },
             ],
+            model=VISION_MODEL,
+            chat_id=chat_id,
         )
-        return r.choices[0].message.content or ""
+        if answer:
+            await asyncio.to_thread(VISION_CACHE.put, VISION_MODEL, prompt, phash, answer)
+        return answer
     except Exception as e:
         return f"⚠️ Ошибка: {str(e)}"
 
@@ -462,25 +708,8 @@ async def _delete_after_delay(bot, chat_id: int, message_id: int, delay: float =
 
 async def _send_long_message(bot, chat_id: int, text: str, parse_mode=None):
     """Отправляет текст, разбивая на части по 4096 символов, если нужно."""
-    MAX_LEN = 4096
-    if len(text) <= MAX_LEN:
-        await bot.send_message(
-            chat_id=chat_id,
-            text=text,
-            parse_mode=parse_mode,
-            disable_web_page_preview=True,
-        )
-        return
-
     while text:
-        if len(text) <= MAX_LEN:
-            chunk, text = text, ""
-        else:
-            split_at = text.rfind("\n", 0, MAX_LEN)
-            if split_at == -1:
-                split_at = MAX_LEN
-            chunk, text = text[:split_at], text[split_at:].lstrip("\n")
-
+        chunk, text = split_message(text)
         await bot.send_message(
             chat_id=chat_id,
             text=chunk,
@@ -521,19 +750,12 @@ async def start_deadline_setup(update: Update, context: ContextTypes.DEFAULT_TYP
     chat_id = update.effective_chat.id
     chat_title = update.effective_chat.title or "Личный чат"
 
-    target_cfg = None
-    for _, cfg in GROUPS_CONFIG.items():
-        if cfg["chat_id"] == chat_id:
-            target_cfg = cfg
-            break
-    if not target_cfg and chat_title in GROUPS_CONFIG:
-        target_cfg = GROUPS_CONFIG[chat_title]
-
-    if not target_cfg:
+    target = GROUPS.resolve(chat_id, chat_title)
+    if not target:
         await update.message.reply_text("❌ Чат не настроен.")
         return
 
-    systems = target_cfg["systems"]
+    systems = list(target.systems)
     kb = [[InlineKeyboardButton(s, callback_data=f"deadline_{i}")] for i, s in enumerate(systems)]
     pending_deadline_setup[chat_id] = {"systems": systems}
     await update.message.reply_text("📅 Выберите систему:", reply_markup=InlineKeyboardMarkup(kb))
@@ -611,23 +833,17 @@ async def handle_progress_button(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     title = update.effective_chat.title or "Личный чат"
-    create_or_update_progress_excel(title, st["date"], st["ans"])
-
-    state = load_progress_state()
-    chat_key = str(cid)
-    if chat_key not in state:
-        state[chat_key] = {}
-
-    for sys_name, val in st["ans"].items():
-        state[chat_key][sys_name] = {"last_percent": float(val), "last_date": st["date"]}
-
-    save_progress_state(state)
+    # Последние значения + журнал для Excel-отчёта (/export_progress)
+    STATE.set_progress(cid, st["ans"], st["date"], project=_get_project_name_by_chat(cid, title) or title)
 
     del pending_progress[cid]
     await q.edit_message_text("✅ Прогресс сохранён. Спасибо!", parse_mode="HTML")
 
 
 # -------------------- BROADCAST --------------------
+BROADCAST = BroadcastEngine(concurrency=BROADCAST_CONCURRENCY)
+
+
 async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin_user(update):
         await update.message.reply_text("⛔️ У вас нет прав на рассылку.")
@@ -664,10 +880,9 @@ async def broadcast_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             selected.add(chat_id)
     elif data == "bc_all":
-        for name, cfg in GROUPS_CONFIG.items():
-            if name == "Рекламация 2025":
-                continue
-            selected.add(cfg["chat_id"])
+        for group in GROUPS.groups():
+            if group.broadcast:
+                selected.add(group.chat_id)
     elif data == "bc_none":
         selected.clear()
     elif data == "bc_cancel":
@@ -697,6 +912,65 @@ async def broadcast_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
         pass
 
 
+def _chat_name(chat_id: int) -> str:
+    group = GROUPS.by_chat(chat_id)
+    return group.name if group else str(chat_id)
+
+
+def _broadcast_status(result: BroadcastResult, final: bool = False) -> str:
+    if final:
+        text = (
+            f"✅ <b>Рассылка завершена!</b> ({result.elapsed:.0f} с)\n\n"
+            f"Успешно: {len(result.sent)}\nОшибок: {len(result.failed)}"
+        )
+    else:
+        text = (
+            f"⏳ Рассылка: {result.done}/{result.total}\n"
+            f"Успешно: {len(result.sent)}, ошибок: {len(result.failed)}"
+        )
+    if result.retries:
+        text += f"\nПовторов (лимиты Telegram/сеть): {result.retries}"
+    if final and result.failed:
+        lines = [f"— {html.escape(_chat_name(cid))}: {html.escape(err[:100])}" for cid, err in result.failed.items()]
+        text += "\n\n" + "\n".join(lines[:20])
+    return text
+
+
+async def _run_broadcast(bot, chat_id: int, message_ids: list[int], targets: list[int]):
+    status_msg = await bot.send_message(chat_id=chat_id, text=f"⏳ Рассылка запущена: 0/{len(targets)}")
+
+    async def progress(result: BroadcastResult):
+        await bot.edit_message_text(
+            chat_id=chat_id, message_id=status_msg.message_id, text=_broadcast_status(result), parse_mode="HTML"
+        )
+
+    result = await BROADCAST.run(bot, chat_id, message_ids, targets, on_progress=progress)
+    for old_id, new_id in result.migrated.items():
+        logger.warning(f"Чат {_chat_name(old_id)} переехал: {old_id} → {new_id}, обновите {GROUPS_FILE}")
+    try:
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=status_msg.message_id,
+            text=_broadcast_status(result, final=True),
+            parse_mode="HTML",
+        )
+    except BadRequest:
+        await bot.send_message(chat_id=chat_id, text=_broadcast_status(result, final=True), parse_mode="HTML")
+
+
+async def _broadcast_album_later(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    """
+    Части альбома приходят отдельными апдейтами — рассылаем разом, когда новых частей
+    не было BROADCAST_ALBUM_WAIT_SECONDS (каждая часть перезапускает таймер).
+    """
+    await asyncio.sleep(BROADCAST_ALBUM_WAIT_SECONDS)
+    album = context.user_data.get("bc_album") or {}
+    targets = sorted(context.user_data.get("bc_selected", set()))
+    context.user_data.clear()
+    if targets and album.get("message_ids"):
+        await _run_broadcast(context.bot, chat_id, album["message_ids"], targets)
+
+
 async def execute_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     targets = context.user_data.get("bc_selected", set())
     if not targets:
@@ -705,40 +979,26 @@ async def execute_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     msg = update.message
-    success = 0
-    failed = 0
-    status_msg = await update.message.reply_text("⏳ Рассылка запущена...")
-
-    for chat_id in targets:
-        try:
-            if msg.text:
-                await context.bot.send_message(chat_id=chat_id, text=msg.text)
-            elif msg.photo:
-                await context.bot.send_photo(chat_id=chat_id, photo=msg.photo[-1].file_id, caption=msg.caption)
-            elif msg.video:
-                await context.bot.send_video(chat_id=chat_id, video=msg.video.file_id, caption=msg.caption)
-            elif msg.document:
-                await context.bot.send_document(chat_id=chat_id, document=msg.document.file_id, caption=msg.caption)
-            elif msg.audio:
-                await context.bot.send_audio(chat_id=chat_id, audio=msg.audio.file_id, caption=msg.caption)
-            elif msg.voice:
-                await context.bot.send_voice(chat_id=chat_id, voice=msg.voice.file_id, caption=msg.caption)
-            else:
-                failed += 1
-                continue
+    chat_id = update.effective_chat.id
 
-            success += 1
-        except Exception as e:
-            logger.error(f"Не удалось отправить в {chat_id}: {e}")
-            failed += 1
+    # Альбом: копим message_id частей, рассылка стартует после последней (debounce)
+    if msg.media_group_id:
+        album = context.user_data.get("bc_album")
+        if album is None or album["media_group_id"] != msg.media_group_id:
+            album = context.user_data["bc_album"] = {"media_group_id": msg.media_group_id, "message_ids": []}
+        album["message_ids"].append(msg.message_id)
+        # Таймер отменяется, только пока он спит: сработав, он сразу очищает user_data
+        timer = album.get("timer")
+        if timer is not None:
+            timer.cancel()
+        album["timer"] = context.application.create_task(_broadcast_album_later(context, chat_id))
+        return
 
+    targets = sorted(targets)
+    # Сообщения, присланные во время рассылки, уже не рассылаются
     context.user_data.clear()
-    await context.bot.edit_message_text(
-        chat_id=update.effective_chat.id,
-        message_id=status_msg.message_id,
-        text=f"✅ <b>Рассылка завершена!</b>\n\nУспешно: {success}\nОшибок: {failed}",
-        parse_mode="HTML",
-    )
+    # Рассылка идёт в фоне: апдейты остальных чатов не ждут её окончания
+    context.application.create_task(_run_broadcast(context.bot, chat_id, [msg.message_id], targets))
 
 
 # -------------------- TEXT --------------------
@@ -778,27 +1038,34 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.chat.send_action("typing")
 
         project_name = _get_project_name_by_chat(cid, title)
-        context_data, source_files = (
-            rag_engine.get_relevant_context(project_name, user_query)
-            if project_name
-            else (None, [])
-        )
+        cached = await rag_engine.aget_cached_answer(project_name, user_query) if project_name else None
 
-        res = await get_gpt_response(user_query, context=context_data)
+        if cached:
+            res, source_files = cached
+            # Отправляем ответ (длинные сообщения автоматически бьются на части)
+            await _send_long_message(context.bot, cid, res)
+        else:
+            context_data, source_files, chunk_ids = (
+                await rag_engine.aretrieve(project_name, user_query)
+                if project_name
+                else (None, {}, [])
+            )
 
-        # Отправляем ответ (длинные сообщения автоматически бьются на части)
-        await _send_long_message(context.bot, cid, res or "⚠️ Не удалось получить ответ")
+            if LLM_STREAMING:
+                # Ответ появляется в чате по мере генерации, длинный — несколькими сообщениями
+                res, ok = await stream_gpt_response(context.bot, cid, user_query, context=context_data)
+            else:
+                res = await get_gpt_response(user_query, context=context_data, chat_id=cid)
+                ok = bool(res) and not res.startswith("⚠️")
+                await _send_long_message(context.bot, cid, res or "⚠️ Не удалось получить ответ")
+
+            if context_data and ok:
+                await rag_engine.astore_answer(project_name, user_query, res, chunk_ids, source_files)
 
-        # Отправляем исходные документы, из которых нашлась информация
-        for file_path in source_files:
+        # Отправляем исходные документы (или выдержки процитированных страниц)
+        for file_path, pages in source_files.items():
             try:
-                with open(file_path, "rb") as f:
-                    await context.bot.send_document(
-                        chat_id=cid,
-                        document=f,
-                        filename=os.path.basename(file_path),
-                        caption=f"📄 {os.path.basename(file_path)}",
-                    )
+                await send_rag_source(context.bot, cid, project_name, file_path, pages)
             except Exception as e:
                 logger.error(f"Не удалось отправить документ {file_path}: {e}")
         return
@@ -813,19 +1080,89 @@ async def reload_docs_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not is_admin_user(update):
         return
 
-    msg = await update.message.reply_text("⏳ Начинаю переиндексацию всех проектов...")
-    count = 0
+    # "/reload_docs full" — сбросить кэш текста PDF и пересобрать индексы с нуля
+    full = bool(context.args) and context.args[0].lower() == "full"
+    if full:
+        await asyncio.to_thread(rag_engine.invalidate_page_cache)
+
+    msg = await update.message.reply_text(
+        f"⏳ Переиндексация {len(GROUPS)} проектов поставлена в очередь (статус: /index_status)..."
+    )
+    futures = [
+        INDEX_SCHEDULER.submit(project_name, priority=PRIORITY_BULK, full_rebuild=full)
+        for project_name in GROUPS.names()
+    ]
+
+    async def _report():
+        results = await asyncio.gather(*futures)
+        await context.bot.edit_message_text(
+            chat_id=update.effective_chat.id,
+            message_id=msg.message_id,
+            text=f"✅ База знаний обновлена! Проиндексировано проектов: {sum(results)}",
+        )
+
+    # Не держим обработчик команды до конца всех сборок
+    context.application.create_task(_report())
+
+
+def _fmt_seconds(seconds: float) -> str:
+    minutes, sec = divmod(int(seconds), 60)
+    return f"{minutes} мин {sec} с" if minutes else f"{sec} с"
+
+
+async def index_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin_user(update):
+        return
+
+    st = INDEX_SCHEDULER.status()
+    lines = [
+        f"🗂 <b>Индексация</b> (воркеров: {st['workers']}, готово: {st['completed']}, ошибок: {st['failed']})",
+        "",
+        "<b>Идут:</b>",
+    ]
+    for j in st["running"]:
+        full = ", с нуля" if j["full_rebuild"] else ""
+        lines.append(f"— {html.escape(j['project'])}: {_fmt_seconds(j['elapsed'])} ({PRIORITY_NAMES.get(j['priority'])}{full})")
+    if not st["running"]:
+        lines.append("—")
+
+    lines += ["", "<b>Ожидают:</b>"]
+    states = {"queued": "в очереди", "waiting": "debounce", "held": "после текущей сборки"}
+    for j in st["pending"]:
+        starts = f", старт через {_fmt_seconds(j['starts_in'])}" if j["state"] == "waiting" else ""
+        lines.append(
+            f"— {html.escape(j['project'])}: {states[j['state']]}{starts}, ждёт {_fmt_seconds(j['waiting'])} "
+            f"({PRIORITY_NAMES.get(j['priority'])}, запросов: {j['requests']})"
+        )
+    if not st["pending"]:
+        lines.append("—")
+
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
 
-    for project_name in GROUPS_CONFIG.keys():
-        ok = await asyncio.to_thread(rag_engine.build_index_for_project, project_name)
-        if ok:
-            count += 1
 
-    await context.bot.edit_message_text(
-        chat_id=update.effective_chat.id,
-        message_id=msg.message_id,
-        text=f"✅ База знаний обновлена! Проиндексировано проектов: {count}",
+async def rag_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin_user(update):
+        return
+
+    stats = rag_engine.get_cache_stats()
+    idx = stats["indexes"]
+    emb = stats["embeddings"]
+    ans = stats["answers"]
+    store = stats["chunk_store"]
+    llm = LLM.stats()
+    text = (
+        "📊 <b>RAG кэши</b>\n"
+        f"Индексы в памяти: {idx['projects']} "
+        f"({idx['bytes'] / 1024 / 1024:.1f} / {idx['max_bytes'] / 1024 / 1024:.0f} МБ)\n"
+        f"— hits: {idx['hits']}, misses: {idx['misses']}, вытеснено: {idx['evictions']}\n"
+        f"— закреплены: {html.escape(', '.join(idx['pinned'])) or '—'}\n"
+        f"Эмбеддинги: hits {emb['hits']}, misses {emb['misses']}\n"
+        f"Общее хранилище чанков: {store['chunks']} ({store['bytes'] / 1024 / 1024:.1f} МБ векторов, page cache ОС)\n"
+        f"Ответы: hits {ans['hits']}, misses {ans['misses']}\n"
+        f"Vision-ответы: hits {VISION_CACHE.hits}, misses {VISION_CACHE.misses}\n"
+        f"Запросы к модели: выполняются {llm['in_flight']}/{llm['max_concurrency']}, ждут {llm['waiting']}"
     )
+    await update.message.reply_text(text, parse_mode="HTML")
 
 
 # -------------------- MEDIA --------------------
@@ -844,24 +1181,15 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Vision: caption начинается с "*"
     if caption.strip().startswith("*") and msg.photo:
         file_obj = await context.bot.get_file(msg.photo[-1].file_id)
-        with tempfile.TemporaryDirectory() as temp_dir:
-            local_path = os.path.join(temp_dir, f"{message_id}.jpg")
-            await file_obj.download_to_drive(local_path)
-            await msg.chat.send_action("typing")
-            ai_answer = await get_vision_response(caption.replace("*", "").strip(), local_path)
-            await msg.reply_text(ai_answer)
+        image = bytes(await file_obj.download_as_bytearray())
+        await msg.chat.send_action("typing")
+        ai_answer = await get_vision_response(caption.replace("*", "").strip(), image, chat_id=chat_id)
+        await msg.reply_text(ai_answer)
         return
 
     # Сохранение файла на диск (persistent)
-    target_cfg = None
-    for _, cfg in GROUPS_CONFIG.items():
-        if cfg["chat_id"] == chat_id:
-            target_cfg = cfg
-            break
-    if not target_cfg and chat_title in GROUPS_CONFIG:
-        target_cfg = GROUPS_CONFIG[chat_title]
-
-    if not target_cfg:
+    target = GROUPS.resolve(chat_id, chat_title)
+    if not target:
         return
 
     file_obj = None
@@ -899,12 +1227,14 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "local_path": local_path,
         "filename": filename,
         "chat_title": chat_title,
-        "config": target_cfg,
+        # Группа на момент вопроса: номера кнопок не собьются, если реестр обновится
+        "group": target,
         "chat_id": chat_id,
         "is_photo": bool(msg.photo),
+        "file_id": None if msg.photo else msg.document.file_id,
     }
 
-    systems = [COMMON_DOCS_BUTTON] + target_cfg["systems"]
+    systems = [COMMON_DOCS_BUTTON, *target.systems]
     keyboard = [[InlineKeyboardButton(s, callback_data=f"save_{chat_id}_{message_id}_{i}")] for i, s in enumerate(systems)]
     await msg.reply_text("🔧 К какой папке сохранить файл?", reply_markup=InlineKeyboardMarkup(keyboard))
 
@@ -929,11 +1259,14 @@ async def handle_save_selection(update: Update, context: ContextTypes.DEFAULT_TY
 
     d = pending_photos[key]
 
-    systems = [COMMON_DOCS_BUTTON] + d["config"]["systems"]
+    systems = [COMMON_DOCS_BUTTON, *d["group"].systems]
     chosen = systems[sys_idx]
     folder_name = COMMON_DOCS_FOLDER if chosen == COMMON_DOCS_BUTTON else chosen
 
     dest_path = save_file_to_system(d["local_path"], d["chat_title"], folder_name, d["filename"])
+    if d.get("file_id"):
+        # Этот файл уже есть в Telegram — в ответах RAG он отправится без повторной загрузки
+        remember_file_id(dest_path, d["file_id"])
 
     if d.get("is_photo"):
         # Для фото: пишем "сохранено" и автоматически удаляем через 5 секунд
@@ -963,27 +1296,26 @@ async def handle_save_selection(update: Update, context: ContextTypes.DEFAULT_TY
 
     del pending_photos[key]
 
-    # автоиндексация: только PDF, плюс debounce+lock внутри schedule_reindex
+    # автоиндексация: только PDF, debounce и очередь сборок — в INDEX_SCHEDULER
     if str(dest_path).lower().endswith(".pdf"):
         project_name = _get_project_name_by_chat(chat_id, d.get("chat_title"))
         if project_name:
-            await schedule_reindex(context.bot, chat_id, project_name)
+            schedule_reindex(chat_id, project_name)
 
 
 # -------------------- JOBS --------------------
 async def ask_for_system_progress(context: ContextTypes.DEFAULT_TYPE):
     d_str = datetime.now().strftime("%Y-%m-%d")
 
-    for addr, cfg in GROUPS_CONFIG.items():
-        cid = cfg.get("chat_id")
-        if not cid:
-            continue
-        if cid == REKLAMACIA_CHAT_ID:
+    for group in GROUPS.groups():
+        if not group.progress:
             continue
+        cid = group.chat_id
+        addr = group.name
 
         deadlines_text = get_deadlines_report(cid)
 
-        systems = cfg["systems"].copy()
+        systems = list(group.systems)
         if not systems:
             continue
 
@@ -1014,29 +1346,101 @@ async def test_progress(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def progress_report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
 
-    target_cfg = None
-    for _, cfg in GROUPS_CONFIG.items():
-        if cfg["chat_id"] == cid:
-            target_cfg = cfg
-            break
-    if not target_cfg:
-        await update.message.reply_text("❌ Чат не настроен в GROUPS_CONFIG.")
+    target = GROUPS.by_chat(cid)
+    if not target:
+        await update.message.reply_text("❌ Чат не настроен в реестре объектов.")
         return
 
-    systems = target_cfg["systems"]
-    state = load_progress_state().get(str(cid), {})
+    systems = target.systems
+    state = STATE.progress(cid)
 
     lines = ["📊 <b>Свод прогресса:</b>"]
     for s in systems:
         rec = state.get(s)
         if rec:
-            lines.append(f"— {s}: <b>{rec.get('last_percent', 0)}%</b> (дата: {rec.get('last_date', '—')})")
+            lines.append(f"— {s}: <b>{rec[0]}%</b> (дата: {rec[1] or '—'})")
         else:
             lines.append(f"— {s}: <b>—</b> (дата: —)")
 
     await update.message.reply_text("\n".join(lines), parse_mode="HTML")
 
 
+def _project_by_folder(folder: str) -> str:
+    """Имя объекта для папки DATA_DIR/<_clean_name(название чата)> прежних xlsx-отчётов."""
+    for name in GROUPS.names():
+        if _clean_name(name) == folder:
+            return name
+    return folder
+
+
+async def export_progress_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /export_progress — Excel с историей прогресса объекта этого чата;
+    /export_progress all (или в личке, только админ) — все объекты со сводным листом.
+    """
+    cid = update.effective_chat.id
+    title = update.effective_chat.title
+    want_all = (bool(context.args) and context.args[0].lower() == "all") or update.effective_chat.type == "private"
+
+    if want_all:
+        if not is_admin_user(update):
+            await update.message.reply_text("⛔️ Выгрузка по всем объектам — только для админов.")
+            return
+        projects = STATE.progress_projects()
+        filename = f"Прогресс_все_объекты_{datetime.now().strftime('%Y-%m-%d')}.xlsx"
+    else:
+        project = _get_project_name_by_chat(cid, title) or title
+        projects = [project] if project in STATE.progress_projects() else []
+        filename = f"Прогресс_{_clean_name(project or 'объект')}_{datetime.now().strftime('%Y-%m-%d')}.xlsx"
+
+    if not projects:
+        await update.message.reply_text("📊 Данных прогресса пока нет.")
+        return
+
+    await update.message.chat.send_action("upload_document")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "progress.xlsx")
+        await asyncio.to_thread(write_progress_workbook, STATE, path, projects)
+        with open(path, "rb") as f:
+            await update.message.reply_document(document=f, filename=filename)
+
+
+async def reload_groups_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически: подхватить изменения groups.json без перезапуска."""
+    await asyncio.to_thread(GROUPS.reload_if_changed)
+
+
+async def reload_groups_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin_user(update):
+        return
+    try:
+        await asyncio.to_thread(GROUPS.reload)
+    except RegistryError as e:
+        lines = "\n".join(f"— {html.escape(err)}" for err in e.errors[:20])
+        await update.message.reply_text(
+            f"❌ <b>groups.json не загружен</b>, работает прежний список:\n{lines}", parse_mode="HTML"
+        )
+        return
+    except OSError as e:
+        await update.message.reply_text(f"❌ Не удалось прочитать {GROUPS_FILE}: {e}")
+        return
+    st = GROUPS.stats()
+    await update.message.reply_text(f"✅ Реестр объектов обновлён: объектов {st['groups']}, систем {st['systems']}")
+
+
+async def warm_up_rag(context: ContextTypes.DEFAULT_TYPE):
+    await rag_engine.warm_up(max_projects=RAG_WARMUP_PROJECTS)
+
+
+async def _post_shutdown(app):
+    await INDEX_SCHEDULER.stop()
+    await LLM.aclose()
+    rag_engine.save_hot_projects()
+    rag_engine.flush_caches()
+    flush_file_ids()
+    STATE.close()
+
+
 def _setup_jobs(app):
     msk_tz = pytz.timezone("Europe/Moscow")
     trigger = CronTrigger(day_of_week="tue,fri", hour=15, minute=0, second=0, timezone=msk_tz)
@@ -1047,26 +1451,47 @@ def _setup_jobs(app):
         name="progress_tue_fri",
     )
 
+    app.job_queue.run_repeating(
+        reload_groups_job,
+        interval=GROUPS_RELOAD_INTERVAL_SECONDS,
+        first=GROUPS_RELOAD_INTERVAL_SECONDS,
+        name="groups_reload",
+    )
+
+    if RAG_WARMUP_PROJECTS > 0:
+        # job_queue стартует вместе с polling — прогрев идёт в фоне, не задерживая запуск
+        app.job_queue.run_once(warm_up_rag, when=RAG_WARMUP_DELAY_SECONDS, name="rag_warmup")
+
 
 def main():
+    global _app
     logger.info("🚀 БОТ ЗАПУЩЕН...")
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    app = ApplicationBuilder().token(TELEGRAM_TOKEN).post_shutdown(_post_shutdown).build()
+    _app = app
 
     rag_engine.configure(data_dir=DATA_DIR)
+    # Загрузка состояния в память; при первом запуске — перенос из JSON и истории из xlsx
+    STATE.open()
+    import_legacy_workbooks(STATE, DATA_DIR, _project_by_folder)
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("test_progress", test_progress))
     app.add_handler(CommandHandler("progress", progress_report_command))
+    app.add_handler(CommandHandler("export_progress", export_progress_command))
     app.add_handler(CommandHandler("set_deadline", start_deadline_setup))
     app.add_handler(CommandHandler("deadlines", show_deadlines_command))
     app.add_handler(CommandHandler("get_id", get_id))
     app.add_handler(CommandHandler("broadcast", broadcast_start))
     app.add_handler(CommandHandler("reload_docs", reload_docs_command))
+    app.add_handler(CommandHandler("rag_stats", rag_stats_command))
+    app.add_handler(CommandHandler("index_status", index_status_command))
+    app.add_handler(CommandHandler("reload_groups", reload_groups_command))
 
     app.add_handler(CallbackQueryHandler(handle_deadline_system, pattern="^deadline_"))
     app.add_handler(CallbackQueryHandler(handle_save_selection, pattern="^save_"))
     app.add_handler(CallbackQueryHandler(broadcast_buttons, pattern="^bc_"))
     app.add_handler(CallbackQueryHandler(handle_progress_button, pattern="^prog:"))
+    app.add_handler(CallbackQueryHandler(handle_full_source, pattern="^src_full:"))
 
     app.add_handler(MessageHandler(filters.PHOTO | filters.VIDEO | filters.Document.ALL, handle_media))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
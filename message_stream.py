@@ -0,0 +1,127 @@
+import time
+import asyncio
+import logging
+from datetime import timedelta
+
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MAX_MESSAGE_LEN = 4096
+# Значок «ещё пишется» в конце сообщения, пока идёт генерация
+STREAM_CURSOR = " ▍"
+
+
+def split_message(text: str, max_len: int = TELEGRAM_MAX_MESSAGE_LEN) -> tuple[str, str]:
+    """(первая часть ≤ max_len, остаток): режем по последнему переводу строки, иначе по лимиту."""
+    if len(text) <= max_len:
+        return text, ""
+    split_at = text.rfind("\n", 0, max_len)
+    if split_at <= 0:
+        split_at = max_len
+    return text[:split_at], text[split_at:].lstrip("\n")
+
+
+def _seconds(retry_after) -> float:
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+class StreamingMessage:
+    """
+    Ответ, который дописывается по мере генерации: первое сообщение — заглушка,
+    дальше edit_message_text не чаще min_interval секунд (лимиты Telegram на правки).
+    Когда текст перерастает 4096 символов, часть закрепляется и продолжение идёт
+    новым сообщением — так же, как режет _send_long_message. Сообщение-продолжение
+    отправляется только когда для него есть непробельный текст. Если правка не прошла
+    (сообщение удалили), текст уходит новым сообщением.
+    """
+
+    def __init__(self, bot, chat_id: int, min_interval: float = 1.5, placeholder: str = "⏳ Готовлю ответ…"):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.min_interval = min_interval
+        self.placeholder = placeholder
+        self.text = ""  # весь полученный текст
+        self._current = ""  # часть текста в текущем сообщении
+        self._shown = ""
+        self._message_id: int | None = None  # None — текущее сообщение ещё не отправлено
+        self._next_edit_at = 0.0
+        self.messages = 0
+        self.edits = 0
+
+    async def _send(self, text: str) -> None:
+        msg = await self.bot.send_message(chat_id=self.chat_id, text=text, disable_web_page_preview=True)
+        self._message_id = msg.message_id
+        self._shown = text
+        self.messages += 1
+        self._next_edit_at = time.monotonic() + self.min_interval
+
+    async def _edit(self, text: str, force: bool = False) -> None:
+        if text == self._shown:
+            return
+        now = time.monotonic()
+        if not force and now < self._next_edit_at:
+            return
+        try:
+            await self.bot.edit_message_text(
+                text=text,
+                chat_id=self.chat_id,
+                message_id=self._message_id,
+                disable_web_page_preview=True,
+            )
+            self._shown = text
+            self.edits += 1
+            self._next_edit_at = time.monotonic() + self.min_interval
+        except RetryAfter as e:
+            delay = _seconds(e.retry_after)
+            logger.warning("Лимит правок Telegram в чате %s, пауза %.0f с", self.chat_id, delay)
+            if force:
+                # Закрывающую правку не теряем
+                await asyncio.sleep(delay)
+                await self._edit(text, force=True)
+            else:
+                self._next_edit_at = time.monotonic() + delay
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return
+            # Сообщение удалено или больше не редактируется — продолжаем новым сообщением
+            logger.warning("Не удалось изменить сообщение %s в чате %s: %s", self._message_id, self.chat_id, e)
+            self._message_id = None
+            await self._send(text)
+
+    async def _show(self, text: str, force: bool = False) -> None:
+        if self._message_id is None:
+            await self._send(text)
+        else:
+            await self._edit(text, force=force)
+
+    async def start(self) -> None:
+        await self._send(self.placeholder)
+
+    async def append(self, delta: str) -> None:
+        if not delta:
+            return
+        self.text += delta
+        self._current += delta
+        while len(self._current) > TELEGRAM_MAX_MESSAGE_LEN:
+            head, rest = split_message(self._current)
+            await self._show(head, force=True)
+            self._current = rest
+            # Продолжение откроется новым сообщением, когда в нём появится текст
+            self._message_id = None
+        if self._current.strip():
+            if len(self._current) + len(STREAM_CURSOR) <= TELEGRAM_MAX_MESSAGE_LEN:
+                await self._show(self._current + STREAM_CURSOR)
+            else:
+                await self._show(self._current)
+
+    async def finish(self, suffix: str = "") -> str:
+        """
+        Последняя правка без курсора; suffix (например, сообщение об ошибке) дописывается в конец.
+        Пустой хвост после разбиения не отправляется; заглушка остаётся, только если текста не было вовсе.
+        """
+        if suffix:
+            await self.append(suffix)
+        if self._current.strip():
+            await self._show(self._current, force=True)
+        return self.text
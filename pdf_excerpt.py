@@ -0,0 +1,124 @@
+"""
+Выдержки из PDF: только страницы, на которые ссылается RAG-ответ.
+
+Вместо многомегабайтного документа в чат уходит маленький PDF из процитированных
+страниц. Готовые выдержки лежат в кэше на диске; ключ — путь, размер и mtime
+исходника плюс набор страниц, поэтому изменённый PDF даёт новую выдержку.
+Кэш ограничен по объёму, старые выдержки удаляются первыми.
+"""
+import os
+import hashlib
+import logging
+import threading
+
+from pypdf import PdfReader, PdfWriter
+
+logger = logging.getLogger(__name__)
+
+EXCERPT_CACHE_MAX_MB = int(os.getenv("RAG_EXCERPT_CACHE_MB", "200"))
+# Если процитирована большая часть документа, выдержка почти не меньше оригинала
+EXCERPT_MAX_SHARE = 0.5
+
+_CACHE_LOCK = threading.Lock()
+
+
+def format_pages(pages: list[int]) -> str:
+    """[3, 5, 6, 7] → "3, 5–7"."""
+    parts: list[str] = []
+    ordered = sorted(set(pages))
+    i = 0
+    while i < len(ordered):
+        j = i
+        while j + 1 < len(ordered) and ordered[j + 1] == ordered[j] + 1:
+            j += 1
+        parts.append(str(ordered[i]) if i == j else f"{ordered[i]}–{ordered[j]}")
+        i = j + 1
+    return ", ".join(parts)
+
+
+def _excerpt_key(source_path: str, pages: list[int]) -> str:
+    st = os.stat(source_path)
+    raw = f"{os.path.abspath(source_path)}|{st.st_size}|{st.st_mtime_ns}|{','.join(map(str, pages))}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _evict(cache_dir: str, keep: str) -> None:
+    """Удаляет самые старые выдержки, пока кэш больше EXCERPT_CACHE_MAX_MB."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not name.endswith(".pdf") or path == keep:
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for _, size, _ in entries) + os.path.getsize(keep)
+    limit = EXCERPT_CACHE_MAX_MB * 1024 * 1024
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def build_excerpt(source_path: str, pages: list[int], cache_dir: str) -> tuple[str, list[int]] | None:
+    """
+    (путь к PDF только из страниц pages, вошедшие страницы) — нумерация с 1, страницы за концом
+    документа отбрасываются. None, если выдержка не имеет смысла (страницы не указаны,
+    покрывают большую часть документа) или не собралась.
+    """
+    pages = sorted({p for p in pages if isinstance(p, int) and p > 0})
+    if not pages:
+        return None
+
+    try:
+        key = _excerpt_key(source_path, pages)
+    except OSError:
+        return None
+    os.makedirs(cache_dir, exist_ok=True)
+    out_path = os.path.join(cache_dir, f"{key}.pdf")
+    if os.path.isfile(out_path):
+        try:
+            # Отбрасываются только страницы за концом документа — вошло столько первых, сколько в выдержке
+            return out_path, pages[:len(PdfReader(out_path).pages)]
+        except Exception as e:
+            logger.warning("Выдержка в кэше не читается, собираем заново %s: %s", out_path, e)
+
+    try:
+        reader = PdfReader(source_path)
+        total_pages = len(reader.pages)
+        pages = [p for p in pages if p <= total_pages]
+        if not pages or len(pages) > total_pages * EXCERPT_MAX_SHARE:
+            return None
+
+        writer = PdfWriter()
+        for p in pages:
+            writer.add_page(reader.pages[p - 1])
+        tmp_path = f"{out_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            writer.write(f)
+        os.replace(tmp_path, out_path)
+    except Exception as e:
+        logger.warning("Не удалось собрать выдержку %s стр. %s: %s", source_path, format_pages(pages), e)
+        return None
+
+    with _CACHE_LOCK:
+        try:
+            _evict(cache_dir, keep=out_path)
+        except OSError as e:
+            logger.warning("Не удалось очистить кэш выдержек: %s", e)
+
+    logger.info(
+        "Выдержка %s стр. %s: %d КБ вместо %d КБ",
+        os.path.basename(source_path),
+        format_pages(pages),
+        os.path.getsize(out_path) // 1024,
+        os.path.getsize(source_path) // 1024,
+    )
+    return out_path, pages
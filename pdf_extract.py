@@ -0,0 +1,212 @@
+"""
+Извлечение текста из PDF, при необходимости — параллельно в пуле процессов,
+и кэш извлечённого текста страниц (gzip JSON по sha256 PDF).
+
+Модуль намеренно лёгкий (только pdfplumber): его функции выполняются в дочерних процессах.
+"""
+import os
+import gzip
+import json
+import logging
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import pdfplumber
+
+logger = logging.getLogger(__name__)
+
+# Версия извлечения: меняется при изменении параметров extract_text — старый кэш страниц игнорируется
+EXTRACTOR_VERSION = 1
+
+# Большие PDF (сметы на сотни страниц) режутся на диапазоны страниц для разных воркеров
+PAGES_PER_TASK = 40
+
+
+def _extract_pages(pdf, start: int, stop: int) -> list[tuple[int, str]]:
+    pages: list[tuple[int, str]] = []
+    for idx in range(start, stop):
+        page = pdf.pages[idx]
+        page_text = page.extract_text(layout=True)
+
+        try:
+            page.flush_cache()
+        except Exception:
+            pass
+
+        if page_text and page_text.strip():
+            pages.append((idx + 1, page_text.strip()))
+    return pages
+
+
+def extract_page_range(file_path: str, start: int, stop: int) -> list[tuple[int, str]]:
+    """Текст страниц [start, stop) (0-based) — [(номер страницы с 1, текст)], пустые пропускаются."""
+    with pdfplumber.open(file_path) as pdf:
+        return _extract_pages(pdf, start, min(stop, len(pdf.pages)))
+
+
+def extract_file(file_path: str) -> tuple[int, list[tuple[int, str]]]:
+    """Весь PDF за один проход: (total_pages, [(номер страницы, текст)])."""
+    with pdfplumber.open(file_path) as pdf:
+        total_pages = len(pdf.pages)
+        return total_pages, _extract_pages(pdf, 0, total_pages)
+
+
+def extract_head(file_path: str) -> tuple[int, list[tuple[int, str]]]:
+    """Число страниц и текст первого диапазона — PDF открывается в воркере, а не в родителе."""
+    with pdfplumber.open(file_path) as pdf:
+        total_pages = len(pdf.pages)
+        return total_pages, _extract_pages(pdf, 0, min(PAGES_PER_TASK, total_pages))
+
+
+class _PendingFile:
+    """PDF в работе у пула: задача extract_head и задачи остальных диапазонов страниц по порядку."""
+
+    __slots__ = ("path", "head", "total_pages", "next_start", "futures")
+
+    def __init__(self, path: str, head: Future):
+        self.path = path
+        self.head = head
+        self.total_pages: int | None = None
+        self.next_start = PAGES_PER_TASK
+        self.futures: list[Future] = []
+
+    def has_more(self) -> bool:
+        """Есть ли ещё не отправленные диапазоны (число страниц известно, когда готов head)."""
+        if self.total_pages is None:
+            if not self.head.done() or self.head.exception() is not None:
+                return False
+            self.total_pages = self.head.result()[0]
+        return self.next_start < self.total_pages
+
+
+def iter_extracted_files(file_paths: list[str], workers: int = 1):
+    """
+    Генератор: (file_path, total_pages, pages | Exception) строго в порядке file_paths.
+
+    workers <= 1 — извлечение в текущем процессе (экономит память на маленьком инстансе).
+    workers > 1  — PDF (и диапазоны страниц больших PDF) раздаются в ProcessPoolExecutor
+    по одной задаче: в полёте (отправлено, но не прочитано) не больше workers * 2 задач,
+    поэтому память ограничена даже на больших проектах. Страницы считает первая задача файла.
+    """
+    if workers <= 1:
+        for file_path in file_paths:
+            try:
+                total_pages, pages = extract_file(file_path)
+            except Exception as e:
+                yield file_path, 0, e
+                continue
+            yield file_path, total_pages, pages
+        return
+
+    max_in_flight = workers * 2
+    files = iter(file_paths)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending: deque[_PendingFile] = deque()
+        in_flight = 0
+
+        def _fill():
+            # Сначала диапазоны более ранних файлов, затем первая задача следующего файла
+            nonlocal in_flight
+            while in_flight < max_in_flight:
+                entry = next((p for p in pending if p.has_more()), None)
+                if entry is not None:
+                    start = entry.next_start
+                    entry.futures.append(pool.submit(extract_page_range, entry.path, start, start + PAGES_PER_TASK))
+                    entry.next_start += PAGES_PER_TASK
+                else:
+                    file_path = next(files, None)
+                    if file_path is None:
+                        return
+                    pending.append(_PendingFile(file_path, pool.submit(extract_head, file_path)))
+                in_flight += 1
+
+        def _collect():
+            nonlocal in_flight
+            entry = pending[0]
+            in_flight -= 1
+            try:
+                total_pages, pages = entry.head.result()
+            except Exception as e:
+                pending.popleft()
+                return entry.path, 0, e
+            entry.total_pages = total_pages
+            pages = list(pages)
+
+            done = 0
+            while True:
+                _fill()
+                if done == len(entry.futures):
+                    if entry.next_start >= total_pages:
+                        break
+                    continue
+                fut = entry.futures[done]
+                done += 1
+                in_flight -= 1
+                try:
+                    pages.extend(fut.result())
+                except Exception as e:
+                    for rest in entry.futures[done:]:
+                        rest.cancel()
+                    in_flight -= len(entry.futures) - done
+                    pending.popleft()
+                    return entry.path, total_pages, e
+
+            pending.popleft()
+            return entry.path, total_pages, pages
+
+        _fill()
+        while pending:
+            yield _collect()
+            _fill()
+
+
+# -------------------- PAGE TEXT CACHE --------------------
+# Извлечённый текст хранится по sha256 содержимого PDF: <cache_dir>/<sha256>.v<N>.json.gz
+# Копии одного PDF в разных объектах используют одну запись.
+def _page_cache_path(cache_dir: str, digest: str) -> str:
+    return os.path.join(cache_dir, f"{digest}.v{EXTRACTOR_VERSION}.json.gz")
+
+
+def has_cached_pages(cache_dir: str, digest: str) -> bool:
+    return os.path.isfile(_page_cache_path(cache_dir, digest))
+
+
+def load_cached_pages(cache_dir: str, digest: str, size: int) -> tuple[int, list[tuple[int, str]]] | None:
+    path = _page_cache_path(cache_dir, digest)
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("Битый кэш страниц %s: %s", path, e)
+        return None
+    if data.get("size") != size:
+        return None
+    return data["total_pages"], [(n, text) for n, text in data["pages"]]
+
+
+def save_cached_pages(cache_dir: str, digest: str, size: int, total_pages: int, pages: list[tuple[int, str]]) -> None:
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _page_cache_path(cache_dir, digest)
+    tmp = f"{path}.tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=6) as f:
+        json.dump({"size": size, "total_pages": total_pages, "pages": pages}, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def clear_page_cache(cache_dir: str, digests: list[str] | None = None) -> int:
+    """Удаляет кэш страниц (всех PDF или только указанных sha256). Возвращает число удалённых файлов."""
+    if not os.path.isdir(cache_dir):
+        return 0
+    wanted = None if digests is None else set(digests)
+    removed = 0
+    for name in os.listdir(cache_dir):
+        if wanted is not None and name.split(".", 1)[0] not in wanted:
+            continue
+        try:
+            os.remove(os.path.join(cache_dir, name))
+            removed += 1
+        except OSError:
+            pass
+    return removed
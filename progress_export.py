@@ -0,0 +1,140 @@
+"""
+Excel-отчёт по прогрессу работ из журнала state_store.
+
+Файл строится по запросу в режиме openpyxl write-only: строки пишутся потоком
+из SQLite, память не зависит от длины истории. Вызывать вне event loop
+(asyncio.to_thread). Прежние DATA_DIR/<Объект>/Прогресс_работ.xlsx один раз
+импортируются в журнал.
+"""
+import os
+import re
+import logging
+from datetime import date, datetime
+from typing import Callable
+
+from openpyxl import Workbook, load_workbook
+
+from state_store import StateStore
+
+logger = logging.getLogger(__name__)
+
+LEGACY_WORKBOOK_NAME = "Прогресс_работ.xlsx"
+LEGACY_IMPORT_MARKER = "progress_xlsx_imported"
+HEADER = ["Дата", "Система", "Процент выполнения, %"]
+SUMMARY_HEADER = ["Объект", "Система", "Последний %", "Дата"]
+
+_SHEET_FORBIDDEN_RE = re.compile(r"[\[\]:*?/\\]")
+_SHEET_TITLE_MAX = 31
+
+
+def _sheet_title(name: str, used: set[str]) -> str:
+    base = _SHEET_FORBIDDEN_RE.sub("_", name).strip("'") or "Объект"
+    title = base[:_SHEET_TITLE_MAX]
+    n = 2
+    while title.lower() in used:
+        suffix = f" ({n})"
+        title = base[: _SHEET_TITLE_MAX - len(suffix)] + suffix
+        n += 1
+    used.add(title.lower())
+    return title
+
+
+def _new_sheet(wb: Workbook, title: str, header: list[str], widths: list[int]):
+    ws = wb.create_sheet(title)
+    for letter, width in zip("ABCD", widths):
+        ws.column_dimensions[letter].width = width
+    ws.append(header)
+    return ws
+
+
+def write_progress_workbook(store: StateStore, path: str, projects: list[str]) -> int:
+    """
+    Пишет отчёт в path: по листу на объект (Дата | Система | %), при нескольких объектах
+    первый лист — сводка последних значений. Возвращает число строк журнала.
+    """
+    wb = Workbook(write_only=True)
+    used: set[str] = set()
+    summary = None
+    if len(projects) > 1:
+        summary = _new_sheet(wb, _sheet_title("Сводка", used), SUMMARY_HEADER, [40, 25, 14, 12])
+
+    rows = 0
+    for project in projects:
+        ws = _new_sheet(wb, _sheet_title(project if summary else "Прогресс", used), HEADER, [12, 25, 22])
+        latest: dict[str, tuple[float, str]] = {}
+        for date_str, system, percent in store.iter_progress_log(project):
+            ws.append([date_str, system, percent])
+            latest[system] = (percent, date_str)
+            rows += 1
+        if summary is not None:
+            for system, (percent, date_str) in latest.items():
+                summary.append([project, system, percent, date_str])
+
+    tmp = f"{path}.tmp"
+    wb.save(tmp)
+    os.replace(tmp, path)
+    logger.info("Отчёт прогресса: %d объектов, %d строк → %s", len(projects), rows, path)
+    return rows
+
+
+def _cell_date(value) -> str | None:
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d")
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value).strip() if value not in (None, "") else None
+
+
+def _cell_percent(value) -> float | None:
+    """Число или строка вида "50", "50%", "50,5"; None — не процент."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.strip().rstrip("%").strip().replace(",", "."))
+        except ValueError:
+            return None
+    return None
+
+
+def import_legacy_workbooks(store: StateStore, data_dir: str, resolve_project: Callable[[str], str]) -> int:
+    """
+    Разовый перенос истории из DATA_DIR/<папка объекта>/Прогресс_работ.xlsx в журнал.
+    resolve_project(папка) → имя объекта в журнале. Файлы не удаляются.
+    Строки с неразборчивыми датой или процентом пропускаются (в лог).
+    Если какой-то файл не читается, не импортируется ничего (повтор при следующем запуске).
+    """
+    if store.has_marker(LEGACY_IMPORT_MARKER):
+        return 0
+
+    rows: list[tuple[str, str, str, float]] = []
+    skipped = 0
+    for folder in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, folder, LEGACY_WORKBOOK_NAME)
+        if not os.path.isfile(path):
+            continue
+        project = resolve_project(folder)
+        try:
+            wb = load_workbook(path, read_only=True)
+            try:
+                for n, row in enumerate(wb.active.iter_rows(min_row=2, max_col=3, values_only=True), start=2):
+                    date_str, system, percent = (tuple(row) + (None, None, None))[:3]
+                    if all(v in (None, "") for v in (date_str, system, percent)):
+                        continue
+                    day, value = _cell_date(date_str), _cell_percent(percent)
+                    if not system or day is None or value is None:
+                        skipped += 1
+                        logger.warning("%s, строка %d пропущена: %r", path, n, row)
+                        continue
+                    rows.append((project, day, str(system), value))
+            finally:
+                wb.close()
+        except Exception as e:
+            # Без отметки об импорте: повторим при следующем запуске, ничего не задублировав
+            logger.error("Не удалось прочитать %s, импорт истории прогресса отложен: %s", path, e)
+            return 0
+
+    store.import_progress_log(LEGACY_IMPORT_MARKER, rows)
+    if rows or skipped:
+        logger.info("Журнал прогресса: импортировано %d строк из прежних xlsx, пропущено %d", len(rows), skipped)
+    return len(rows)
@@ -1,37 +1,182 @@
 import os
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import hashlib
 import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 
-import pdfplumber
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import FAISS
 from langchain_core.documents import Document
 
+from answer_cache import SemanticAnswerCache
+from bm25_index import BM25Index
+from context_packer import TokenCounter, pack_context
+from embedding_cache import CachedEmbeddings
+from embedding_providers import DEFAULT_PROVIDER, create_embeddings
+from index_cache import IndexCache
+from vector_index import ChunkStore, CompactIndex, content_hash, referenced_store_rows, remove_index
+from pdf_extract import (
+    clear_page_cache,
+    has_cached_pages,
+    iter_extracted_files,
+    load_cached_pages,
+    save_cached_pages,
+)
+
 logger = logging.getLogger(__name__)
 
-# Кэш индексов в памяти (ускоряет повторные запросы до рестарта)
-VECTOR_STORES: dict[str, FAISS] = {}
 
-# Embeddings (ключ берется из env OPENAI_API_KEY внутри langchain_openai)
-EMBEDDINGS = OpenAIEmbeddings(model="text-embedding-3-small")
+# Кэш индексов в памяти (ускоряет повторные запросы до рестарта).
+# Ограничен бюджетом RAG_INDEX_CACHE_MB (LRU), проекты из RAG_PINNED_PROJECTS не вытесняются.
+# Считается только память самих индексов: векторы общие (memmap ChunkStore), их держит page cache ОС.
+VECTOR_STORES = IndexCache(
+    max_bytes=int(float(os.getenv("RAG_INDEX_CACHE_MB", "200")) * 1024 * 1024),
+    size_fn=lambda index: index.nbytes,  # номера строк общего хранилища + маска удалённых строк
+)
+for _pinned in filter(None, (p.strip() for p in os.getenv("RAG_PINNED_PROJECTS", "").split(","))):
+    VECTOR_STORES.pin(_pinned)
+
+# Один проект не индексируется/загружается параллельно (RLock: сборка вызывается из загрузки)
+_PROJECT_LOCKS: dict[str, threading.RLock] = {}
+_PROJECT_LOCKS_GUARD = threading.Lock()
+
+# Single-flight для async-загрузки: параллельные вопросы к холодному проекту ждут одну загрузку
+_INDEX_LOADS: dict[str, asyncio.Future] = {}
 
 # Пути (на Render disk обычно /var/data)
 _DATA_DIR = os.path.abspath(os.getenv("DATA_DIR", "/var/data"))
 _BASE_FOLDER = os.path.join(_DATA_DIR, "StroyBot_Files")
 _INDEX_ROOT = os.path.join(_DATA_DIR, "rag_indexes")
 
+# Embeddings: провайдер из RAG_EMBEDDING_PROVIDER (openai — ключ из env OPENAI_API_KEY; local — без сети)
+# Обёрнуты постоянным кэшем для вопросов (поиск, кэш ответов). Чанки эмбеддятся напрямую:
+# их векторы дедуплицирует общее хранилище чанков, второй копии в кэше не нужно
+EMBEDDING_PROVIDER = os.getenv("RAG_EMBEDDING_PROVIDER", DEFAULT_PROVIDER)
+_embedder, EMBEDDING_MODEL = create_embeddings(EMBEDDING_PROVIDER)
+EMBEDDING_CACHE_FILENAME = "embedding_cache.sqlite3"
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("RAG_EMBEDDING_CACHE_MAX_ENTRIES", "50000"))
+EMBEDDINGS = CachedEmbeddings(
+    _embedder,
+    model=EMBEDDING_MODEL,
+    db_path=os.path.join(_DATA_DIR, EMBEDDING_CACHE_FILENAME),
+    max_entries=EMBEDDING_CACHE_MAX_ENTRIES,
+)
+
+# Сборка индекса — конвейер: извлечение/нарезка идут, пока пачки чанков эмбеддятся в потоках.
+# В полёте не больше RAG_EMBED_CONCURRENCY запросов к API и EMBED_QUEUE_FACTOR * их число пачек
+# (backpressure: извлечение ждёт, пока готовые пачки запишутся в индекс).
+EMBED_CONCURRENCY = max(1, int(os.getenv("RAG_EMBED_CONCURRENCY", "4")))
+EMBED_QUEUE_FACTOR = 2
+# Повторы при rate limit / временных ошибках API: экспоненциальная задержка с джиттером
+EMBED_MAX_RETRIES = int(os.getenv("RAG_EMBED_MAX_RETRIES", "5"))
+EMBED_BACKOFF_BASE_SECONDS = 1.0
+EMBED_BACKOFF_MAX_SECONDS = 60.0
+_RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+_RETRYABLE_ERRORS = {"RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError"}
+
+# Извлечение текста PDF: число процессов (1 = без пула, для инстанса на 512 МБ)
+EXTRACT_WORKERS = max(1, int(os.getenv("RAG_EXTRACT_WORKERS", "1")))
+
+# Кэш извлечённого текста страниц (gzip по sha256 PDF): пересборка без повторного pdfplumber
+PAGE_CACHE_DIRNAME = "rag_page_cache"
+
+# Общее хранилище чанков (DATA_DIR/rag_chunks/<модель>/): уникальный текст эмбеддится и хранится один раз,
+# индексы проектов ссылаются на его строки. Открывается лениво.
+CHUNK_STORE_DIRNAME = "rag_chunks"
+_CHUNK_STORE: ChunkStore | None = None
+_CHUNK_STORE_GUARD = threading.Lock()
+# Сборка мусора хранилища идёт, только когда нет сборок индексов: незакоммиченное поколение
+# ссылается на строки, которых ещё нет ни в одном index.json. Запускается после сборки,
+# сменившей поколение (и первой сборки после старта — подбирает мусор прерванных сборок)
+_ACTIVE_BUILDS = 0
+_BUILDS_GUARD = threading.Lock()
+_chunk_gc_pending = True
+
+# Манифест индекса: какие PDF (size/mtime/sha256) дали какие чанки
+# v2: компактный формат vector_index вместо FAISS + pickle
+# v3: индексы проектов ссылаются на общее хранилище чанков (старые индексы пересобираются)
+MANIFEST_FILENAME = "manifest.json"
+MANIFEST_VERSION = 3
 
-def configure(data_dir: str):
+# Лексический индекс BM25 рядом с векторным, свой файл на каждое поколение индекса
+# (rag_indexes/<project>/bm25.<gen>.sqlite3) — переключается вместе с векторами. Открывается лениво.
+BM25_FILENAME = "bm25.{}.sqlite3"
+LEGACY_BM25_FILENAME = "bm25.sqlite3"
+_BM25_INDEXES: dict[str, BM25Index] = {}
+_BM25_GUARD = threading.Lock()
+# Reciprocal Rank Fusion: score = Σ 1 / (RRF_K + rank)
+RRF_K = 60
+
+# Контекст для модели ответа: соседние чанки страницы склеиваются, повторы убираются,
+# всё укладывается в бюджет токенов (tiktoken для модели ответа)
+CONTEXT_MAX_TOKENS = int(os.getenv("RAG_CONTEXT_MAX_TOKENS", "2000"))
+CONTEXT_TOKENIZER_MODEL = "gpt-4o"
+TOKEN_COUNTER = TokenCounter(CONTEXT_TOKENIZER_MODEL)
+
+# Недавно использованные проекты (project -> время последнего вопроса) для прогрева после рестарта
+HOT_PROJECTS_FILENAME = "rag_hot_projects.json"
+HOT_PROJECTS_SAVE_INTERVAL = 60
+_HOT_PROJECTS: dict[str, float] = {}
+_hot_projects_saved_at = 0.0
+
+# Ревизия индекса проекта (растёт при каждом изменении) — ключ валидности кэша ответов
+_INDEX_REVISIONS: dict[str, int] = {}
+
+# Семантический кэш ответов: похожий вопрос к той же ревизии индекса → готовый ответ
+ANSWER_CACHE_FILENAME = "answer_cache.sqlite3"
+ANSWER_CACHE = SemanticAnswerCache(
+    db_path=os.path.join(_DATA_DIR, ANSWER_CACHE_FILENAME),
+    threshold=float(os.getenv("RAG_ANSWER_CACHE_THRESHOLD", "0.95")),
+    ttl_seconds=float(os.getenv("RAG_ANSWER_CACHE_TTL_HOURS", "72")) * 3600,
+    max_entries=int(os.getenv("RAG_ANSWER_CACHE_MAX_ENTRIES", "200")),
+)
+
+
+def configure(data_dir: str, extract_workers: int | None = None):
     """Вызывай на старте приложения."""
-    global _DATA_DIR, _BASE_FOLDER, _INDEX_ROOT
+    global _DATA_DIR, _BASE_FOLDER, _INDEX_ROOT, EXTRACT_WORKERS, _CHUNK_STORE
     _DATA_DIR = os.path.abspath(data_dir)
     _BASE_FOLDER = os.path.join(_DATA_DIR, "StroyBot_Files")
     _INDEX_ROOT = os.path.join(_DATA_DIR, "rag_indexes")
     os.makedirs(_BASE_FOLDER, exist_ok=True)
     os.makedirs(_INDEX_ROOT, exist_ok=True)
+    EMBEDDINGS.set_path(os.path.join(_DATA_DIR, EMBEDDING_CACHE_FILENAME))
+    ANSWER_CACHE.set_path(os.path.join(_DATA_DIR, ANSWER_CACHE_FILENAME))
+    with _CHUNK_STORE_GUARD:
+        if _CHUNK_STORE is not None:
+            _CHUNK_STORE.close()
+        _CHUNK_STORE = None
+    _mark_chunk_gc_pending()
+    _INDEX_REVISIONS.clear()
+    _HOT_PROJECTS.clear()
+    _HOT_PROJECTS.update(_load_hot_projects())
+    if extract_workers is not None:
+        EXTRACT_WORKERS = max(1, extract_workers)
     logger.info(f"RAG base folder: {_BASE_FOLDER}")
 
 
+def set_embedding_provider(provider: str, **options) -> None:
+    """
+    Переключает провайдер эмбеддингов (например, на local при недоступности OpenAI).
+    Индексы, собранные другой моделью, не загружаются и пересобираются при обращении.
+    """
+    global EMBEDDING_PROVIDER, EMBEDDING_MODEL, _CHUNK_STORE
+    embedder, model = create_embeddings(provider, **options)
+    EMBEDDINGS.set_underlying(embedder, model)
+    EMBEDDING_PROVIDER, EMBEDDING_MODEL = provider, model
+    with _CHUNK_STORE_GUARD:
+        if _CHUNK_STORE is not None:
+            _CHUNK_STORE.close()
+        _CHUNK_STORE = None
+    for project_name in VECTOR_STORES.keys():
+        VECTOR_STORES.pop(project_name)
+
+
 def _clean_name(name: str) -> str:
     return "".join([c if c.isalnum() or c in "._- " else "_" for c in name]).strip()
 
@@ -44,6 +189,84 @@ def _project_index_path(project_name: str) -> str:
     return os.path.join(_INDEX_ROOT, _clean_name(project_name))
 
 
+def _chunk_store() -> ChunkStore:
+    global _CHUNK_STORE
+    with _CHUNK_STORE_GUARD:
+        if _CHUNK_STORE is None:
+            _CHUNK_STORE = ChunkStore(os.path.join(_DATA_DIR, CHUNK_STORE_DIRNAME, _clean_name(EMBEDDING_MODEL)))
+        return _CHUNK_STORE
+
+
+def _project_lock(project_name: str) -> threading.RLock:
+    with _PROJECT_LOCKS_GUARD:
+        return _PROJECT_LOCKS.setdefault(project_name, threading.RLock())
+
+
+def _page_cache_dir() -> str:
+    return os.path.join(_DATA_DIR, PAGE_CACHE_DIRNAME)
+
+
+def _iter_pdf_files(files: list[tuple[str, str, str | None]]):
+    """
+    Для списка (abs_path, rel_source, sha256 | None) отдаёт (abs_path, rel_source, docs | Exception)
+    в исходном порядке. docs — Document по одной странице с непустым текстом.
+
+    Страницы берутся из кэша текста (DATA_DIR/rag_page_cache), если PDF уже извлекался;
+    остальные извлекаются в пуле из EXTRACT_WORKERS процессов (см. pdf_extract) и кэшируются.
+    """
+    cache_dir = _page_cache_dir()
+    plan: list[tuple[str, str, str | None, int, bool]] = []
+    for abs_path, rel_source, digest in files:
+        try:
+            size = os.path.getsize(abs_path)
+            if digest is None:
+                digest = _file_sha256(abs_path)
+        except OSError:
+            digest, size = None, -1
+        cached = digest is not None and has_cached_pages(cache_dir, digest)
+        plan.append((abs_path, rel_source, digest, size, cached))
+
+    misses = [p[0] for p in plan if not p[4]]
+    extracted = iter_extracted_files(misses, workers=EXTRACT_WORKERS)
+
+    for abs_path, rel_source, digest, size, cached in plan:
+        result = load_cached_pages(cache_dir, digest, size) if cached else None
+        if result is None and cached:
+            # Кэш оказался битым — извлекаем этот файл отдельно, без пула
+            _, total_pages, pages = next(iter_extracted_files([abs_path], workers=1))
+        elif result is None:
+            file_path, total_pages, pages = next(extracted)
+            assert file_path == abs_path
+        else:
+            total_pages, pages = result
+
+        if isinstance(pages, Exception):
+            yield abs_path, rel_source, pages
+            continue
+
+        if result is None and digest is not None:
+            try:
+                save_cached_pages(cache_dir, digest, size, total_pages, pages)
+            except OSError as e:
+                logger.warning("Не удалось сохранить кэш страниц %s: %s", abs_path, e)
+
+        if not pages:
+            logger.warning("PDF без извлекаемого текста (возможно скан): %s", abs_path)
+
+        docs = [
+            Document(
+                page_content=page_text,
+                metadata={
+                    "source": rel_source,
+                    "page": page_num,
+                    "total_pages": total_pages,
+                },
+            )
+            for page_num, page_text in pages
+        ]
+        yield abs_path, rel_source, docs
+
+
 def iter_pdf_documents(folder_path: str):
     """
     Генератор документов: читает PDF рекурсивно и отдаёт Document по одной странице.
@@ -52,45 +275,225 @@ def iter_pdf_documents(folder_path: str):
     if not os.path.exists(folder_path):
         return
 
+    files: list[tuple[str, str]] = []
+    for root, _, filenames in os.walk(folder_path):
+        for filename in sorted(filenames):
+            if not filename.lower().endswith(".pdf"):
+                continue
+            file_path = os.path.join(root, filename)
+            files.append((file_path, os.path.relpath(file_path, folder_path), None))
+
+    for file_path, _, docs in _iter_pdf_files(files):
+        if isinstance(docs, Exception):
+            logger.error("Ошибка чтения PDF %s: %s", file_path, docs)
+            continue
+        yield from docs
+
+
+# -------------------- MANIFEST --------------------
+def _atomic_write_json(path: str, data: dict) -> None:
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _project_manifest_path(project_name: str) -> str:
+    return os.path.join(_project_index_path(project_name), MANIFEST_FILENAME)
+
+
+def _load_manifest(project_name: str) -> dict | None:
+    path = _project_manifest_path(project_name)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error("Не удалось прочитать манифест %s: %s", path, e)
+        return None
+
+
+def _save_manifest(project_name: str, manifest: dict) -> None:
+    index_path = _project_index_path(project_name)
+    os.makedirs(index_path, exist_ok=True)
+    _atomic_write_json(_project_manifest_path(project_name), manifest)
+    _INDEX_REVISIONS[project_name] = manifest.get("revision", 0)
+
+
+# -------------------- HOT PROJECTS / WARM-UP --------------------
+def _hot_projects_path() -> str:
+    return os.path.join(_DATA_DIR, HOT_PROJECTS_FILENAME)
+
+
+def _load_hot_projects() -> dict[str, float]:
+    path = _hot_projects_path()
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return {str(k): float(v) for k, v in json.load(f).items()}
+    except Exception as e:
+        logger.error("Не удалось прочитать %s: %s", path, e)
+        return {}
+
+
+def flush_caches() -> None:
+    """Сбрасывает отложенные записи кэша эмбеддингов на диск (вызывается при остановке бота)."""
+    try:
+        EMBEDDINGS.flush()
+    except sqlite3.Error as e:
+        logger.error("Не удалось сбросить кэш эмбеддингов: %s", e)
+
+
+def save_hot_projects(snapshot: dict[str, float] | None = None) -> None:
+    """Сохраняет время последнего использования проектов (вызывается и при остановке бота)."""
+    global _hot_projects_saved_at
+    try:
+        _atomic_write_json(_hot_projects_path(), dict(_HOT_PROJECTS) if snapshot is None else snapshot)
+        _hot_projects_saved_at = time.time()
+    except OSError as e:
+        logger.error("Не удалось сохранить горячие проекты: %s", e)
+
+
+def _touch_project(project_name: str) -> dict[str, float] | None:
+    """Отмечает вопрос к проекту. Раз в HOT_PROJECTS_SAVE_INTERVAL возвращает снимок для записи на диск."""
+    global _hot_projects_saved_at
+    now = time.time()
+    _HOT_PROJECTS[project_name] = now
+    if now - _hot_projects_saved_at < HOT_PROJECTS_SAVE_INTERVAL:
+        return None
+    _hot_projects_saved_at = now
+    return dict(_HOT_PROJECTS)
+
+
+def get_hot_projects(limit: int | None = None) -> list[str]:
+    """Проекты от недавно использованных к давним."""
+    ranked = sorted(_HOT_PROJECTS, key=_HOT_PROJECTS.get, reverse=True)
+    return ranked if limit is None else ranked[:limit]
+
+
+def _warm_project(project_name: str) -> str:
+    """Загружает и прогревает индекс проекта. Возвращает статус для лога."""
+    with _project_lock(project_name):
+        index = VECTOR_STORES.peek(project_name)
+        if index is None:
+            estimate = CompactIndex.estimate_nbytes(_project_index_path(project_name))
+            if estimate is None:
+                return "нет индекса на диске"
+            if VECTOR_STORES.total_bytes + estimate > VECTOR_STORES.max_bytes:
+                return "пропущен: не хватает бюджета памяти"
+            index = load_index_if_exists(project_name)
+            if index is None:
+                return "ошибка загрузки"
+    index.warm()
+    return f"ok ({index.ntotal} chunks)"
+
+
+async def warm_up(max_projects: int = 5) -> None:
+    """
+    Фоновый прогрев индексов недавно использованных проектов после рестарта.
+    Не строит отсутствующие индексы и не вытесняет уже загруженные (бюджет VECTOR_STORES).
+    """
+    projects = get_hot_projects(max_projects)
+    if not projects:
+        logger.info("🔥 Прогрев RAG: нет недавно использованных проектов")
+        return
+
+    started = time.perf_counter()
+    logger.info("🔥 Прогрев RAG: %d проектов", len(projects))
+    for i, project_name in enumerate(projects, start=1):
+        t0 = time.perf_counter()
+        try:
+            status = await asyncio.to_thread(_warm_project, project_name)
+        except Exception as e:
+            status = f"ошибка: {e}"
+        logger.info(
+            "🔥 Прогрев %d/%d: %s — %s за %.2f с", i, len(projects), project_name, status, time.perf_counter() - t0
+        )
+    logger.info("🔥 Прогрев RAG завершён за %.2f с", time.perf_counter() - started)
+
+
+def pin_project(project_name: str, pinned: bool = True) -> None:
+    """Закрепляет индекс проекта в памяти (не вытесняется LRU) или снимает закрепление."""
+    if pinned:
+        VECTOR_STORES.pin(project_name)
+    else:
+        VECTOR_STORES.unpin(project_name)
+
+
+def get_cache_stats() -> dict:
+    """Счётчики кэшей RAG: индексы в памяти, эмбеддинги, ответы."""
+    return {
+        "indexes": VECTOR_STORES.stats(),
+        "embeddings": {"hits": EMBEDDINGS.hits, "misses": EMBEDDINGS.misses},
+        "chunk_store": _chunk_store().stats(),
+        "answers": {"hits": ANSWER_CACHE.hits, "misses": ANSWER_CACHE.misses},
+    }
+
+
+def get_index_revision(project_name: str) -> int:
+    """Ревизия индекса проекта из манифеста (0 — индекса ещё нет)."""
+    if project_name not in _INDEX_REVISIONS:
+        _INDEX_REVISIONS[project_name] = (_load_manifest(project_name) or {}).get("revision", 0)
+    return _INDEX_REVISIONS[project_name]
+
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _scan_pdf_files(folder_path: str) -> dict[str, tuple[str, int, int]]:
+    """Все PDF проекта: rel_path -> (abs_path, size, mtime_ns)."""
+    found: dict[str, tuple[str, int, int]] = {}
     for root, _, files in os.walk(folder_path):
         for filename in sorted(files):
             if not filename.lower().endswith(".pdf"):
                 continue
-
             file_path = os.path.join(root, filename)
-            rel_source = os.path.relpath(file_path, folder_path)
-
             try:
-                with pdfplumber.open(file_path) as pdf:
-                    total_pages = len(pdf.pages)
-                    has_text = False
+                st = os.stat(file_path)
+            except OSError as e:
+                logger.error("Не удалось прочитать PDF %s: %s", file_path, e)
+                continue
+            found[os.path.relpath(file_path, folder_path)] = (file_path, st.st_size, st.st_mtime_ns)
+    return found
+
+
+def _remove_legacy_index_files(index_path: str) -> None:
+    """Файлы старого формата (FAISS save_local + pickle docstore, BM25 вне поколений)."""
+    names = ["index.faiss", "index.pkl"] + [LEGACY_BM25_FILENAME + s for s in ("", "-wal", "-shm")]
+    for name in names:
+        try:
+            os.remove(os.path.join(index_path, name))
+        except FileNotFoundError:
+            pass
 
-                    for page_num, page in enumerate(pdf.pages, start=1):
-                        page_text = page.extract_text(layout=True)
 
-                        try:
-                            page.flush_cache()
-                        except Exception:
-                            pass
+def _remove_index_files(index_path: str) -> None:
+    remove_index(index_path)
+    _remove_legacy_index_files(index_path)
 
-                        if not page_text or not page_text.strip():
-                            continue
 
-                        has_text = True
-                        yield Document(
-                            page_content=page_text.strip(),
-                            metadata={
-                                "source": rel_source,
-                                "page": page_num,
-                                "total_pages": total_pages,
-                            },
-                        )
+def _bm25_path(index_path: str, generation: int) -> str:
+    return os.path.join(index_path, BM25_FILENAME.format(generation))
 
-                    if not has_text:
-                        logger.warning("PDF без извлекаемого текста (возможно скан): %s", file_path)
 
-            except Exception as e:
-                logger.error("Ошибка чтения PDF %s: %s", file_path, e)
+def _get_bm25(project_name: str, generation: int) -> BM25Index | None:
+    """BM25 того же поколения, что и векторный индекс читателя (None — файла нет)."""
+    path = _bm25_path(_project_index_path(project_name), generation)
+    with _BM25_GUARD:
+        bm25 = _BM25_INDEXES.get(project_name)
+        if bm25 is None or bm25.path != path:
+            if not os.path.isfile(path):
+                return None
+            # Прежний экземпляр не закрываем: его может дочитывать другой поток (закроется при сборке мусора)
+            bm25 = _BM25_INDEXES[project_name] = BM25Index(path)
+        return bm25
 
 
 def build_index_for_project(
@@ -98,12 +501,71 @@ def build_index_for_project(
     chunk_size: int = 1000,   # увеличено с 600: лучше сохраняет контекст
     chunk_overlap: int = 150, # увеличено с 80: больше связность между чанками
     batch_size: int = 30,
+    full_rebuild: bool = False,
 ):
     """
-    Строит FAISS индекс батчами и сохраняет на диск:
-      /var/data/rag_indexes/<project>/index.faiss + index.pkl
-    Возвращает vectorstore или None.
+    Инкрементально обновляет индекс и сохраняет на диск:
+      /var/data/rag_indexes/<project>/index.json + refs.<gen>.sqlite3 + bm25.<gen>.sqlite3 + manifest.json,
+      векторы и тексты чанков — в общем /var/data/rag_chunks/ (формат — см. vector_index)
+
+    Манифест хранит для каждого PDF size, mtime, sha256 и id его чанков:
+      - новые/изменённые PDF извлекаются и эмбеддятся заново;
+      - чанки удалённых/изменённых PDF удаляются из индекса;
+      - если ничего не изменилось — индекс не трогаем.
+    full_rebuild=True игнорирует манифест и строит индекс с нуля.
+    Изменения пишутся в новое поколение (векторы + BM25), которое становится текущим только
+    после успешной обработки всех пачек; до этого индекс, BM25 и манифест на диске прежние.
+    Возвращает индекс (CompactIndex) или None.
     """
+    global _ACTIVE_BUILDS
+    with _BUILDS_GUARD:
+        _ACTIVE_BUILDS += 1
+    try:
+        with _project_lock(project_name):
+            return _build_index(project_name, chunk_size, chunk_overlap, batch_size, full_rebuild)
+    finally:
+        with _BUILDS_GUARD:
+            _ACTIVE_BUILDS -= 1
+        if _chunk_gc_pending:
+            collect_chunk_garbage()
+
+
+def collect_chunk_garbage() -> int | None:
+    """
+    Освобождает строки общего хранилища, на которые не ссылается текущее поколение ни одного проекта.
+    Возвращает число освобождённых строк или None, если идёт сборка индекса либо произошла ошибка.
+    """
+    global _chunk_gc_pending
+    with _BUILDS_GUARD:
+        if _ACTIVE_BUILDS:
+            return None
+        started = time.perf_counter()
+        try:
+            referenced: set[int] = set()
+            if os.path.isdir(_INDEX_ROOT):
+                for name in os.listdir(_INDEX_ROOT):
+                    path = os.path.join(_INDEX_ROOT, name)
+                    if os.path.isdir(path):
+                        referenced |= referenced_store_rows(path)
+            freed = _chunk_store().collect_garbage(referenced)
+        except Exception as e:
+            logger.error("Сборка мусора хранилища чанков не удалась: %s", e)
+            return None
+        _chunk_gc_pending = False
+    logger.info(
+        "Хранилище чанков: освобождено строк %d, ссылок %d (%.1f с)",
+        freed, len(referenced), time.perf_counter() - started,
+    )
+    return freed
+
+
+def _build_index(
+    project_name: str,
+    chunk_size: int,
+    chunk_overlap: int,
+    batch_size: int,
+    full_rebuild: bool,
+):
     docs_path = _project_docs_path(project_name)
     index_path = _project_index_path(project_name)
 
@@ -113,139 +575,524 @@ def build_index_for_project(
         logger.warning("⚠️ Папка не найдена: %s", docs_path)
         return None
 
+    params = {
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "embedding_model": EMBEDDING_MODEL,
+    }
+
+    # live — текущее поколение на диске; оно не меняется, новая сборка пишется в следующее
+    live: CompactIndex | None = None
+    loaded = _load_manifest(project_name)
+    prev_revision = (loaded or {}).get("revision", 0)
+    manifest = None if full_rebuild else loaded
+    if manifest and manifest.get("version") == MANIFEST_VERSION and manifest.get("params") == params:
+        has_chunks = any(e.get("chunk_ids") for e in manifest.get("files", {}).values())
+        if has_chunks:
+            live = CompactIndex.open(index_path, _chunk_store())
+            if live is None or not os.path.isfile(_bm25_path(index_path, live.generation)):
+                if live is not None:
+                    live.close()
+                live = None
+                manifest = None
+    else:
+        manifest = None
+
+    if manifest is None:
+        manifest = {"version": MANIFEST_VERSION, "params": params, "revision": prev_revision, "files": {}}
+
+    old_files: dict[str, dict] = manifest["files"]
+    new_files: dict[str, dict] = {}
+    changed: list[tuple[str, str, int, int, str]] = []
+
+    for rel, (abs_path, size, mtime_ns) in _scan_pdf_files(docs_path).items():
+        entry = old_files.get(rel)
+        if entry and entry["size"] == size and entry["mtime_ns"] == mtime_ns:
+            new_files[rel] = entry
+            continue
+        try:
+            digest = _file_sha256(abs_path)
+        except OSError as e:
+            logger.error("Ошибка чтения PDF %s: %s", abs_path, e)
+            if entry:
+                new_files[rel] = entry
+            continue
+        if entry and entry["sha256"] == digest:
+            new_files[rel] = {**entry, "size": size, "mtime_ns": mtime_ns}
+            continue
+        changed.append((rel, abs_path, size, mtime_ns, digest))
+
+    changed_rels = {c[0] for c in changed}
+    removed = [rel for rel in old_files if rel not in new_files and rel not in changed_rels]
+
+    if not changed and not removed:
+        if new_files != old_files:
+            manifest["files"] = new_files
+            _save_manifest(project_name, manifest)
+        logger.info("✅ Индекс актуален, изменений нет: %s", project_name)
+        if live is not None:
+            live.close()
+        return VECTOR_STORES.peek(project_name) or load_index_if_exists(project_name)
+
+    stale_ids = [cid for rel in removed for cid in old_files[rel]["chunk_ids"]]
+    stale_ids += [cid for rel in changed_rels if rel in old_files for cid in old_files[rel]["chunk_ids"]]
+
     splitter = RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap,
         separators=["\n\n", "\n", ". ", " ", ""],
     )
 
-    vectorstore = None
     batch: list[Document] = []
-    pdf_count = 0
+    batch_ids: list[str] = []
     chunk_count = 0
-    seen_sources: set[str] = set()
-
-    for doc in iter_pdf_documents(docs_path):
-        src = doc.metadata.get("source", "")
-        if src not in seen_sources:
-            seen_sources.add(src)
-            pdf_count += 1
-
-        splits = splitter.split_documents([doc])
-        # Гарантируем, что source/page сохраняются в каждом чанке
-        for s in splits:
-            s.metadata.setdefault("source", src)
-            batch.append(s)
-
-            if len(batch) >= batch_size:
-                if vectorstore is None:
-                    vectorstore = FAISS.from_documents(documents=batch, embedding=EMBEDDINGS)
-                else:
-                    vectorstore.add_documents(documents=batch)
-                chunk_count += len(batch)
-                batch.clear()
-
-    if batch:
-        if vectorstore is None:
-            vectorstore = FAISS.from_documents(documents=batch, embedding=EMBEDDINGS)
-        else:
-            vectorstore.add_documents(documents=batch)
-        chunk_count += len(batch)
-        batch.clear()
+    reused_count = 0
+    backpressure_seconds = 0.0
+    store = _chunk_store()
+
+    # Новое поколение: копия живых ссылок без чанков удалённых/изменённых PDF (векторы не копируются)
+    # и копия BM25 текущего поколения, либо пустые — при полной сборке
+    if live is not None:
+        writer = live.compact(exclude=stale_ids)
+        live_bm25 = _bm25_path(index_path, live.generation)
+        live.close()
+        bm25 = BM25Index.copy(live_bm25, _bm25_path(index_path, writer.generation))
+        bm25.delete(stale_ids)
+    else:
+        writer = CompactIndex.create(index_path, store)
+        bm25 = BM25Index(_bm25_path(index_path, writer.generation))
+
+    # Пачки в работе, в порядке отправки: (future строк хранилища, chunk ids, метаданные, тексты)
+    in_flight: deque[tuple[Future, list[str], list[dict], list[str]]] = deque()
+    max_in_flight = EMBED_CONCURRENCY * EMBED_QUEUE_FACTOR
+    embed_pool = ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY, thread_name_prefix="rag-embed")
+
+    def _write_oldest():
+        # Запись в индекс — только из этого потока и в порядке пачек (номера строк детерминированы)
+        nonlocal chunk_count, reused_count
+        future, ids, metadatas, texts = in_flight.popleft()
+        rows, reused = future.result()
+        writer.add(ids, rows, metadatas)
+        bm25.add_many(list(zip(ids, texts)))
+        chunk_count += len(ids)
+        reused_count += reused
+
+    def _flush():
+        nonlocal backpressure_seconds
+        if batch:
+            texts = [d.page_content for d in batch]
+            future = embed_pool.submit(_embed_batch, store, texts)
+            in_flight.append((future, list(batch_ids), [d.metadata for d in batch], texts))
+            batch.clear()
+            batch_ids.clear()
+        # Готовые пачки пишем сразу, при переполнении очереди — ждём самую старую
+        while in_flight and in_flight[0][0].done():
+            _write_oldest()
+        if len(in_flight) >= max_in_flight:
+            t0 = time.perf_counter()
+            _write_oldest()
+            backpressure_seconds += time.perf_counter() - t0
+
+    changed_by_rel = {c[0]: c for c in changed}
+    try:
+        for abs_path, rel, pages in _iter_pdf_files([(c[1], c[0], c[4]) for c in changed]):
+            if isinstance(pages, Exception):
+                logger.error("Ошибка чтения PDF %s: %s", abs_path, pages)
+                continue
+            _, _, size, mtime_ns, digest = changed_by_rel[rel]
+
+            chunk_ids: list[str] = []
+            for doc in pages:
+                splits = splitter.split_documents([doc])
+                # Гарантируем, что source/page сохраняются в каждом чанке
+                for s in splits:
+                    s.metadata.setdefault("source", rel)
+                    cid = f"{digest[:16]}:{rel}:{len(chunk_ids)}"
+                    s.metadata["chunk_id"] = cid
+                    chunk_ids.append(cid)
+                    batch.append(s)
+                    batch_ids.append(cid)
+
+                    if len(batch) >= batch_size:
+                        _flush()
+
+            new_files[rel] = {"size": size, "mtime_ns": mtime_ns, "sha256": digest, "chunk_ids": chunk_ids}
 
-    if vectorstore is None:
-        logger.warning("⚠️ Индекс не построен: PDF=%d, chunks=%d", pdf_count, chunk_count)
+        _flush()
+        while in_flight:
+            _write_oldest()
+    except BaseException:
+        # При ошибке (API недоступно после всех повторов) не ждём остальные пачки
+        # и удаляем несостоявшееся поколение: текущие индекс, BM25 и манифест не тронуты
+        embed_pool.shutdown(wait=True, cancel_futures=True)
+        bm25.close()
+        writer.discard()
+        raise
+    embed_pool.shutdown(wait=True)
+
+    manifest["files"] = new_files
+    manifest["revision"] = prev_revision + 1
+    bm25.close()
+
+    if writer.ntotal == 0:
+        writer.discard()
+        VECTOR_STORES.pop(project_name, None)
+        _remove_index_files(index_path)
+        _mark_chunk_gc_pending()
+        _save_manifest(project_name, manifest)
+        ANSWER_CACHE.invalidate(project_name)
+        logger.warning("⚠️ Индекс не построен: PDF=%d, chunks=0", len(new_files))
         return None
 
-    os.makedirs(index_path, exist_ok=True)
-    vectorstore.save_local(index_path)
-    VECTOR_STORES[project_name] = vectorstore
+    # Новое поколение (векторы + BM25) становится текущим атомарно (index.json), старые
+    # поколения и файлы старого формата удаляются. Манифест пишется после: если процесс упадёт
+    # между ними, следующая сборка повторит те же изменения поверх нового поколения.
+    writer.commit()
+    _mark_chunk_gc_pending()
+    total = writer.ntotal
+    writer.close()
+    _remove_legacy_index_files(index_path)
+    _save_manifest(project_name, manifest)
+    ANSWER_CACHE.invalidate(project_name)
+    index = load_index_if_exists(project_name)
+
+    logger.info(
+        "✅ Индекс сохранён: %s (PDF: %d, изменено: %d, удалено: %d, новых chunks: %d, всего: %d)",
+        index_path, len(new_files), len(changed), len(removed), chunk_count, total,
+    )
+    logger.info(
+        "Общее хранилище чанков: переиспользовано %d из %d, всего уникальных %d",
+        reused_count, chunk_count, store.stats()["chunks"],
+    )
+    logger.info("Конвейер эмбеддингов: извлечение ждало запись пачек %.1f с", backpressure_seconds)
+    return index
+
+
+def _mark_chunk_gc_pending() -> None:
+    global _chunk_gc_pending
+    _chunk_gc_pending = True
+
+
+def _retry_delay(error: Exception, attempt: int) -> float | None:
+    """Задержка перед повтором эмбеддинга или None, если ошибка не временная."""
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    if status is not None:
+        retryable = status in _RETRYABLE_STATUS
+    else:
+        retryable = type(error).__name__ in _RETRYABLE_ERRORS or isinstance(error, (TimeoutError, ConnectionError))
+    if not retryable:
+        return None
+    delay = min(EMBED_BACKOFF_MAX_SECONDS, EMBED_BACKOFF_BASE_SECONDS * 2 ** attempt) * random.uniform(0.5, 1.0)
+    try:
+        retry_after = float(getattr(response, "headers", {}).get("retry-after"))
+        delay = max(delay, min(retry_after, EMBED_BACKOFF_MAX_SECONDS))
+    except (TypeError, ValueError):
+        pass
+    return delay
+
+
+def _embed_with_retry(texts: list[str]) -> list[list[float]]:
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        try:
+            # Мимо кэша эмбеддингов: вектор чанка хранится только в общем хранилище
+            return EMBEDDINGS.underlying.embed_documents(texts)
+        except Exception as e:
+            delay = _retry_delay(e, attempt) if attempt < EMBED_MAX_RETRIES else None
+            if delay is None:
+                raise
+            logger.warning("Эмбеддинги: %s, повтор %d/%d через %.1f с", e, attempt + 1, EMBED_MAX_RETRIES, delay)
+            time.sleep(delay)
+
+
+def _embed_batch(store: ChunkStore, texts: list[str]) -> tuple[list[int], int]:
+    """
+    Строки общего хранилища для текстов пачки (выполняется в потоке конвейера).
+    Эмбеддятся только чанки, которых ещё нет в хранилище (ни в этом, ни в других проектах).
+    Возвращает (строки, сколько чанков переиспользовано).
+    """
+    hashes = [content_hash(t) for t in texts]
+    rows = store.lookup(hashes)
+    missing = list({h: t for h, t in zip(hashes, texts) if h not in rows}.items())
+    if missing:
+        vectors = _embed_with_retry([t for _, t in missing])
+        rows.update(store.add([h for h, _ in missing], [t for _, t in missing], vectors))
+    return [rows[h] for h in hashes], len(texts) - len(missing)
 
-    logger.info("✅ Индекс сохранён: %s (PDF: %d, chunks: %d)", index_path, pdf_count, chunk_count)
-    return vectorstore
+
+def invalidate_page_cache(project_name: str | None = None) -> int:
+    """
+    Сбрасывает кэш извлечённого текста: весь или только PDF проекта (по манифесту).
+    Возвращает число удалённых файлов кэша.
+    """
+    if project_name is None:
+        removed = clear_page_cache(_page_cache_dir())
+    else:
+        manifest = _load_manifest(project_name) or {}
+        digests = [e["sha256"] for e in manifest.get("files", {}).values()]
+        removed = clear_page_cache(_page_cache_dir(), digests) if digests else 0
+    logger.info("Кэш текста страниц очищен (%s): %d файлов", project_name or "все проекты", removed)
+    return removed
 
 
 def load_index_if_exists(project_name: str):
     """Пробует загрузить сохранённый индекс с диска, если он есть."""
     index_path = _project_index_path(project_name)
-    if not os.path.isdir(index_path):
+
+    model = ((_load_manifest(project_name) or {}).get("params") or {}).get("embedding_model")
+    if model is not None and model != EMBEDDING_MODEL:
+        logger.warning(f"Индекс {index_path} собран моделью {model}, текущая {EMBEDDING_MODEL}: нужна пересборка")
         return None
 
     try:
-        vs = FAISS.load_local(
-            index_path,
-            EMBEDDINGS,
-            allow_dangerous_deserialization=True,  # load_local использует pickle [web:687]
-        )
-        VECTOR_STORES[project_name] = vs
-        logger.info(f"✅ Индекс загружен с диска: {index_path}")
-        return vs
+        vs = CompactIndex.open(index_path, _chunk_store())
     except Exception as e:
         logger.error(f"Не удалось загрузить индекс {index_path}: {e}")
         return None
+    if vs is None:
+        return None
+
+    VECTOR_STORES[project_name] = vs
+    logger.info(f"✅ Индекс загружен с диска: {index_path} (chunks: {vs.ntotal})")
+    return vs
+
+
+def _load_or_build_index(project_name: str):
+    """Индекс из памяти, с диска или (если его нет) построенный заново. Блокирующий вызов."""
+    vs = VECTOR_STORES.get(project_name)
+    if vs is not None:
+        return vs
+    with _project_lock(project_name):
+        vs = VECTOR_STORES.peek(project_name)
+        if vs is None:
+            vs = load_index_if_exists(project_name) or build_index_for_project(project_name)
+        return vs
+
+
+async def _atouch_project(project_name: str) -> None:
+    snapshot = _touch_project(project_name)
+    if snapshot is not None:
+        # Файл пишется в потоке, а не в event loop
+        await asyncio.to_thread(save_hot_projects, snapshot)
+
+
+async def aget_index(project_name: str):
+    """
+    Async-вариант _load_or_build_index: загрузка/сборка идёт в потоке, event loop не блокируется.
+    Параллельные вызовы для одного холодного проекта ждут одну и ту же загрузку.
+    """
+    await _atouch_project(project_name)
+    vs = VECTOR_STORES.get(project_name)
+    if vs is not None:
+        return vs
+
+    fut = _INDEX_LOADS.get(project_name)
+    if fut is None:
+        fut = asyncio.ensure_future(asyncio.to_thread(_load_or_build_index, project_name))
+        _INDEX_LOADS[project_name] = fut
+        fut.add_done_callback(lambda _: _INDEX_LOADS.pop(project_name, None))
+    # shield: отмена одного ожидающего не должна отменять общую загрузку
+    return await asyncio.shield(fut)
+
+
+async def aget_relevant_context(project_name: str, query: str, k: int = 6, score_threshold: float = 0.35):
+    """
+    Async-вариант get_relevant_context для хендлеров бота.
+    Загрузка индекса (single-flight) и эмбеддинг запроса + поиск выполняются вне event loop.
+    """
+    context_str, source_files, _ = await aretrieve(project_name, query, k, score_threshold)
+    return context_str, list(source_files)
+
+
+async def aretrieve(project_name: str, query: str, k: int = 6, score_threshold: float = 0.35):
+    """Async-вариант retrieve: (context_str, source_files, chunk_ids), source_files — {путь PDF: страницы}."""
+    if not project_name:
+        return None, {}, []
+    index = await aget_index(project_name)
+    if index is None:
+        return None, {}, []
+    return await asyncio.to_thread(_retrieve_from, index, project_name, query, k, score_threshold)
+
+
+def _lookup_answer(project_name: str, query: str) -> tuple[str, dict[str, list[int]]] | None:
+    try:
+        hit = ANSWER_CACHE.lookup(project_name, get_index_revision(project_name), EMBEDDINGS.embed_query(query))
+    except Exception as e:
+        logger.warning("Кэш ответов недоступен: %s", e)
+        return None
+    if hit is None:
+        return None
+    answer, sources = hit
+    logger.info("Ответ из кэша: %s (hits=%d, misses=%d)", project_name, ANSWER_CACHE.hits, ANSWER_CACHE.misses)
+    if isinstance(sources, list):
+        # Ответы, сохранённые до учёта страниц: только пути
+        sources = {p: [] for p in sources}
+    return answer, {p: pages for p, pages in sources.items() if os.path.isfile(p)}
+
+
+def _store_answer(
+    project_name: str, query: str, answer: str, chunk_ids: list[str], source_files: dict[str, list[int]]
+) -> None:
+    try:
+        ANSWER_CACHE.put(
+            project_name,
+            get_index_revision(project_name),
+            query,
+            EMBEDDINGS.embed_query(query),  # уже в кэше эмбеддингов после поиска
+            chunk_ids,
+            source_files,
+            answer,
+        )
+    except Exception as e:
+        logger.warning("Не удалось сохранить ответ в кэш: %s", e)
+
+
+async def aget_cached_answer(project_name: str, query: str) -> tuple[str, dict[str, list[int]]] | None:
+    """
+    (answer, source_files) для семантически близкого вопроса к текущему индексу проекта или None;
+    source_files — {путь PDF: страницы}, как у retrieve.
+    """
+    if not project_name:
+        return None
+    cached = await asyncio.to_thread(_lookup_answer, project_name, query)
+    if cached is not None:
+        # Ответ из кэша — тоже использование проекта (для прогрева после рестарта)
+        await _atouch_project(project_name)
+    return cached
+
+
+async def astore_answer(
+    project_name: str, query: str, answer: str, chunk_ids: list[str], source_files: dict[str, list[int]]
+):
+    """Кладёт ответ LLM в семантический кэш проекта."""
+    if not project_name:
+        return
+    await asyncio.to_thread(_store_answer, project_name, query, answer, chunk_ids, source_files)
+
+
+def _doc_key(doc: Document) -> str:
+    return doc.metadata.get("chunk_id") or f"{doc.metadata.get('source')}:{doc.metadata.get('page')}:{doc.page_content[:64]}"
+
+
+def _fuse_rrf(index, vector_docs: list[Document], lexical_ids: list[str], k: int) -> list[Document]:
+    """Сливает векторный и BM25 рейтинги через Reciprocal Rank Fusion, возвращает top-k документов."""
+    scores: dict[str, float] = {}
+    docs: dict[str, Document] = {}
+
+    for rank, doc in enumerate(vector_docs):
+        key = _doc_key(doc)
+        docs[key] = doc
+        scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank + 1)
+
+    missing = [cid for cid in lexical_ids if cid not in docs]
+    for doc in index.get_by_chunk_ids(missing):
+        docs[doc.metadata["chunk_id"]] = doc
+
+    for rank, cid in enumerate(lexical_ids):
+        if cid in docs:
+            scores[cid] = scores.get(cid, 0.0) + 1.0 / (RRF_K + rank + 1)
+
+    ranked = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [docs[key] for key in ranked]
 
 
 def get_relevant_context(project_name: str, query: str, k: int = 6, score_threshold: float = 0.35):
     """
-    Усиленный RAG-поиск. Возвращает (context_str, source_files).
+    Усиленный RAG-поиск. Возвращает (context_str, source_files) — см. retrieve;
+    source_files — список путей PDF в порядке релевантности (страницы отдаёт retrieve).
+    """
+    context_str, source_files, _ = retrieve(project_name, query, k, score_threshold)
+    return context_str, list(source_files)
+
+
+def retrieve(project_name: str, query: str, k: int = 6, score_threshold: float = 0.35):
+    """
+    Усиленный RAG-поиск. Возвращает (context_str, source_files, chunk_ids);
+    source_files — {полный путь PDF: номера процитированных страниц} в порядке релевантности.
 
     Алгоритм:
       1. MMR (Maximal Marginal Relevance): выбирает k=6 разнообразных релевантных фрагментов
          из 20 кандидатов (lambda=0.7: 70% релевантность + 30% разнообразие).
-      2. Fallback: similarity_search_with_relevance_scores + фильтр по порогу.
+      2. Fallback: similarity_search (косинусная близость) + фильтр по порогу.
+      3. BM25 по инвертированному индексу проекта, слияние с векторным рейтингом через RRF.
+      4. Упаковка: чанки одной страницы склеиваются без перекрытий, повторы убираются,
+         контекст ограничен CONTEXT_MAX_TOKENS (см. context_packer).
 
     Контекст содержит номер страницы и название документа.
     """
     if not project_name:
-        return None, []
+        return None, {}, []
+
+    index = _load_or_build_index(project_name)
+    if index is None:
+        return None, {}, []
+    return _retrieve_from(index, project_name, query, k, score_threshold)
 
-    if project_name not in VECTOR_STORES:
-        if not load_index_if_exists(project_name):
-            if not build_index_for_project(project_name):
-                return None, []
 
-    index = VECTOR_STORES[project_name]
+def _retrieve_from(index: CompactIndex, project_name: str, query: str, k: int, score_threshold: float):
+    """Поиск retrieve по уже полученному индексу (aretrieve не обращается к VECTOR_STORES второй раз)."""
     results: list[Document] = []
 
-    # ── Шаг 1: MMR ──
     try:
-        results = index.max_marginal_relevance_search(
-            query,
-            k=k,
-            fetch_k=max(k * 4, 20),
-            lambda_mult=0.7,
-        )
+        query_vector = EMBEDDINGS.embed_query(query)
     except Exception as exc:
-        logger.warning("MMR недоступен (%s), fallback → similarity_search", exc)
+        # Без эмбеддинга остаётся только BM25 (Шаг 3)
+        logger.warning("Эмбеддинг запроса недоступен (%s), только лексический поиск", exc)
+        query_vector = None
 
-    # ── Шаг 2: Fallback ──
-    if not results:
+    # ── Шаг 1: MMR ──
+    if query_vector is not None:
         try:
-            scored = index.similarity_search_with_relevance_scores(query, k=k + 4)
-            results = [doc for doc, score in scored if score >= score_threshold][:k]
-        except Exception:
-            results = index.similarity_search(query, k=k)
+            rows = index.max_marginal_relevance_search(
+                query_vector,
+                k=k,
+                fetch_k=max(k * 4, 20),
+                lambda_mult=0.7,
+            )
+            results = index.get_documents(rows)
+        except Exception as exc:
+            logger.warning("MMR недоступен (%s), fallback → similarity_search", exc)
+
+    # ── Шаг 2: Fallback: косинусная близость + фильтр по порогу ──
+    if not results and query_vector is not None:
+        scored = index.similarity_search(query_vector, k=k + 4)
+        results = index.get_documents([row for row, score in scored if score >= score_threshold][:k])
+
+    # ── Шаг 3: BM25 + Reciprocal Rank Fusion (точные идентификаторы: "СП 17.13330", "узел 3.2") ──
+    try:
+        bm25 = _get_bm25(project_name, index.generation)
+        lexical = bm25.search(query, k=k * 2) if bm25 is not None else []
+    except Exception as exc:
+        logger.warning("BM25 недоступен (%s), только векторный поиск", exc)
+        lexical = []
+    if lexical:
+        results = _fuse_rrf(index, results, [cid for cid, _ in lexical], k)
 
     if not results:
-        return None, []
+        return None, {}, []
 
     docs_path = _project_docs_path(project_name)
-    seen_sources: list[str] = []
-    source_files: list[str] = []
-    context_parts: list[str] = []
+    source_files: dict[str, list[int]] = {}
+    chunk_ids = [doc.metadata["chunk_id"] for doc in results if doc.metadata.get("chunk_id")]
 
     for doc in results:
         source = doc.metadata.get("source", "unknown")
-        page = doc.metadata.get("page", "?")
-        context_parts.append(
-            f"——— [{source}] стр. {page} ———\n{doc.page_content}"
-        )
-        if source != "unknown" and source not in seen_sources:
-            seen_sources.append(source)
-            full_path = os.path.join(docs_path, source)
-            if os.path.isfile(full_path):
-                source_files.append(full_path)
+        if source == "unknown":
+            continue
+        full_path = os.path.join(docs_path, source)
+        if full_path not in source_files:
+            if not os.path.isfile(full_path):
+                continue
+            source_files[full_path] = []
+        page = doc.metadata.get("page")
+        if isinstance(page, int) and page not in source_files[full_path]:
+            source_files[full_path].append(page)
+
+    for pages in source_files.values():
+        pages.sort()
 
-    return "\n\n".join(context_parts), source_files
+    context_str, tokens = pack_context(results, CONTEXT_MAX_TOKENS, TOKEN_COUNTER)
+    logger.info("RAG-контекст: %s — %d чанков → %d токенов", project_name, len(results), tokens)
+    return context_str, source_files, chunk_ids
 
 
@@ -0,0 +1,223 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore:
+    """
+    Состояние бота: сроки работ, последний прогресс по системам чатов и журнал
+    всех ответов опросов прогресса (только добавление; из него строится Excel-отчёт).
+
+    Сроки и прогресс держатся в памяти (чтение — словарь, без диска), изменения сразу пишутся
+    в SQLite (WAL) построчным upsert — запись не растёт с историей.
+    При первом открытии данные переносятся из старых deadlines.json / progress_state.json,
+    сами файлы переименовываются в *.migrated.
+    """
+
+    def __init__(self, db_path: str, legacy_deadlines: str | None = None, legacy_progress: str | None = None):
+        self.db_path = db_path
+        self.legacy_deadlines = legacy_deadlines
+        self.legacy_progress = legacy_progress
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        # chat_id -> {система: "ДД.ММ.ГГГГ"}
+        self._deadlines: dict[int, dict[str, str]] = {}
+        # chat_id -> {система: (last_percent, last_date)}
+        self._progress: dict[int, dict[str, tuple[float, str | None]]] = {}
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            with self._lock:
+                if self._conn is None:
+                    self._open()
+        return self._conn
+
+    def open(self) -> None:
+        """Открывает базу и загружает состояние в память (иначе — при первом обращении)."""
+        self._db()
+
+    def _open(self) -> None:
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS deadlines ("
+            " chat_id INTEGER NOT NULL,"
+            " system TEXT NOT NULL,"
+            " date TEXT NOT NULL,"
+            " PRIMARY KEY (chat_id, system))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS progress ("
+            " chat_id INTEGER NOT NULL,"
+            " system TEXT NOT NULL,"
+            " last_percent REAL NOT NULL,"
+            " last_date TEXT,"
+            " PRIMARY KEY (chat_id, system))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS progress_log ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " project TEXT NOT NULL,"
+            " chat_id INTEGER,"
+            " date TEXT NOT NULL,"
+            " system TEXT NOT NULL,"
+            " percent REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS progress_log_project ON progress_log(project, date)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        conn.commit()
+
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone() is None:
+            self._migrate_json(conn)
+
+        for chat_id, system, date in conn.execute("SELECT chat_id, system, date FROM deadlines"):
+            self._deadlines.setdefault(chat_id, {})[system] = date
+        for chat_id, system, percent, date in conn.execute(
+            "SELECT chat_id, system, last_percent, last_date FROM progress"
+        ):
+            self._progress.setdefault(chat_id, {})[system] = (percent, date)
+        self._conn = conn
+
+    def _migrate_json(self, conn: sqlite3.Connection) -> None:
+        """
+        Одноразовый перенос из JSON-файлов прежней версии. Если файл не читается,
+        он остаётся на месте, перенос повторится при следующем запуске
+        (INSERT OR IGNORE — уже сохранённые в базе значения не затираются).
+        """
+        deadlines = self._read_legacy(self.legacy_deadlines)
+        progress = self._read_legacy(self.legacy_progress)
+        complete = deadlines is not None and progress is not None
+        deadlines = deadlines or {}
+        progress = progress or {}
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO deadlines (chat_id, system, date) VALUES (?, ?, ?)",
+                [(int(chat), system, date) for chat, systems in deadlines.items() for system, date in systems.items()],
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO progress (chat_id, system, last_percent, last_date) VALUES (?, ?, ?, ?)",
+                [
+                    (int(chat), system, float(rec.get("last_percent", 0)), rec.get("last_date"))
+                    for chat, systems in progress.items()
+                    for system, rec in systems.items()
+                ],
+            )
+            if complete:
+                conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', '1')")
+        if not complete:
+            return
+
+        for path, data in ((self.legacy_deadlines, deadlines), (self.legacy_progress, progress)):
+            if data:
+                try:
+                    os.replace(path, f"{path}.migrated")
+                except OSError as e:
+                    logger.warning("Не удалось переименовать %s: %s", path, e)
+        if deadlines or progress:
+            logger.info(
+                "Состояние перенесено из JSON: сроки для %d чатов, прогресс для %d чатов", len(deadlines), len(progress)
+            )
+
+    @staticmethod
+    def _read_legacy(path: str | None) -> dict | None:
+        if not path or not os.path.exists(path):
+            return {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error("JSON read error %s: %s", path, e)
+            return None
+
+    # ---- сроки ----
+    def deadlines(self, chat_id: int) -> dict[str, str]:
+        self._db()
+        return dict(self._deadlines.get(chat_id, {}))
+
+    def set_deadline(self, chat_id: int, system: str, date_str: str) -> None:
+        db = self._db()
+        with self._lock:
+            with db:
+                db.execute(
+                    "INSERT INTO deadlines (chat_id, system, date) VALUES (?, ?, ?)"
+                    " ON CONFLICT(chat_id, system) DO UPDATE SET date = excluded.date",
+                    (chat_id, system, date_str),
+                )
+            self._deadlines.setdefault(chat_id, {})[system] = date_str
+
+    # ---- прогресс ----
+    def progress(self, chat_id: int) -> dict[str, tuple[float, str | None]]:
+        """{система: (последний процент, дата)} чата."""
+        self._db()
+        return dict(self._progress.get(chat_id, {}))
+
+    def get_progress(self, chat_id: int, system: str) -> tuple[float, str | None]:
+        self._db()
+        return self._progress.get(chat_id, {}).get(system, (0.0, None))
+
+    def set_progress(self, chat_id: int, values: dict[str, float], date_str: str, project: str | None = None) -> None:
+        """Последние значения опроса по системам (+ запись в журнал объекта project) — одной транзакцией."""
+        db = self._db()
+        with self._lock:
+            with db:
+                db.executemany(
+                    "INSERT INTO progress (chat_id, system, last_percent, last_date) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT(chat_id, system) DO UPDATE"
+                    " SET last_percent = excluded.last_percent, last_date = excluded.last_date",
+                    [(chat_id, system, float(value), date_str) for system, value in values.items()],
+                )
+                if project:
+                    db.executemany(
+                        "INSERT INTO progress_log (project, chat_id, date, system, percent) VALUES (?, ?, ?, ?, ?)",
+                        [(project, chat_id, date_str, system, float(value)) for system, value in values.items()],
+                    )
+            chat = self._progress.setdefault(chat_id, {})
+            for system, value in values.items():
+                chat[system] = (float(value), date_str)
+
+    # ---- журнал прогресса ----
+    def has_marker(self, key: str) -> bool:
+        db = self._db()
+        with self._lock:
+            return db.execute("SELECT 1 FROM meta WHERE key = ?", (key,)).fetchone() is not None
+
+    def import_progress_log(self, marker: str, rows: list[tuple[str, str, str, float]]) -> None:
+        """Разовый импорт истории (project, date, system, percent); marker отмечает, что импорт сделан."""
+        db = self._db()
+        with self._lock:
+            with db:
+                db.executemany(
+                    "INSERT INTO progress_log (project, date, system, percent) VALUES (?, ?, ?, ?)", rows
+                )
+                db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, '1')", (marker,))
+
+    def progress_projects(self) -> list[str]:
+        db = self._db()
+        with self._lock:
+            return [r[0] for r in db.execute("SELECT DISTINCT project FROM progress_log ORDER BY project")]
+
+    def iter_progress_log(self, project: str):
+        """
+        Строки журнала объекта (date, system, percent) по дате. Читает отдельное соединение
+        (WAL: не мешает записи), поэтому годится для потоковой выгрузки из другого потока.
+        """
+        self._db()
+        conn = sqlite3.connect(self.db_path)
+        try:
+            yield from conn.execute(
+                "SELECT date, system, percent FROM progress_log WHERE project = ? ORDER BY date, id", (project,)
+            )
+        finally:
+            conn.close()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,520 @@
+"""
+Компактный формат индексов без pickle с общим контентно-адресуемым хранилищем чанков.
+
+Общее хранилище (ChunkStore, DATA_DIR/rag_chunks/<модель эмбеддингов>/):
+  store.json      — размерность векторов
+  vectors.f16     — нормированные векторы float16, строка за строкой (np.memmap)
+  chunks.sqlite3  — sha256 текста чанка → номер строки и текст; свободные строки (free_rows)
+
+Одинаковый чанк (норматив, скопированный в несколько объектов) эмбеддится и хранится один раз.
+Строки, на которые не ссылается ни один проект, освобождает collect_garbage(); их место занимают
+следующие чанки, хвост vectors.f16 из свободных строк обрезается при открытии хранилища.
+
+Каталог индекса проекта (CompactIndex):
+  index.json          — текущее поколение и число строк (меняется атомарно)
+  refs.<gen>.sqlite3  — chunk_id → строка общего хранилища, метаданные, флаг удаления
+  bm25.<gen>.sqlite3  — лексический индекс того же поколения (bm25_index, пишет rag_engine)
+
+Сборка пишет только в новое поколение; текущее на диске не меняется до commit().
+
+Загрузка почти мгновенная: векторы не читаются в RAM, а подгружаются ОС по требованию,
+тексты достаются из SQLite только для найденных строк. Никакого pickle.
+"""
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+import threading
+
+import numpy as np
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+INDEX_META_FILENAME = "index.json"
+STORE_META_FILENAME = "store.json"
+# Скалярное произведение считается блоками, чтобы не поднимать весь memmap во float32
+_SCORE_BLOCK_ROWS = 8192
+# RAM индекса на строку: номер строки общего хранилища (int64) + флаг живой строки (bool)
+_ROW_NBYTES = 8 + 1
+# Файлы поколений проекта; vectors/chunks — формат до общего хранилища (удаляются вместе с остальными)
+_GENERATION_FILES = ("refs.{}.sqlite3", "bm25.{}.sqlite3", "vectors.{}.f16", "chunks.{}.sqlite3")
+
+
+def content_hash(text: str) -> str:
+    """Ключ чанка в общем хранилище."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _batches(items: list, size: int = 500):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class ChunkStore:
+    """
+    Общее для всех проектов хранилище уникальных чанков: текст + нормированный вектор по sha256 текста.
+
+    Номер строки — стабильная ссылка для индексов проектов: строки не перенумеровываются.
+    collect_garbage() освобождает строки без ссылок, add() заполняет освобождённые раньше,
+    чем дописывает новые, поэтому файлы не растут от пересборок. Файл vectors.f16 во время работы
+    не укорачивается (его отображают открытые memmap), хвост из свободных строк обрезается в __init__.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.dim: int | None = None
+        self.rows = 0
+        self._vectors: np.memmap | None = None
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(path, "chunks.sqlite3"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " row INTEGER PRIMARY KEY,"
+            " hash TEXT UNIQUE NOT NULL,"
+            " text TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS free_rows (row INTEGER PRIMARY KEY)")
+        self._conn.commit()
+        try:
+            with open(os.path.join(path, STORE_META_FILENAME), "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+        except FileNotFoundError:
+            pass
+        self._trim_free_tail()
+        self._map_vectors()
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.path, "vectors.f16")
+
+    def _trim_free_tail(self) -> None:
+        # Файл ещё не отображён в память: свободные строки в конце можно отрезать
+        (live_rows,) = self._conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM chunks").fetchone()
+        self._conn.execute("DELETE FROM free_rows WHERE row >= ?", (live_rows,))
+        self._conn.commit()
+        if self.dim is not None and os.path.exists(self._vectors_path):
+            if os.path.getsize(self._vectors_path) > live_rows * self.dim * 2:
+                with open(self._vectors_path, "r+b") as f:
+                    f.truncate(live_rows * self.dim * 2)
+
+    def _map_vectors(self) -> None:
+        if self.dim is None or not os.path.exists(self._vectors_path):
+            return
+        # Строки без записи в SQLite (оборванная дозапись) не видны: add() их перезапишет
+        (self.rows,) = self._conn.execute(
+            "SELECT COALESCE(MAX(row) + 1, 0) FROM"
+            " (SELECT MAX(row) AS row FROM chunks UNION ALL SELECT MAX(row) FROM free_rows)"
+        ).fetchone()
+        self._vectors = (
+            np.memmap(self._vectors_path, dtype=np.float16, mode="r", shape=(self.rows, self.dim))
+            if self.rows else None
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+            self._vectors = None
+
+    def lookup(self, hashes: list[str]) -> dict[str, int]:
+        """sha256 → номер строки для уже сохранённых чанков."""
+        found: dict[str, int] = {}
+        with self._lock:
+            for part in _batches(list(set(hashes))):
+                marks = ",".join("?" * len(part))
+                found.update(self._conn.execute(f"SELECT hash, row FROM chunks WHERE hash IN ({marks})", part))
+        return found
+
+    def add(self, hashes: list[str], texts: list[str], vectors: list[list[float]]) -> dict[str, int]:
+        """Дописывает чанки, которых ещё нет. Возвращает sha256 → номер строки для всех hashes."""
+        mat = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(mat, axis=1, keepdims=True)
+        mat = mat / np.where(norms == 0, 1, norms)
+
+        with self._lock:
+            if self.dim is None:
+                tmp = os.path.join(self.path, f"{STORE_META_FILENAME}.tmp")
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump({"dim": int(mat.shape[1])}, f)
+                os.replace(tmp, os.path.join(self.path, STORE_META_FILENAME))
+                self.dim = int(mat.shape[1])
+            if mat.ndim != 2 or mat.shape[1] != self.dim:
+                raise ValueError(f"Ожидалась размерность {self.dim}, получено {mat.shape}")
+
+            rows = self.lookup(hashes)
+            new: list[int] = []
+            for i, h in enumerate(hashes):
+                if h not in rows:
+                    rows[h] = -1
+                    new.append(i)
+            if not new:
+                return rows
+
+            # Сначала свободные строки, остальное — в конец файла
+            free = [
+                r for (r,) in self._conn.execute(
+                    "SELECT row FROM free_rows WHERE row < ? ORDER BY row LIMIT ?", (self.rows, len(new))
+                )
+            ]
+            slots = free + list(range(self.rows, self.rows + len(new) - len(free)))
+            for i, slot in zip(new, slots):
+                rows[hashes[i]] = slot
+            vectors = mat[new].astype(np.float16)
+
+            # Вектор пишется до записи в SQLite: после сбоя строка остаётся свободной
+            if free:
+                with open(self._vectors_path, "r+b") as f:
+                    for slot, vector in zip(free, vectors):
+                        f.seek(slot * self.dim * 2)
+                        f.write(vector.tobytes())
+            if len(new) > len(free):
+                with open(self._vectors_path, "ab") as f:
+                    f.truncate(self.rows * self.dim * 2)
+                    f.write(vectors[len(free):].tobytes())
+            self._conn.executemany(
+                "INSERT INTO chunks (row, hash, text) VALUES (?, ?, ?)",
+                [(rows[hashes[i]], hashes[i], texts[i]) for i in new],
+            )
+            self._conn.executemany("DELETE FROM free_rows WHERE row = ?", [(r,) for r in free])
+            self._conn.commit()
+            self._map_vectors()
+        return rows
+
+    def vectors(self, rows: np.ndarray) -> np.ndarray:
+        """Векторы строк во float32 (строки, дописанные другими проектами, подхватываются)."""
+        with self._lock:
+            if len(rows) and int(rows.max()) >= self.rows:
+                self._map_vectors()
+            vectors = self._vectors
+        if vectors is None:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.asarray(vectors[rows], dtype=np.float32)
+
+    def texts(self, rows: list[int]) -> dict[int, str]:
+        found: dict[int, str] = {}
+        with self._lock:
+            for part in _batches(rows):
+                marks = ",".join("?" * len(part))
+                found.update(self._conn.execute(f"SELECT row, text FROM chunks WHERE row IN ({marks})", part))
+        return found
+
+    def collect_garbage(self, referenced: set[int]) -> int:
+        """
+        Освобождает строки, которых нет в referenced (текст удаляется, место вектора займёт add()).
+        Возвращает число освобождённых строк.
+        """
+        with self._lock:
+            garbage = [r for (r,) in self._conn.execute("SELECT row FROM chunks") if r not in referenced]
+            if not garbage:
+                return 0
+            for part in _batches(garbage):
+                marks = ",".join("?" * len(part))
+                self._conn.execute(f"DELETE FROM chunks WHERE row IN ({marks})", part)
+            self._conn.executemany("INSERT OR IGNORE INTO free_rows (row) VALUES (?)", [(r,) for r in garbage])
+            self._conn.commit()
+        return len(garbage)
+
+    def stats(self) -> dict:
+        with self._lock:
+            (chunks,) = self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()
+        return {"chunks": chunks, "free": self.rows - chunks, "bytes": self.rows * (self.dim or 0) * 2}
+
+
+def _refs_path(path: str, generation: int) -> str:
+    return os.path.join(path, f"refs.{generation}.sqlite3")
+
+
+def referenced_store_rows(path: str) -> set[int]:
+    """Строки общего хранилища, на которые ссылаются живые чанки текущего поколения индекса в path."""
+    meta = _read_meta(path)
+    if meta is None or "rows" not in meta:
+        return set()
+    conn = sqlite3.connect(f"file:{_refs_path(path, meta['generation'])}?mode=ro", uri=True)
+    try:
+        return {
+            r for (r,) in conn.execute(
+                "SELECT store_row FROM chunks WHERE deleted = 0 AND row < ?", (meta["rows"],)
+            )
+        }
+    finally:
+        conn.close()
+
+
+def _existing_generations(path: str) -> set[int]:
+    gens: set[int] = set()
+    if not os.path.isdir(path):
+        return gens
+    for name in os.listdir(path):
+        parts = name.split(".")
+        if len(parts) >= 3 and parts[0] in ("refs", "bm25", "vectors", "chunks") and parts[1].isdigit():
+            gens.add(int(parts[1]))
+    return gens
+
+
+def _read_meta(path: str) -> dict | None:
+    try:
+        with open(os.path.join(path, INDEX_META_FILENAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _remove_generation(path: str, generation: int) -> None:
+    for pattern in _GENERATION_FILES:
+        for suffix in ("", "-journal", "-wal", "-shm"):
+            try:
+                os.remove(os.path.join(path, pattern.format(generation)) + suffix)
+            except FileNotFoundError:
+                pass
+
+
+def remove_index(path: str) -> None:
+    """Удаляет все файлы индекса проекта в каталоге (manifest и прочее не трогает)."""
+    try:
+        os.remove(os.path.join(path, INDEX_META_FILENAME))
+    except FileNotFoundError:
+        pass
+    for gen in _existing_generations(path):
+        _remove_generation(path, gen)
+
+
+class CompactIndex:
+    """
+    Векторный индекс проекта: ссылки на строки ChunkStore + метаданные в SQLite.
+
+    Поиск — косинусная близость (векторы нормированы), плюс MMR.
+    Удаление — пометка строк (tombstone), место возвращает compact().
+    Изменения пишутся в новое поколение (create() или compact() текущего) и становятся видны
+    через commit() и open(). Текущее поколение не меняется, поэтому открытые читатели
+    и прерванная сборка не видят половину изменений.
+    """
+
+    def __init__(self, path: str, generation: int, store: ChunkStore, rows: int | None = None):
+        self.path = path
+        self.generation = generation
+        self.store = store
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(_refs_path(path, generation), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " row INTEGER PRIMARY KEY,"
+            " chunk_id TEXT NOT NULL,"
+            " store_row INTEGER NOT NULL,"
+            " metadata TEXT NOT NULL,"
+            " deleted INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS chunks_chunk_id ON chunks(chunk_id)")
+        self._conn.commit()
+        self._load_rows(rows)
+
+    # -------------------- OPEN / CREATE --------------------
+    @classmethod
+    def open(cls, path: str, store: ChunkStore) -> "CompactIndex | None":
+        meta = _read_meta(path)
+        if meta is None or "rows" not in meta or not os.path.isfile(_refs_path(path, meta["generation"])):
+            return None
+        return cls(path, meta["generation"], store, rows=meta["rows"])
+
+    @classmethod
+    def create(cls, path: str, store: ChunkStore) -> "CompactIndex":
+        """Новое пустое поколение. Текущим станет только после commit()."""
+        os.makedirs(path, exist_ok=True)
+        gens = _existing_generations(path)
+        meta = _read_meta(path)
+        if meta:
+            gens.add(meta["generation"])
+        return cls(path, max(gens, default=0) + 1, store)
+
+    @staticmethod
+    def estimate_nbytes(path: str) -> int | None:
+        """nbytes индекса по index.json, без открытия (None — индекса нет)."""
+        meta = _read_meta(path)
+        if meta is None or "rows" not in meta:
+            return None
+        return meta["rows"] * _ROW_NBYTES
+
+    def commit(self) -> None:
+        """Делает это поколение текущим и удаляет файлы остальных поколений."""
+        tmp = os.path.join(self.path, f"{INDEX_META_FILENAME}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"generation": self.generation, "rows": self.rows}, f)
+        os.replace(tmp, os.path.join(self.path, INDEX_META_FILENAME))
+        for gen in _existing_generations(self.path) - {self.generation}:
+            _remove_generation(self.path, gen)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def discard(self) -> None:
+        """Закрывает и удаляет несостоявшееся поколение (сборка прервана до commit())."""
+        self.close()
+        _remove_generation(self.path, self.generation)
+
+    def _load_rows(self, limit: int | None = None) -> None:
+        # Открытое поколение читается ровно в пределах index.json
+        if limit is None:
+            refs = self._conn.execute("SELECT store_row, deleted FROM chunks ORDER BY row").fetchall()
+        else:
+            refs = self._conn.execute(
+                "SELECT store_row, deleted FROM chunks WHERE row < ? ORDER BY row", (limit,)
+            ).fetchall()
+        self._store_rows = np.asarray([r[0] for r in refs], dtype=np.int64)
+        self._alive = np.asarray([not r[1] for r in refs], dtype=bool)
+
+    # -------------------- STATS --------------------
+    @property
+    def rows(self) -> int:
+        return len(self._store_rows)
+
+    @property
+    def ntotal(self) -> int:
+        """Число живых (не удалённых) чанков."""
+        return int(self._alive.sum())
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Память, которой владеет индекс: номера строк хранилища + маска удалённых.
+        Векторы лежат в общем memmap ChunkStore (page cache ОС, общий для проектов) и сюда не входят.
+        """
+        return self.rows * _ROW_NBYTES
+
+    def warm(self) -> None:
+        """Прогревает page cache: читает векторы проекта тем же путём, что и поиск."""
+        for start in range(0, self.rows, _SCORE_BLOCK_ROWS):
+            self.store.vectors(self._store_rows[start:start + _SCORE_BLOCK_ROWS]).sum()
+
+    # -------------------- WRITE --------------------
+    def add(self, chunk_ids: list[str], store_rows: list[int], metadatas: list[dict]) -> None:
+        with self._lock:
+            # Повторное добавление того же chunk_id заменяет старую строку
+            self._mark_deleted(chunk_ids)
+            start = self.rows
+            self._conn.executemany(
+                "INSERT INTO chunks (row, chunk_id, store_row, metadata) VALUES (?, ?, ?, ?)",
+                [
+                    (start + i, cid, srow, json.dumps(meta, ensure_ascii=False))
+                    for i, (cid, srow, meta) in enumerate(zip(chunk_ids, store_rows, metadatas))
+                ],
+            )
+            self._conn.commit()
+            self._store_rows = np.concatenate([self._store_rows, np.asarray(store_rows, dtype=np.int64)])
+            self._alive = np.concatenate([self._alive, np.ones(len(store_rows), dtype=bool)])
+
+    def _mark_deleted(self, chunk_ids: list[str]) -> None:
+        for part in _batches(chunk_ids):
+            marks = ",".join("?" * len(part))
+            rows = [
+                r for (r,) in self._conn.execute(
+                    f"SELECT row FROM chunks WHERE deleted = 0 AND chunk_id IN ({marks})", part
+                )
+            ]
+            if not rows:
+                continue
+            self._conn.execute(f"UPDATE chunks SET deleted = 1 WHERE row IN ({','.join('?' * len(rows))})", rows)
+            self._alive[np.asarray(rows, dtype=np.int64)] = False
+
+    def delete(self, chunk_ids: list[str]) -> None:
+        with self._lock:
+            self._mark_deleted(chunk_ids)
+            self._conn.commit()
+
+    @property
+    def deleted_ratio(self) -> float:
+        return 1.0 - self.ntotal / self.rows if self.rows else 0.0
+
+    def compact(self, exclude: list[str] | None = None) -> "CompactIndex":
+        """
+        Переписывает живые ссылки, кроме chunk_id из exclude, в новое поколение
+        (commit выполняет вызывающий). Векторы не копируются.
+        """
+        new = CompactIndex.create(self.path, self.store)
+        skip = set(exclude or ())
+        with self._lock:
+            rows = [int(r) for r in np.flatnonzero(self._alive)]
+            for part in _batches(rows, _SCORE_BLOCK_ROWS):
+                refs = [r for r in self._fetch(part) if r[0] not in skip]
+                if refs:
+                    new.add([r[0] for r in refs], [r[1] for r in refs], [r[2] for r in refs])
+        return new
+
+    # -------------------- READ --------------------
+    def _fetch(self, rows: list[int]) -> list[tuple[str, int, dict]]:
+        found: dict[int, tuple[str, int, dict]] = {}
+        with self._lock:
+            for part in _batches(rows):
+                marks = ",".join("?" * len(part))
+                for row, cid, srow, meta in self._conn.execute(
+                    f"SELECT row, chunk_id, store_row, metadata FROM chunks WHERE row IN ({marks})", part
+                ):
+                    found[row] = (cid, srow, json.loads(meta))
+        return [found[r] for r in rows if r in found]
+
+    def _documents(self, refs: list[tuple[str, int, dict]]) -> list[Document]:
+        texts = self.store.texts([srow for _, srow, _ in refs])
+        return [Document(page_content=texts[srow], metadata=meta) for _, srow, meta in refs if srow in texts]
+
+    def get_documents(self, rows: list[int]) -> list[Document]:
+        return self._documents(self._fetch(rows))
+
+    def get_by_chunk_ids(self, chunk_ids: list[str]) -> list[Document]:
+        if not chunk_ids:
+            return []
+        marks = ",".join("?" * len(chunk_ids))
+        with self._lock:
+            found = {
+                cid: (cid, srow, json.loads(meta))
+                for cid, srow, meta in self._conn.execute(
+                    f"SELECT chunk_id, store_row, metadata FROM chunks WHERE deleted = 0 AND chunk_id IN ({marks})",
+                    chunk_ids,
+                )
+            }
+        return self._documents([found[c] for c in chunk_ids if c in found])
+
+    def _scores(self, q: np.ndarray) -> np.ndarray:
+        store_rows, alive = self._store_rows, self._alive
+        scores = np.full(len(alive), -np.inf, dtype=np.float32)
+        for start in range(0, len(alive), _SCORE_BLOCK_ROWS):
+            stop = start + _SCORE_BLOCK_ROWS
+            scores[start:stop] = self.store.vectors(store_rows[start:stop]) @ q
+        scores[~alive] = -np.inf
+        return scores
+
+    def _query(self, query_vector) -> np.ndarray:
+        q = np.asarray(query_vector, dtype=np.float32)
+        n = float(np.linalg.norm(q))
+        return q / n if n else q
+
+    def similarity_search(self, query_vector, k: int) -> list[tuple[int, float]]:
+        """Top-k строк по косинусной близости: [(row, score)]."""
+        scores = self._scores(self._query(query_vector))
+        n_alive = int(np.isfinite(scores).sum())
+        if n_alive == 0:
+            return []
+        k = min(k, n_alive)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(r), float(scores[r])) for r in top]
+
+    def max_marginal_relevance_search(
+        self, query_vector, k: int, fetch_k: int, lambda_mult: float = 0.5
+    ) -> list[int]:
+        """MMR: k строк из fetch_k ближайших, баланс релевантности и разнообразия."""
+        candidates = self.similarity_search(query_vector, fetch_k)
+        if not candidates:
+            return []
+        rows = [r for r, _ in candidates]
+        relevance = np.asarray([s for _, s in candidates], dtype=np.float32)
+        cand_vecs = self.store.vectors(self._store_rows[rows])
+
+        selected: list[int] = [0]
+        while len(selected) < min(k, len(rows)):
+            redundancy = (cand_vecs @ cand_vecs[selected].T).max(axis=1)
+            mmr = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+            mmr[selected] = -np.inf
+            selected.append(int(np.argmax(mmr)))
+        return [rows[i] for i in selected]
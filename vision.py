@@ -0,0 +1,155 @@
+"""
+Подготовка фото для vision-запросов и кэш ответов по перцептивному хэшу.
+
+Фото скачивается в память, уменьшается до размера, который модель всё равно
+использует (detail=high: вписать в 2048×2048, короткая сторона ≤ 768), и
+пережимается в JPEG. Ответ кэшируется по dHash картинки + тексту вопроса:
+пересланное или повторно отправленное фото (Telegram пережимает его заново)
+даёт тот же хэш с точностью до нескольких бит и отвечается сразу.
+"""
+import io
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+import numpy as np
+from PIL import ExifTags, Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+VISION_MAX_SIDE = 2048
+VISION_MAX_SHORT_SIDE = 768
+VISION_JPEG_QUALITY = 85
+# Фото, отличающиеся не больше чем в стольких битах dHash из 64, считаются одним
+PHASH_MAX_DISTANCE = 4
+
+
+def _target_size(width: int, height: int) -> tuple[int, int]:
+    scale = min(1.0, VISION_MAX_SIDE / max(width, height))
+    scale = min(scale, VISION_MAX_SHORT_SIDE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def dhash(image: Image.Image, size: int = 8) -> int:
+    """Разностный хэш: 64 бита «левый пиксель ярче правого» по уменьшенной серой картинке."""
+    small = image.convert("L").resize((size + 1, size), Image.Resampling.LANCZOS)
+    px = np.asarray(small, dtype=np.int16)
+    bits = (px[:, 1:] > px[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def prepare_image(data: bytes) -> tuple[bytes, int]:
+    """(JPEG для модели, dHash) из исходных байтов фото; поворот по EXIF применяется."""
+    with Image.open(io.BytesIO(data)) as src:
+        is_jpeg = src.format == "JPEG"
+        rotated = src.getexif().get(ExifTags.Base.Orientation, 1) != 1
+        image = ImageOps.exif_transpose(src).convert("RGB")
+    phash = dhash(image)
+
+    size = _target_size(*image.size)
+    resized = size != image.size
+    if resized:
+        image = image.resize(size, Image.Resampling.LANCZOS)
+    out = io.BytesIO()
+    image.save(out, format="JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+    jpeg = out.getvalue()
+    # Небольшой JPEG без поворота пережимать незачем, если он и так не больше
+    if is_jpeg and not resized and not rotated and len(data) <= len(jpeg):
+        jpeg = data
+    logger.info(
+        "Фото для vision: %d КБ → %d КБ, %dx%d", len(data) // 1024, len(jpeg) // 1024, size[0], size[1]
+    )
+    return jpeg, phash
+
+
+def _normalize_prompt(prompt: str) -> str:
+    return " ".join(prompt.lower().replace("ё", "е").split())
+
+
+class VisionAnswerCache:
+    """
+    Кэш vision-ответов (SQLite): ключ — модель, нормализованный вопрос и dHash фото.
+    Попадание — тот же вопрос и расстояние Хэмминга хэшей ≤ max_distance, не старше ttl.
+    Лишние записи сверх max_entries вытесняются по last_used (LRU).
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        max_distance: int = PHASH_MAX_DISTANCE,
+        ttl_seconds: float = 30 * 24 * 3600,
+        max_entries: int = 5000,
+    ):
+        self.db_path = db_path
+        self.max_distance = max_distance
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " model TEXT NOT NULL,"
+                " prompt TEXT NOT NULL,"
+                " phash INTEGER NOT NULL,"
+                " answer TEXT NOT NULL,"
+                " created REAL NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS answers_prompt ON answers(model, prompt)")
+            conn.execute("CREATE INDEX IF NOT EXISTS answers_last_used ON answers(last_used)")
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _signed(phash: int) -> int:
+        # SQLite INTEGER — знаковые 64 бита
+        return phash - (1 << 64) if phash >= 1 << 63 else phash
+
+    def lookup(self, model: str, prompt: str, phash: int) -> str | None:
+        with self._lock:
+            db = self._db()
+            rows = db.execute(
+                "SELECT id, phash, answer FROM answers WHERE model = ? AND prompt = ? AND created >= ?",
+                (model, _normalize_prompt(prompt), time.time() - self.ttl_seconds),
+            ).fetchall()
+            best = None
+            for row_id, stored, answer in rows:
+                distance = ((stored & ((1 << 64) - 1)) ^ phash).bit_count()
+                if distance <= self.max_distance and (best is None or distance < best[0]):
+                    best = (distance, row_id, answer)
+            if best is None:
+                self.misses += 1
+                return None
+            db.execute("UPDATE answers SET last_used = ? WHERE id = ?", (time.time(), best[1]))
+            db.commit()
+            self.hits += 1
+            return best[2]
+
+    def put(self, model: str, prompt: str, phash: int, answer: str) -> None:
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT INTO answers (model, prompt, phash, answer, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (model, _normalize_prompt(prompt), self._signed(phash), answer, now, now),
+            )
+            db.execute("DELETE FROM answers WHERE created < ?", (now - self.ttl_seconds,))
+            db.execute(
+                "DELETE FROM answers WHERE id NOT IN (SELECT id FROM answers ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            db.commit()